@@ -13,13 +13,20 @@ os.environ.setdefault("OMP_NUM_THREADS", "1")
 
 # Import các modules
 import config
+import model_registry
+import vector_store
+from frame_cache import get_frame_cache
 from search_video import VideoSearcher
 from extract_features import VideoFeatureExtractor
 from verify_video import VideoVerifier
+from job_queue import JobQueue, JobError, QueueFullError, DONE, ERROR
 import time
 import glob
 import shutil
 import threading
+import copy
+from collections import OrderedDict
+import numpy as np
 
 
 app = Flask(__name__)
@@ -31,26 +38,30 @@ CORS(app)
 searcher = None
 extractor = None
 verifier = None
-index_mtime = None
-metadata_mtime = None
 _ingest_thread_started = False
+_init_lock = threading.Lock()
+
+# Index + metadata dùng chung cho searcher và verifier, reload ở thread nền
+index_holder = vector_store.IndexHolder()
+
+# Mọi công việc nặng (search/verify/extract) chạy trên worker pool giới hạn
+jobs = JobQueue(config.JOB_WORKERS, kind_limits=config.JOB_KIND_LIMITS,
+                max_queue=config.JOB_MAX_QUEUE, result_ttl=config.JOB_RESULT_TTL_SEC)
 
 
 def _reload_searcher():
-    """Reload VideoSearcher and capture index/metadata mtimes."""
-    global searcher, index_mtime, metadata_mtime
-    searcher = VideoSearcher()
-    index_mtime = os.path.getmtime(config.FEATURES_FILE) if os.path.exists(config.FEATURES_FILE) else None
-    metadata_mtime = os.path.getmtime(config.METADATA_FILE) if os.path.exists(config.METADATA_FILE) else None
+    """Yêu cầu watcher load generation index mới ở nền (không chặn request hiện tại)."""
+    index_holder.request_reload()
     return searcher
 
 
 def get_searcher():
-    global searcher, index_mtime, metadata_mtime
-    current_index_mtime = os.path.getmtime(config.FEATURES_FILE) if os.path.exists(config.FEATURES_FILE) else None
-    current_metadata_mtime = os.path.getmtime(config.METADATA_FILE) if os.path.exists(config.METADATA_FILE) else None
-    if searcher is None or index_mtime != current_index_mtime or metadata_mtime != current_metadata_mtime:
-        return _reload_searcher()
+    global searcher
+    if searcher is None:
+        with _init_lock:
+            if searcher is None:
+                searcher = VideoSearcher(holder=index_holder)
+                index_holder.start_watcher()
     return searcher
 
 
@@ -64,10 +75,84 @@ def get_extractor():
 def get_verifier():
     global verifier
     if verifier is None:
-        verifier = VideoVerifier()
+        with _init_lock:
+            if verifier is None:
+                verifier = VideoVerifier(holder=index_holder)
+                index_holder.start_watcher()
     return verifier
 
 
+def _index_generation():
+    """Generation của index đang dùng (đổi khi base/delta được ghi lại)."""
+    return index_holder.current().version
+
+
+# ======================================================
+# 🗃️ Query cache (LRU) cho /search
+# ======================================================
+class QueryResultCache:
+    """
+    LRU: key = (path chuẩn hóa, size, mtime, top_k) → (query vector, kết quả, generation, partial).
+    Khi generation index đổi, kết quả cũ bị bỏ nhưng vector query vẫn dùng lại
+    (chỉ cần chạy lại FAISS, không decode/CLIP lại).
+    partial=True: vector của search progressive dừng sớm (chỉ 1 phần frame). Vector này chỉ
+    đủ tin cậy cùng với phép kiểm tra margin lúc tạo ra, nên chỉ trả lại cho request progressive
+    khi generation chưa đổi; các trường hợp khác coi như miss.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0          # trả kết quả từ cache
+        self.vector_hits = 0   # chỉ dùng lại vector (index đã đổi)
+        self.misses = 0
+
+    @staticmethod
+    def make_key(video_path, top_k):
+        st = os.stat(video_path)
+        return (os.path.normcase(os.path.abspath(video_path)), st.st_size, st.st_mtime, top_k)
+
+    def get(self, key, generation, allow_partial=False):
+        """Trả về (query_vec, results); results = None nếu generation đã đổi."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] and (not allow_partial or entry[2] != generation):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            query_vec, results, entry_generation, _partial = entry
+            if entry_generation != generation:
+                self.vector_hits += 1
+                return query_vec, None
+            self.hits += 1
+            return query_vec, copy.deepcopy(results)
+
+    def put(self, key, generation, query_vec, results, partial=False):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (query_vec, copy.deepcopy(results), generation, partial)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'vector_hits': self.vector_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+query_cache = QueryResultCache(config.QUERY_CACHE_SIZE)
+
+
 # ======================================================
 # 🧰 Hàm tiện ích
 # ======================================================
@@ -104,97 +189,203 @@ def health():
         'data_dir': config.DATA_DIR,
         'vector_folder': config.VECTOR_FOLDER,
         'env': platform.system(),
-        'index_mtime': os.path.getmtime(config.FEATURES_FILE) if os.path.exists(config.FEATURES_FILE) else None,
-        'metadata_mtime': os.path.getmtime(config.METADATA_FILE) if os.path.exists(config.METADATA_FILE) else None
+        'generation': vector_store.store_version(),
+        'delta_segments': len(vector_store.read_manifest().get('deltas', [])),
+        'index': index_holder.info(),
+        'model': model_registry.memory_info(),
+        'frame_cache': get_frame_cache().stats() if get_frame_cache() else None,
+        'query_cache': query_cache.stats(),
+        'jobs': jobs.stats()
     })
 
 
 # ======================================================
 # 🔍 Search API
 # ======================================================
-@app.route('/search', methods=['POST'])
-def search():
-    """Tìm kiếm video tương đồng"""
-    try:
-        data = request.get_json()
-        video_path = data.get('video_path')
+def _format_search_results(results):
+    """Format kết quả trả về và chuẩn hóa đường dẫn từ metadata theo môi trường hiện tại."""
+    formatted_results = []
+    for r in results:
+        formatted_results.append({
+            'rank': r.get('rank', 0),
+            'video_name': r.get('video_name', 'Unknown'),
+            'similarity': float(r.get('similarity', 0)),
+            'video_path': normalize_video_path(r.get('video_path', ''))
+        })
+    return formatted_results
 
-        if not video_path:
-            return jsonify({'error': 'Missing video_path'}), 400
 
-        # 🔧 Chuẩn hóa đường dẫn theo môi trường
-        video_path = normalize_video_path(video_path)
+def _search_job(data):
+    """Tìm kiếm video tương đồng"""
+    video_path = data.get('video_path')
 
-        if not os.path.exists(video_path):
-            return jsonify({'error': f'Video not found: {video_path}'}), 404
+    if not video_path:
+        raise JobError('Missing video_path', 400)
+
+    # 🔧 Chuẩn hóa đường dẫn theo môi trường
+    video_path = normalize_video_path(video_path)
+
+    if not os.path.exists(video_path):
+        raise JobError(f'Video not found: {video_path}', 404)
+
+    if not os.path.isfile(video_path):
+        raise JobError(f'Path is not a valid file: {video_path}', 404)
+
+    progressive = data.get('progressive')
+    progressive = config.SEARCH_PROGRESSIVE if progressive is None else bool(progressive)
+    # include_stats: trả về {results, frames_used, ...} thay vì list kết quả
+    include_stats = bool(data.get('include_stats'))
+
+    # Gọi search (ưu tiên LRU cache theo path/size/mtime)
+    searcher = get_searcher()
+    generation = _index_generation()
+    cache_key = QueryResultCache.make_key(video_path, config.TOP_K)
+    query_vec, cached_results = query_cache.get(cache_key, generation, allow_partial=progressive)
+    stats = {'frames_used': 0, 'frames_total': None, 'margin': None, 'cached': True}
+    partial = False
+    if cached_results is not None:
+        return dict(stats, results=cached_results) if include_stats else cached_results
+
+    if query_vec is None and progressive:
+        query_vec, results, info = searcher.search_progressive(video_path, top_k=config.TOP_K)
+        stats = dict(info, cached=False)
+        # Dừng trước stride 1 → vector chỉ từ 1 phần lưới frame
+        partial = info['stride'] != 1
+        print(f"[SEARCH] {os.path.basename(video_path)}: {info['frames_used']}/{info['frames_total']} frame, "
+              f"margin={info['margin']}")
+    else:
+        if query_vec is None:
+            query_vec = searcher.extract_features_from_query_video(video_path)
+            stats = {'frames_used': None, 'frames_total': None, 'margin': None, 'cached': False}
+        results = searcher.search_vector(query_vec, top_k=config.TOP_K) if query_vec is not None else []
+    formatted_results = _format_search_results(results)
 
-        if not os.path.isfile(video_path):
-            return jsonify({'error': f'Path is not a valid file: {video_path}'}), 404
+    if query_vec is not None:
+        query_cache.put(cache_key, generation, query_vec, formatted_results, partial=partial)
+    return dict(stats, results=formatted_results) if include_stats else formatted_results
 
-        # Gọi search
-        searcher = get_searcher()
-        results = searcher.search(video_path, top_k=config.TOP_K)
 
-        # Format kết quả trả về và chuẩn hóa đường dẫn theo môi trường hiện tại
-        formatted_results = []
-        for r in results:
-            video_path = r.get('video_path', '')
-            # Chuẩn hóa đường dẫn từ metadata theo môi trường hiện tại
-            normalized_path = normalize_video_path(video_path)
-            formatted_results.append({
-                'rank': r.get('rank', 0),
-                'video_name': r.get('video_name', 'Unknown'),
-                'similarity': float(r.get('similarity', 0)),
-                'video_path': normalized_path
-            })
+@app.route('/search', methods=['POST'])
+def search():
+    return _run_sync('search', request.get_json(silent=True) or {})
 
-        return jsonify(formatted_results)
 
-    except Exception as e:
-        print(f'[SEARCH ERROR] {str(e)}')
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+def _search_batch_job(data):
+    """
+    Tìm kiếm nhiều video trong 1 request: decode song song, frame gộp chung batch CLIP,
+    1 lần index.search cho toàn bộ vector query. Trả về kết quả theo từng path.
+    """
+    video_paths = data.get('video_paths')
+    if not isinstance(video_paths, list) or not video_paths:
+        raise JobError('Missing video_paths', 400)
+    if len(video_paths) > config.SEARCH_BATCH_MAX_PATHS:
+        raise JobError(f'Too many video_paths (max {config.SEARCH_BATCH_MAX_PATHS})', 400)
+    top_k = int(data.get('top_k') or config.TOP_K)
+
+    searcher = get_searcher()
+    generation = _index_generation()
+    items = []
+    for raw_path in video_paths:
+        video_path = normalize_video_path(raw_path) if isinstance(raw_path, str) else None
+        item = {'video_path': raw_path, 'path': video_path, 'vec': None, 'results': None, 'error': None}
+        items.append(item)
+        if not video_path or not os.path.isfile(video_path):
+            item['error'] = f'Video not found: {video_path}'
+            continue
+        item['key'] = QueryResultCache.make_key(video_path, top_k)
+        item['vec'], item['results'] = query_cache.get(item['key'], generation)
+
+    # Decode + CLIP chung cho các path chưa có vector trong cache
+    to_embed = [it for it in items if it['error'] is None and it['vec'] is None]
+    if to_embed:
+        vectors = searcher.extract_features_from_query_videos([it['path'] for it in to_embed])
+        for it, vec in zip(to_embed, vectors):
+            it['vec'] = vec
+
+    # 1 lần search dạng ma trận cho mọi query chưa có kết quả
+    to_search = [it for it in items if it['error'] is None and it['results'] is None]
+    with_vec = [it for it in to_search if it['vec'] is not None]
+    if with_vec:
+        matrix = np.stack([np.asarray(it['vec'], dtype='float32').reshape(-1) for it in with_vec])
+        for it, results in zip(with_vec, searcher.search_vectors(matrix, top_k=top_k)):
+            it['results'] = _format_search_results(results)
+            query_cache.put(it['key'], generation, it['vec'], it['results'])
+    for it in to_search:
+        if it['vec'] is None:
+            it['results'] = []
+
+    response = []
+    for it in items:
+        if it['error'] is not None:
+            response.append({'video_path': it['video_path'], 'error': it['error']})
+        else:
+            response.append({'video_path': it['video_path'], 'results': it['results']})
+    return {'count': len(response), 'top_k': top_k, 'results': response}
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    return _run_sync('search_batch', request.get_json(silent=True) or {})
+
+
+def _live_search_job(data, report):
+    """
+    Live search trên file livestream đang được ghi: kết quả tạm thời được cập nhật vào
+    progress của job (GET /jobs/<id>), kết quả cuối là result của job.
+    """
+    video_path = data.get('video_path')
+    if not video_path:
+        raise JobError('Missing video_path', 400)
+    video_path = normalize_video_path(video_path)
+    if not os.path.isfile(video_path):
+        raise JobError(f'Video not found: {video_path}', 404)
+    top_k = int(data.get('top_k') or config.TOP_K)
+
+    update = None
+    for update in get_searcher().live_search(video_path, top_k=top_k):
+        update = dict(update, results=_format_search_results(update['results']))
+        report(update)
+    return update
 
 
 # ======================================================
 # 🧠 Extract API
 # ======================================================
-@app.route('/extract', methods=['POST'])
-def extract():
+def _extract_job(data):
     """Trích xuất features từ video folder"""
-    try:
-        from extract_features import save_features
-
-        # Cho phép body chỉ định mode và folder
-        data = request.get_json(silent=True) or {}
-        mode = data.get('mode', 'create')
-        video_folder = data.get('video_folder') or config.VIDEO_FOLDER
-
-        extractor = get_extractor()
-        features_list, metadata_list = extractor.process_video_folder(
-            video_folder,
-            use_parallel=True,
-            n_jobs=config.N_JOBS
-        )
-        save_features(features_list, metadata_list, mode=mode)
-
-        # Reload searcher sau update
-        _reload_searcher()
+    from extract_features import save_features
 
-        return jsonify({
-            'success': True,
-            'message': 'Extraction completed',
-            'features_file': config.FEATURES_FILE,
-            'metadata_file': config.METADATA_FILE,
-            'mode': mode,
-            'video_folder': video_folder,
-            'total_videos': len(metadata_list)
-        })
+    # Cho phép body chỉ định mode và folder
+    mode = data.get('mode', 'create')
+    video_folder = data.get('video_folder') or config.VIDEO_FOLDER
 
-    except Exception as e:
-        print(f'[EXTRACT ERROR] {str(e)}')
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    extractor = get_extractor()
+    features_list, metadata_list, sequences_list = extractor.process_video_folder(
+        video_folder,
+        use_parallel=True,
+        n_jobs=config.N_JOBS
+    )
+    save_features(features_list, metadata_list, mode=mode, sequences_list=sequences_list)
+
+    # Reload searcher sau update
+    _reload_searcher()
+
+    files = vector_store.current_files()
+    return {
+        'success': True,
+        'message': 'Extraction completed',
+        'generation': files['generation'],
+        'features_file': files['index_file'],
+        'metadata_file': files['metadata_file'],
+        'mode': mode,
+        'video_folder': video_folder,
+        'total_videos': len(metadata_list)
+    }
+
+
+@app.route('/extract', methods=['POST'])
+def extract():
+    return _run_sync('extract', request.get_json(silent=True) or {})
 
 
 # ======================================================
@@ -202,15 +393,18 @@ def extract():
 # ======================================================
 @app.route('/refresh-searcher', methods=['POST'])
 def refresh_searcher():
-    """Force reload of VideoSearcher (after vector updates)."""
+    """Force reload of the shared index generation (after vector updates)."""
     try:
-        s = _reload_searcher()
+        # Load ngay trên request này; search đang chạy vẫn dùng generation cũ tới khi swap
+        index_holder.refresh(force=True)
+        files = vector_store.current_files()
         return jsonify({
             'success': True,
             'message': 'Searcher reloaded',
-            'index_file': config.FEATURES_FILE,
-            'metadata_file': config.METADATA_FILE,
-            'metadata_count': len(getattr(s, 'metadata', []))
+            'generation': index_holder.current().version,
+            'index_file': files['index_file'],
+            'metadata_file': files['metadata_file'],
+            'metadata_count': len(index_holder.current().metadata)
         })
     except Exception as e:
         print(f'[REFRESH ERROR] {str(e)}')
@@ -268,18 +462,13 @@ def _run_ingest_cycle():
     moved_to_temp = _move_all(config.SAVE_FOLDER, config.TEMP_FOLDER)
     print(f"[INGEST] Moved to temp: {len(moved_to_temp)} files")
 
-    # 2) Update vectors from TEMP
-    extractor = get_extractor()
-    features_list, metadata_list = extractor.process_video_folder(
-        config.TEMP_FOLDER,
-        use_parallel=True,
-        n_jobs=config.N_JOBS
-    )
-    if features_list:
-        from extract_features import save_features
-        save_features(features_list, metadata_list, mode="update")
-        print(f"[INGEST] Updated vectors: +{len(features_list)}")
-        _reload_searcher()
+    # 2) Update vectors from TEMP: đi qua hàng đợi như job 'extract' (chung giới hạn JOB_KIND_LIMITS['extract'])
+    if _list_videos(config.TEMP_FOLDER):
+        job = jobs.run('extract', {'mode': 'update', 'video_folder': config.TEMP_FOLDER})
+        if job.status == ERROR:
+            # Video giữ lại trong TEMP, vòng sau xử lý lại
+            raise RuntimeError(f"extract job {job.id} failed: {job.error}")
+        print(f"[INGEST] Updated vectors from {job.result['total_videos']} videos (job {job.id})")
     else:
         print("[INGEST] No new features to update")
 
@@ -289,6 +478,14 @@ def _run_ingest_cycle():
     print("=== [INGEST] Cycle End ===\n")
 
 
+def _maybe_compact():
+    """Gộp delta vào base khi đủ số lượng/tuổi (chạy nền trong ingest worker)."""
+    if not vector_store.needs_compaction():
+        return
+    if vector_store.compact() is not None:
+        _reload_searcher()
+
+
 def _ingest_worker_loop():
     while True:
         try:
@@ -296,6 +493,11 @@ def _ingest_worker_loop():
         except Exception as e:
             print(f"[INGEST] Cycle error: {e}")
             traceback.print_exc()
+        try:
+            _maybe_compact()
+        except Exception as e:
+            print(f"[COMPACT] Error: {e}")
+            traceback.print_exc()
         # Nghỉ 3 phút sau mỗi vòng xử lý
         time.sleep(180)
 
@@ -312,34 +514,101 @@ def _start_ingest_worker():
 # ======================================================
 # ✅ Verify API
 # ======================================================
+def _verify_job(data):
+    """Verify video similarity"""
+    video_path = data.get('video_path')
+
+    if not video_path:
+        raise JobError('Missing video_path', 400)
+
+    # 🔧 Chuẩn hóa đường dẫn theo môi trường
+    video_path = normalize_video_path(video_path)
+
+    if not os.path.exists(video_path):
+        raise JobError(f'Video not found: {video_path}', 404)
+
+    verifier = get_verifier()
+    result = verifier.verify(video_path)
+
+    return {
+        'similarity': float(result.get('similarity', 0)),
+        'video_path': video_path,
+        'method': result.get('method'),
+        'alignment_similarity': result.get('alignment_similarity'),
+        'offset_sec': result.get('offset_sec')
+    }
+
+
 @app.route('/verify', methods=['POST'])
 def verify():
-    """Verify video similarity"""
-    try:
-        data = request.get_json()
-        video_path = data.get('video_path')
+    return _run_sync('verify', request.get_json(silent=True) or {})
 
-        if not video_path:
-            return jsonify({'error': 'Missing video_path'}), 400
 
-        # 🔧 Chuẩn hóa đường dẫn theo môi trường
-        video_path = normalize_video_path(video_path)
+# ======================================================
+# 📋 Job API: submit → status → result
+# ======================================================
+jobs.register('search', _search_job)
+jobs.register('search_batch', _search_batch_job)
+jobs.register('verify', _verify_job)
+jobs.register('extract', _extract_job)
+jobs.register('live_search', _live_search_job, progress=True)
 
-        if not os.path.exists(video_path):
-            return jsonify({'error': f'Video not found: {video_path}'}), 404
 
-        verifier = get_verifier()
-        result = verifier.verify(video_path)
+def _job_result_response(job):
+    if job.status == DONE:
+        return jsonify(job.result)
+    if job.status == ERROR:
+        return jsonify({'error': job.error}), job.error_status or 500
+    return jsonify(dict(job.to_dict(jobs.position(job)),
+                        status_url=f'/jobs/{job.id}', result_url=f'/jobs/{job.id}/result')), 202
 
-        return jsonify({
-            'similarity': float(result.get('similarity', 0)),
-            'video_path': video_path
-        })
 
-    except Exception as e:
-        print(f'[VERIFY ERROR] {str(e)}')
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+def _run_sync(kind, data):
+    """
+    Endpoint đồng bộ cũ: đi qua cùng hàng đợi (quá tải thì xếp hàng), chờ tối đa JOB_SYNC_TIMEOUT_SEC.
+    Chưa xong thì trả 202 + job_id/result_url, không giữ HTTP request (và worker Flask) vô hạn.
+    """
+    try:
+        return _job_result_response(jobs.run(kind, data, timeout=config.JOB_SYNC_TIMEOUT_SEC))
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 429
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Body: {"kind": "search" | "search_batch" | "verify" | "extract" | "live_search", "params": {...}} → 202 + job_id."""
+    data = request.get_json(silent=True) or {}
+    try:
+        job = jobs.submit(data.get('kind'), data.get('params') or {})
+    except JobError as e:
+        return jsonify({'error': str(e)}), e.status
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify(dict(job.to_dict(jobs.position(job)),
+                        status_url=f'/jobs/{job.id}', result_url=f'/jobs/{job.id}/result')), 202
+
+
+@app.route('/jobs', methods=['GET'])
+def job_metrics():
+    """Độ sâu hàng đợi, số job đang chạy / đã xong theo từng loại."""
+    return jsonify(jobs.stats())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+    return jsonify(job.to_dict(jobs.position(job)))
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """200 + kết quả khi xong, 202 khi còn chờ/chạy, mã lỗi của job khi thất bại."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+    return _job_result_response(job)
 
 
 # ======================================================
@@ -0,0 +1,214 @@
+"""
+Embed khung hình bằng CLIP theo micro-batch, cộng dồn vào running mean
+(bộ nhớ đỉnh phụ thuộc batch size, không phụ thuộc độ dài video)
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import config
+import model_registry
+from fingerprint import file_fingerprint
+
+
+def embed_batch(images, clip=None):
+    """Embed 1 batch PIL.Image → np.float32 [n, d], mỗi dòng đã chuẩn hóa L2."""
+    model, processor, device = clip or model_registry.get_clip()
+    inputs = processor(images=images, return_tensors="pt", padding=True)
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with torch.no_grad():
+        feats = model.get_image_features(**inputs)
+        feats = feats / feats.norm(p=2, dim=-1, keepdim=True)
+    return feats.cpu().numpy().astype('float32')
+
+
+def iter_embedding_batches(timed_images, batch_size=None, clip=None):
+    """
+    Nhận iterator (t, PIL.Image), yield (times, embeddings) theo từng micro-batch.
+    Chỉ giữ tối đa batch_size ảnh trong bộ nhớ.
+    """
+    batch_size = batch_size or config.EMBED_BATCH_SIZE
+    times, images = [], []
+    for t, img in timed_images:
+        times.append(t)
+        images.append(img)
+        if len(images) >= batch_size:
+            yield np.asarray(times, dtype='float64'), embed_batch(images, clip)
+            times, images = [], []
+    if images:
+        yield np.asarray(times, dtype='float64'), embed_batch(images, clip)
+
+
+class RunningMean:
+    """Cộng dồn embedding đã chuẩn hóa; vector() trả về mean đã chuẩn hóa L2."""
+
+    def __init__(self):
+        self.sum = None
+        self.count = 0
+
+    def add(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype='float32')
+        if embeddings.ndim == 1:
+            embeddings = embeddings.reshape(1, -1)
+        if len(embeddings) == 0:
+            return
+        batch_sum = embeddings.sum(axis=0, dtype='float64')
+        self.sum = batch_sum if self.sum is None else self.sum + batch_sum
+        self.count += len(embeddings)
+
+    def vector(self):
+        if self.sum is None or self.count == 0:
+            return None
+        vec = (self.sum / self.count).astype('float32')
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec = vec / norm
+        return vec
+
+
+def embed_mean(timed_images, batch_size=None, clip=None):
+    """Vector đặc trưng trung bình (đã chuẩn hóa) của cả chuỗi ảnh, None nếu rỗng."""
+    acc = RunningMean()
+    for _times, embs in iter_embedding_batches(timed_images, batch_size=batch_size, clip=clip):
+        acc.add(embs)
+    return acc.vector()
+
+
+def embed_sequence(timed_images, batch_size=None, clip=None):
+    """
+    Embedding từng frame của cả chuỗi ảnh: (times float64 [n], embeddings float32 [n, d]),
+    (None, None) nếu rỗng. Vector trung bình = RunningMean của chính các embedding này.
+    """
+    times, embs = [], []
+    for batch_times, batch_embs in iter_embedding_batches(timed_images, batch_size=batch_size, clip=clip):
+        times.append(batch_times)
+        embs.append(batch_embs)
+    if not embs:
+        return None, None
+    return np.concatenate(times), np.concatenate(embs)
+
+
+def iter_video_embeddings(sampler, video_path, time_points, cache=None, on_progress=None, batch_size=None):
+    """
+    Yield (times, embeddings) cho các thời điểm của 1 video.
+    Nếu có cache: trả phần đã cache trước (không decode), chỉ decode + embed phần thiếu
+    rồi ghi bổ sung vào cache.
+    """
+    time_points = np.asarray(time_points, dtype='float64')
+    fingerprint = None
+    if cache is not None and len(time_points):
+        try:
+            fingerprint = file_fingerprint(video_path)
+            found, cached = cache.lookup(fingerprint, time_points)
+            if cached is not None and len(cached):
+                yield time_points[found], cached
+            time_points = time_points[~found]
+        except OSError as e:
+            print(f"[FRAME CACHE] Bỏ qua cache cho {video_path}: {e}")
+            fingerprint = None
+
+    new_times, new_embs = [], []
+    for times, embs in iter_embedding_batches(
+            sampler.iter_images(video_path, time_points, on_progress=on_progress), batch_size=batch_size):
+        if fingerprint is not None:
+            new_times.append(times)
+            new_embs.append(embs)
+        yield times, embs
+
+    if fingerprint is not None and new_embs:
+        cache.store(fingerprint, np.concatenate(new_times), np.concatenate(new_embs))
+
+
+def embed_video_mean(sampler, video_path, time_points, cache=None, on_progress=None, batch_size=None):
+    """Vector trung bình (đã chuẩn hóa) của 1 video, dùng cache frame nếu có."""
+    acc = RunningMean()
+    for _times, embs in iter_video_embeddings(sampler, video_path, time_points, cache=cache,
+                                              on_progress=on_progress, batch_size=batch_size):
+        acc.add(embs)
+    return acc.vector()
+
+
+def embed_video_means(sampler, video_paths, time_points, cache=None, max_workers=None, batch_size=None):
+    """
+    Vector trung bình của nhiều video cùng lúc: decode song song (mỗi video 1 thread, cv2 nhả GIL),
+    frame của mọi video được gộp chung vào các micro-batch CLIP.
+    Trả về list cùng thứ tự video_paths; None nếu video không đọc được frame nào.
+    """
+    batch_size = batch_size or config.EMBED_BATCH_SIZE
+    max_workers = max(1, max_workers or config.SEARCH_BATCH_WORKERS)
+    time_points = np.asarray(time_points, dtype='float64')
+    accs = [RunningMean() for _ in video_paths]
+    pending = {}      # vị trí video → (fingerprint, thời điểm cần decode)
+    for i, path in enumerate(video_paths):
+        fingerprint, missing = None, time_points
+        if cache is not None and len(time_points):
+            try:
+                fingerprint = file_fingerprint(path)
+                found, cached = cache.lookup(fingerprint, time_points)
+                if cached is not None and len(cached):
+                    accs[i].add(cached)
+                missing = time_points[~found]
+            except OSError as e:
+                print(f"[FRAME CACHE] Bỏ qua cache cho {path}: {e}")
+                fingerprint = None
+        if len(missing):
+            pending[i] = (fingerprint, missing)
+
+    # Hàng đợi giới hạn: decode không chạy quá xa CLIP (bộ nhớ đỉnh ~ vài batch ảnh)
+    frames = queue.Queue(maxsize=batch_size * 2)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _decode(i):
+        try:
+            for t, img in sampler.iter_images(video_paths[i], pending[i][1]):
+                if stop.is_set():
+                    return
+                _put((i, t, img))
+        except Exception as e:
+            print(f"[EMBED] Lỗi decode {video_paths[i]}: {e}")
+        finally:
+            _put((i, None, done))
+
+    new_rows = {i: ([], []) for i in pending}
+
+    def _flush(items):
+        embs = embed_batch([img for _i, _t, img in items])
+        owners = np.array([i for i, _t, _img in items])
+        for i in np.unique(owners):
+            mask = owners == i
+            accs[i].add(embs[mask])
+            if pending[i][0] is not None:
+                new_rows[i][0].append(np.array([t for (j, t, _img) in items if j == i], dtype='float64'))
+                new_rows[i][1].append(embs[mask])
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch-decode") as pool:
+        for i in pending:
+            pool.submit(_decode, i)
+        try:
+            remaining, items = len(pending), []
+            while remaining:
+                i, t, img = frames.get()
+                if img is done:
+                    remaining -= 1
+                else:
+                    items.append((i, t, img))
+                if len(items) >= batch_size or (items and not remaining):
+                    _flush(items)
+                    items = []
+        finally:
+            stop.set()
+
+    for i, (times, embs) in new_rows.items():
+        if embs:
+            cache.store(pending[i][0], np.concatenate(times), np.concatenate(embs))
+    return [acc.vector() for acc in accs]
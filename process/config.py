@@ -44,8 +44,18 @@ TEMP_FOLDER = os.path.join(DATA_DIR, "1temp")
 SAVE_FOLDER = os.path.join(DATA_DIR, "7save")
 VECTOR_FOLDER = os.path.join(DATA_DIR, "3vertor")
 
+CACHE_FOLDER = os.path.join(DATA_DIR, "8cache")
+
 FEATURES_FILE = os.path.join(VECTOR_FOLDER, "video_features.faiss")
-METADATA_FILE = os.path.join(VECTOR_FOLDER, "video_metadata.pkl")
+VECTORS_FILE = os.path.join(VECTOR_FOLDER, "video_vectors.npy")          # Vector gốc của base (để rebuild/train lại)
+METADATA_FILE = os.path.join(VECTOR_FOLDER, "video_metadata.pkl")       # Định dạng cũ, chỉ dùng để migrate
+METADATA_DB = os.path.join(VECTOR_FOLDER, "video_metadata.sqlite")       # Metadata theo FAISS row id
+MANIFEST_FILE = os.path.join(VECTOR_FOLDER, "manifest.json")      # Định dạng cũ (delta ghi tại chỗ), chỉ dùng để migrate
+SEGMENTS_FOLDER = os.path.join(VECTOR_FOLDER, "segments")         # Định dạng cũ, chỉ dùng để migrate
+GENERATIONS_FOLDER = os.path.join(VECTOR_FOLDER, "generations")   # Mỗi lần ghi = 1 thư mục generation bất biến
+CURRENT_FILE = os.path.join(VECTOR_FOLDER, "CURRENT")             # Tên generation đang dùng
+METADATA_FOLDER = os.path.join(VECTOR_FOLDER, "metadata")        # Metadata DB của từng lần create
+GENERATION_KEEP = 3   # Số generation gần nhất được giữ lại (reader đang chạy vẫn dùng được generation cũ)
 
 # ======================================================
 # 🎞️ 4. Tham số trích xuất
@@ -53,8 +63,10 @@ METADATA_FILE = os.path.join(VECTOR_FOLDER, "video_metadata.pkl")
 START_TIME = 5        # Bắt đầu từ giây thứ 5
 END_TIME = 120         # Kết thúc ở giây thứ 35
 SAMPLE_RATE = 0.5     # Lấy mẫu mỗi 0.5 giây
-VERIFY_RATE = 0.1     # Lấy mẫu mỗi 0.1 giây
+VERIFY_RATE = 0.5     # Lấy mẫu mỗi 0.5 giây (verify căn chỉnh với chuỗi frame lưu ở SAMPLE_RATE, giảm thêm được)
+VERIFY_MEAN_RATE = 0.1  # Store chưa có chuỗi frame: verify chỉ so vector trung bình, giữ tốc độ lấy mẫu cũ để điểm không đổi
 MAX_FRAMES = int((END_TIME - START_TIME) / SAMPLE_RATE)  # 60 khung hình
+SAMPLER_MAX_SKIP_SECONDS = 10.0  # Khoảng trống > giá trị này thì seek, ngược lại decode tiến (grab)
 
 # ======================================================
 # 🧠 5. Model & Tìm kiếm
@@ -62,11 +74,59 @@ MAX_FRAMES = int((END_TIME - START_TIME) / SAMPLE_RATE)  # 60 khung hình
 CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
 IMAGE_WEIGHT = 1.0   # 100% hình ảnh (không dùng âm thanh)
 TOP_K = 5            # Số video tương đồng nhất trả về
+# Loại FAISS index: "flat" (chính xác, brute-force), "ivf_flat", "hnsw", "ivf_pq"
+# Đánh giá recall@TOP_K / QPS trên corpus thật: python index_factory.py
+INDEX_TYPE = "flat"
+INDEX_TRAIN_THRESHOLD = 20000   # Dưới ngưỡng này luôn dùng flat; vượt ngưỡng thì train khi create/compact
+INDEX_TRAIN_SAMPLE = 100000     # Số vector tối đa dùng để train
+IVF_NLIST = 0                   # 0 = tự tính ~4*sqrt(N)
+IVF_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128
+PQ_M = 64                       # Số sub-quantizer của IVF-PQ (phải chia hết dimension)
+EMBED_BATCH_SIZE = 32  # Số frame mỗi micro-batch CLIP (bộ nhớ đỉnh tỉ lệ với giá trị này)
+
+# Cache embedding từng frame (dùng lại giữa /search và /verify trên cùng file)
+FRAME_CACHE_ENABLED = True
+FRAME_CACHE_DIR = os.path.join(CACHE_FOLDER, "frames")
+FRAME_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2GB, xóa theo LRU khi vượt
+
+QUERY_CACHE_SIZE = 256  # Số query (vector + top-k) giữ trong LRU của /search
+# Search coarse-to-fine: embed lưới thưa trước (mỗi PROGRESSIVE_STRIDES[i] điểm lấy 1), dày dần
+# chỉ khi similarity hạng 1 - hạng 2 (cosine) còn nhỏ hơn PROGRESSIVE_MARGIN
+# Tắt mặc định: vector dừng sớm cho similarity khác search đủ frame; bật theo request bằng "progressive": true
+SEARCH_PROGRESSIVE = False
+PROGRESSIVE_STRIDES = (8, 4, 2, 1)
+PROGRESSIVE_MARGIN = 0.03
+# Verify: căn chỉnh chuỗi frame query với chuỗi frame đã lưu của VERIFY_CANDIDATES ứng viên đầu
+VERIFY_CANDIDATES = 5
+VERIFY_MAX_LAG_SEC = 30.0     # Độ lệch thời gian tối đa giữa query và video gốc
+VERIFY_MIN_OVERLAP = 0.5      # Tỉ lệ frame query tối thiểu phải ghép được ở 1 độ lệch
+SEARCH_BATCH_WORKERS = 4      # /search/batch: số video decode song song (frame gộp chung batch CLIP)
+SEARCH_BATCH_MAX_PATHS = 256  # /search/batch: số path tối đa mỗi request
+
+# Live search trên video livestream đang được ghi (file lớn dần hoặc stdin)
+LIVE_REQUERY_SEC = 2.0        # Query lại FAISS sau mỗi N giây stream mới
+LIVE_MAX_HEIGHT = 360         # ffmpeg thu nhỏ frame trước khi đưa vào CLIP (CLIP chỉ dùng 224px)
+LIVE_IDLE_TIMEOUT_SEC = 15.0  # File không lớn thêm trong N giây → coi như stream đã kết thúc
+
+# Hàng đợi job của API (/jobs): số worker chung + số job chạy đồng thời tối đa cho từng loại
+JOB_WORKERS = 4
+JOB_KIND_LIMITS = {'search': 2, 'search_batch': 1, 'verify': 2, 'extract': 1, 'live_search': 2}
+JOB_MAX_QUEUE = 1000          # Vượt quá → submit trả 429
+JOB_RESULT_TTL_SEC = 3600     # Giữ kết quả job đã xong trong N giây
+JOB_SYNC_TIMEOUT_SEC = 120    # Endpoint đồng bộ chờ tối đa N giây, quá thì trả 202 + job_id
+
+# Gộp delta vào base khi có >= COMPACT_MAX_DELTAS delta hoặc delta cũ nhất quá COMPACT_MAX_AGE_SEC
+COMPACT_MAX_DELTAS = 20
+COMPACT_MAX_AGE_SEC = 6 * 3600
+INDEX_WATCH_INTERVAL_SEC = 2.0  # API kiểm tra store đổi mỗi N giây, load + swap index ở thread nền
 
 # ======================================================
 # ⚡ 6. Song song hóa
 # ======================================================
-N_JOBS = 2  # (-1 = tất cả cores, 1 = tuần tự)
+N_JOBS = 2  # Số worker process của pool trích xuất, mỗi worker load model 1 lần (-1 = tất cả cores, 1 = tuần tự)
 
 # ======================================================
 # 🗂️ 7. Khởi tạo thư mục nếu chưa tồn tại
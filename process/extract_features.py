@@ -5,17 +5,18 @@ import os
 # Avoid multiple OpenMP runtime initialization on macOS
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
 os.environ.setdefault("OMP_NUM_THREADS", "1")
-import cv2
-import torch
 import numpy as np
-import faiss
-import pickle
 import glob
+import time
+import atexit
+import threading
+import multiprocessing
 from tqdm import tqdm
-from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-from joblib import Parallel, delayed
 import config
+import model_registry
+from frame_sampler import FrameSampler, make_time_points
+from clip_embedder import embed_mean, embed_sequence, RunningMean
+import vector_store
 import platform
 
 
@@ -35,200 +36,231 @@ def normalize_video_path_for_metadata(video_path: str) -> str:
 
 
 def _create_model():
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = CLIPModel.from_pretrained(config.CLIP_MODEL_NAME).to(device)
-    processor = CLIPProcessor.from_pretrained(config.CLIP_MODEL_NAME, use_fast=True)
-    model.eval()
-    return model, processor, device
+    # Mỗi process chỉ load model 1 lần (registry dùng chung)
+    return model_registry.get_clip()
+
+
+def _embed_video(sampler, video_path, time_points, clip=None):
+    """(vector trung bình, (times, embedding float16 từng frame)) hoặc (None, None)."""
+    times, embs = embed_sequence(sampler.iter_images(video_path, time_points), clip=clip)
+    if embs is None:
+        return None, None
+    acc = RunningMean()
+    acc.add(embs)
+    return acc.vector(), (times.astype('float32'), embs.astype('float16'))
 
 
 def _extract_from_video_single(video_path):
     try:
-        model, processor, device = _create_model()
+        clip = _create_model()
         video_name = os.path.basename(video_path)
         
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            return None
-        
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frames = []
-        time_points = np.arange(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
-        
-        for time_point in time_points:
-            frame_number = int(time_point * fps)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-            ret, frame = cap.read()
-            if ret:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb)
-                frames.append(pil_image)
-        cap.release()
+        time_points = make_time_points(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
+        # Stream frame → micro-batch CLIP (không giữ toàn bộ frame); giữ embedding từng frame cho verify
+        feature_vector, sequence = _embed_video(FrameSampler(), video_path, time_points, clip)
         
-        if not frames:
+        if feature_vector is None:
             return None
         
-        inputs = processor(images=frames, return_tensors="pt", padding=True)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        
-        with torch.no_grad():
-            image_features = model.get_image_features(**inputs)
-            image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-            feature_vector = image_features.mean(dim=0).cpu().numpy()
-            norm = np.linalg.norm(feature_vector)
-            if norm > 0:
-                feature_vector = feature_vector / norm
-        
         metadata = {'video_name': video_name, 'video_path': normalize_video_path_for_metadata(video_path)}
-        return (feature_vector, metadata)
+        return (feature_vector, metadata, sequence)
     
     except Exception as e:
         print(f"Lỗi xử lý {video_path}: {e}")
         return None
 
 
+# ======================================================
+# ⚡ Worker pool: mỗi process load model 1 lần rồi lấy video từ queue
+# ======================================================
+def _resolve_pool_size(n_jobs):
+    cpu = os.cpu_count() or 1
+    size = cpu if n_jobs is None or n_jobs < 0 else n_jobs
+    return max(1, min(size, cpu))
+
+
+def _init_pool_worker():
+    # Load model ngay khi worker khởi động, dùng lại cho mọi video của worker
+    _create_model()
+
+
+def _pool_extract_indexed(item):
+    i, video_path = item
+    t0 = time.time()
+    result = _extract_from_video_single(video_path)
+    return i, (os.getpid(), time.time() - t0, result)
+
+
 class VideoFeatureExtractor:
     def __init__(self):
-        print("Đang load CLIP model...")
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(config.CLIP_MODEL_NAME).to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(config.CLIP_MODEL_NAME, use_fast=True)
-        self.model.eval()
-        print(f"Model đã load trên {self.device}")
+        self.model, self.processor, self.device = model_registry.get_clip()
+        self.last_pool_stats = None  # throughput từng worker của lần chạy pool gần nhất
+        self.sampler = FrameSampler()
+        # Pool worker sống suốt vòng đời extractor (tạo lazy, model chỉ load 1 lần mỗi worker)
+        self._pool = None
+        self._pool_size = 0
+        self._pool_lock = threading.Lock()
+        atexit.register(self.close)
 
-    def extract_frames(self, video_path, start_time=5, end_time=35, sample_rate=0.5):
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            return []
+    def _get_pool(self, pool_size):
+        """Pool dùng chung giữa các lần process_video_folder; chỉ tạo lại khi đổi kích thước."""
+        if self._pool is not None and self._pool_size == pool_size:
+            return self._pool
+        self.close()
+        print(f"Khởi tạo pool {pool_size} worker (mỗi worker load model 1 lần)...")
+        # spawn: không kế thừa model/thread của process cha (an toàn với torch)
+        ctx = multiprocessing.get_context("spawn")
+        self._pool = ctx.Pool(processes=pool_size, initializer=_init_pool_worker)
+        self._pool_size = pool_size
+        return self._pool
 
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frames = []
-        time_points = np.arange(start_time, end_time, sample_rate)
-        
-        for time_point in time_points:
-            frame_number = int(time_point * fps)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-            ret, frame = cap.read()
-            
-            if ret:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb)
-                frames.append(pil_image)
-        
-        cap.release()
-        return frames
+    def close(self):
+        """Đóng pool worker (gọi khi không cần trích xuất nữa; tự gọi lúc thoát process)."""
+        pool, self._pool, self._pool_size = self._pool, None, 0
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def extract_frames(self, video_path, start_time=5, end_time=35, sample_rate=0.5):
+        time_points = make_time_points(start_time, end_time, sample_rate)
+        return self.sampler.sample(video_path, time_points)
 
     def extract_features_from_frames(self, frames):
         if not frames:
             return None
-        
-        inputs = self.processor(images=frames, return_tensors="pt", padding=True)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        with torch.no_grad():
-            image_features = self.model.get_image_features(**inputs)
-            image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-            feature_vector = image_features.mean(dim=0).cpu().numpy()
-            norm = np.linalg.norm(feature_vector)
-            if norm > 0:
-                feature_vector = feature_vector / norm
-        
-        return feature_vector
+        return embed_mean(((None, f) for f in frames))
 
     def extract_from_video(self, video_path):
         video_name = os.path.basename(video_path)
-        frames = self.extract_frames(video_path, 
-                                     start_time=config.START_TIME,
-                                     end_time=config.END_TIME,
-                                     sample_rate=config.SAMPLE_RATE)
-        if not frames:
-            return None
-        
-        features = self.extract_features_from_frames(frames)
+        time_points = make_time_points(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
+        features, sequence = _embed_video(self.sampler, video_path, time_points)
         if features is not None:
             metadata = {
                 'video_name': video_name,
                 'video_path': normalize_video_path_for_metadata(video_path)
             }
-            return (features, metadata)
+            return (features, metadata, sequence)
         
         return None
 
-    def process_video_folder(self, folder_path, use_parallel=True, n_jobs=-1):
+    def _process_with_pool(self, video_files, n_jobs):
+        """
+        Xử lý song song bằng pool process cố định (kích thước theo n_jobs / config.N_JOBS),
+        pool được giữ lại cho các lần gọi sau (vd. vòng ingest của API).
+        Trả về list kết quả theo thứ tự video_files, đồng thời in throughput từng worker.
+        """
+        pool_size = _resolve_pool_size(n_jobs)
+        print(f"Đang xử lý song song với pool {pool_size} worker...")
+
+        results = {}
+        worker_stats = {}  # pid -> [số video, thời gian bận]
+        t_start = time.time()
+        with self._pool_lock:
+            pool = self._get_pool(pool_size)
+            tasks = pool.imap_unordered(_pool_extract_indexed, list(enumerate(video_files)), chunksize=1)
+            for i, (pid, elapsed, result) in tqdm(tasks, total=len(video_files), desc="Processing videos"):
+                results[i] = result
+                stats = worker_stats.setdefault(pid, [0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+        wall = time.time() - t_start
+
+        self.last_pool_stats = {
+            'pool_size': pool_size,
+            'videos': len(video_files),
+            'wall_seconds': wall,
+            'workers': {
+                pid: {'videos': n, 'busy_seconds': busy, 'videos_per_sec': (n / busy) if busy > 0 else 0.0}
+                for pid, (n, busy) in worker_stats.items()
+            },
+        }
+        for pid, st in self.last_pool_stats['workers'].items():
+            print(f"  [WORKER {pid}] {st['videos']} video, bận {st['busy_seconds']:.1f}s → {st['videos_per_sec']:.2f} video/s")
+        print(f"  [POOL] {len(video_files)} video trong {wall:.1f}s → {len(video_files) / max(wall, 1e-9):.2f} video/s")
+
+        return [results[i] for i in range(len(video_files))]
+
+    def process_video_folder(self, folder_path, use_parallel=True, n_jobs=None):
+        """
+        Trả về (features_list, metadata_list, sequences_list); sequences_list[i] = (times, embeddings)
+        từng frame của video i, được lưu cạnh index để verify căn chỉnh theo thời gian.
+        """
+        if n_jobs is None:
+            n_jobs = config.N_JOBS
         video_files = []
         for ext in ['*.mov', '*.mp4', '*.avi', '*.mkv']:
             video_files.extend(glob.glob(os.path.join(folder_path, ext)))
         
         print(f"Tìm thấy {len(video_files)} video")
         
-        if use_parallel and n_jobs != 1:
-            print(f"Đang xử lý song song với {n_jobs} luồng...")
-            results = Parallel(n_jobs=n_jobs)(
-                delayed(_extract_from_video_single)(video_path) 
-                for video_path in video_files
-            )
-            
+        if use_parallel and n_jobs != 1 and len(video_files) > 1:
+            results = self._process_with_pool(video_files, n_jobs)
+
             features_list = []
             metadata_list = []
+            sequences_list = []
             for result in results:
                 if result is not None:
-                    features, metadata = result
+                    features, metadata, sequence = result
                     features_list.append(features)
                     metadata_list.append(metadata)
+                    sequences_list.append(sequence)
         else:
             print("Đang xử lý tuần tự...")
             features_list = []
             metadata_list = []
+            sequences_list = []
             
             for video_path in tqdm(video_files, desc="Processing videos"):
                 result = self.extract_from_video(video_path)
                 if result is not None:
-                    features, metadata = result
+                    features, metadata, sequence = result
                     features_list.append(features)
                     metadata_list.append(metadata)
+                    sequences_list.append(sequence)
         
-        return features_list, metadata_list
+        return features_list, metadata_list, sequences_list
 
 
-def save_features(features_list, metadata_list, mode="create"):
+def save_features(features_list, metadata_list, mode="create", sequences_list=None):
     # Không có features để lưu
     if not features_list:
         print("Không có features để lưu!")
         return
-
-    # Chuẩn hóa folder output nếu cần
-    vector_dir = os.path.dirname(config.FEATURES_FILE)
-    if vector_dir and not os.path.exists(vector_dir):
-        os.makedirs(vector_dir, exist_ok=True)
+    if sequences_list is None:
+        sequences_list = [None] * len(features_list)
 
     # Chống trùng lặp theo video_path
-    def _dedup(features, metadata):
+    def _dedup(features, metadata, sequences):
         seen = set()
-        f_out, m_out = [], []
-        for f, m in zip(features, metadata):
+        f_out, m_out, s_out = [], [], []
+        for f, m, seq in zip(features, metadata, sequences):
             vp = (m or {}).get('video_path')
             if vp and vp not in seen:
                 seen.add(vp)
                 f_out.append(f)
                 m_out.append(m)
-        return f_out, m_out
+                s_out.append(seq)
+        return f_out, m_out, s_out
 
-    # Nếu update và đã có metadata, lọc bỏ các video đã tồn tại
+    features_list, metadata_list, sequences_list = _dedup(features_list, metadata_list, sequences_list)
+
+    # Nếu update và đã có store, lọc bỏ các video đã tồn tại (base + delta)
     effective_mode = mode
-    if mode == "update" and os.path.exists(config.METADATA_FILE):
+    if mode == "update" and vector_store.has_base():
         try:
-            with open(config.METADATA_FILE, 'rb') as f:
-                existing_metadata = pickle.load(f)
-            existing_paths = set((m or {}).get('video_path') for m in existing_metadata if m)
-            filtered_features, filtered_metadata = [], []
-            for f, m in zip(features_list, metadata_list):
+            existing_paths = vector_store.existing_paths(
+                [(m or {}).get('video_path') for m in metadata_list])
+            filtered_features, filtered_metadata, filtered_sequences = [], [], []
+            for f, m, seq in zip(features_list, metadata_list, sequences_list):
                 vp = (m or {}).get('video_path')
                 if vp not in existing_paths:
                     filtered_features.append(f)
                     filtered_metadata.append(m)
+                    filtered_sequences.append(seq)
             if len(filtered_features) != len(features_list):
                 print(f"Bỏ qua {len(features_list) - len(filtered_features)} video trùng lặp khi update")
-            features_list, metadata_list = filtered_features, filtered_metadata
+            features_list, metadata_list, sequences_list = filtered_features, filtered_metadata, filtered_sequences
         except Exception as e:
             print(f"Không thể đọc metadata hiện có, tiếp tục không lọc trùng: {e}")
 
@@ -244,50 +276,36 @@ def save_features(features_list, metadata_list, mode="create"):
     features_array = features_array / norms
     dimension = features_array.shape[1]
 
-    # Tạo mới hoặc cập nhật index hiện có, có kiểm tra dimension
-    index = None
-    if effective_mode == "create" or not os.path.exists(config.FEATURES_FILE):
-        index = faiss.IndexFlatIP(dimension)
-        print("Tạo mới FAISS index...")
-    else:
-        print("Cập nhật FAISS index hiện có...")
-        index = faiss.read_index(config.FEATURES_FILE)
-        if hasattr(index, 'd') and index.d != dimension:
-            print(f"Cảnh báo: dimension index ({index.d}) != dimension vector mới ({dimension}). Chuyển sang create.")
-            index = faiss.IndexFlatIP(dimension)
+    # Update: chỉ ghi 1 delta nhỏ; create (hoặc chưa có base / lệch dimension): ghi base mới
+    if effective_mode == "update" and vector_store.has_base():
+        current_dim = vector_store.index_dimension()
+        if current_dim != dimension:
+            print(f"Cảnh báo: dimension index ({current_dim}) != dimension vector mới ({dimension}). Chuyển sang create.")
             effective_mode = "create"
-
-    index.add(features_array)
-    faiss.write_index(index, config.FEATURES_FILE)
-    print(f"Đã lưu index vào {config.FEATURES_FILE}")
-
-    # Ghi metadata: tạo mới hoặc nối thêm, đồng thời dedup nếu create
-    if effective_mode == "create" or not os.path.exists(config.METADATA_FILE):
-        # Dedup trong batch create
-        metadata_list = _dedup(features_list, metadata_list)[1]
-        all_metadata = metadata_list
     else:
-        with open(config.METADATA_FILE, 'rb') as f:
-            existing_metadata = pickle.load(f)
-        all_metadata = existing_metadata + metadata_list
+        effective_mode = "create"
 
-    with open(config.METADATA_FILE, 'wb') as f:
-        pickle.dump(all_metadata, f)
-    print(f"Đã lưu metadata vào {config.METADATA_FILE}")
+    if effective_mode == "create":
+        print("Tạo mới FAISS index...")
+        total = vector_store.write_base(features_array, metadata_list, sequences=sequences_list)
+    else:
+        print("Thêm delta vào FAISS index hiện có...")
+        total = vector_store.append_segment(features_array, metadata_list, sequences=sequences_list)
 
-    print(f"Tổng số video trong index: {len(all_metadata)}")
+    print(f"Tổng số video trong index: {total}")
     print(f"Vector dimension: {dimension}")
 
 
 def main(mode="create", video_folder=None):
     extractor = VideoFeatureExtractor()
     folder = video_folder or config.VIDEO_FOLDER
-    features_list, metadata_list = extractor.process_video_folder(
+    features_list, metadata_list, sequences_list = extractor.process_video_folder(
         folder,
         use_parallel=True,
         n_jobs=config.N_JOBS
     )
-    save_features(features_list, metadata_list, mode=mode)
+    extractor.close()
+    save_features(features_list, metadata_list, mode=mode, sequences_list=sequences_list)
     print("\nHoàn thành trích xuất features!")
 
 
@@ -311,7 +329,14 @@ if __name__ == "__main__":
             pass
         config.VECTOR_FOLDER = out_dir
         config.FEATURES_FILE = os.path.join(config.VECTOR_FOLDER, "video_features.faiss")
+        config.VECTORS_FILE = os.path.join(config.VECTOR_FOLDER, "video_vectors.npy")
         config.METADATA_FILE = os.path.join(config.VECTOR_FOLDER, "video_metadata.pkl")
+        config.METADATA_DB = os.path.join(config.VECTOR_FOLDER, "video_metadata.sqlite")
+        config.MANIFEST_FILE = os.path.join(config.VECTOR_FOLDER, "manifest.json")
+        config.SEGMENTS_FOLDER = os.path.join(config.VECTOR_FOLDER, "segments")
+        config.GENERATIONS_FOLDER = os.path.join(config.VECTOR_FOLDER, "generations")
+        config.CURRENT_FILE = os.path.join(config.VECTOR_FOLDER, "CURRENT")
+        config.METADATA_FOLDER = os.path.join(config.VECTOR_FOLDER, "metadata")
 
     # Chạy chính
     main(mode=args.mode, video_folder=args.video_folder)
@@ -0,0 +1,44 @@
+"""
+Fingerprint nội dung file video (không phụ thuộc config/numpy): dùng chung cho frame_cache
+(cache embedding CLIP) và segment_videos.py (cache timeline aHash).
+"""
+import os
+import hashlib
+import threading
+
+_FP_SAMPLE_BYTES = 1 << 20  # đọc 1MB đầu / giữa / cuối file
+
+
+def _fingerprint_uncached(path, size):
+    h = hashlib.sha1()
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        offsets = [0]
+        if size > 3 * _FP_SAMPLE_BYTES:
+            offsets += [size // 2, size - _FP_SAMPLE_BYTES]
+        for off in offsets:
+            f.seek(off)
+            h.update(f.read(_FP_SAMPLE_BYTES))
+    return h.hexdigest()
+
+
+_fp_lock = threading.Lock()
+_fp_memo = {}  # (path, size, mtime) -> fingerprint
+
+
+def file_fingerprint(path):
+    """
+    Fingerprint nội dung file (sha1 của size + 1MB đầu/giữa/cuối).
+    Được memo theo (path, size, mtime) nên gọi lại gần như miễn phí.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    with _fp_lock:
+        fp = _fp_memo.get(key)
+    if fp is None:
+        fp = _fingerprint_uncached(path, st.st_size)
+        with _fp_lock:
+            if len(_fp_memo) > 4096:
+                _fp_memo.clear()
+            _fp_memo[key] = fp
+    return fp
@@ -0,0 +1,157 @@
+"""
+Cache trên đĩa cho embedding CLIP từng frame, key = fingerprint nội dung file + thời điểm.
+Mỗi file video → 1 file .npy (structured: t_ms int64, emb float16[d]) đọc bằng mmap,
+xóa theo LRU khi tổng dung lượng vượt giới hạn.
+"""
+import os
+import threading
+import numpy as np
+import config
+
+def time_keys(time_points):
+    """Thời điểm (giây) → key mili-giây, để lưới 0.5s và 0.1s dùng chung key."""
+    return np.rint(np.asarray(time_points, dtype='float64') * 1000.0).astype('int64')
+
+
+class FrameEmbeddingCache:
+    def __init__(self, cache_dir=None, max_bytes=None):
+        model_slug = config.CLIP_MODEL_NAME.replace('/', '__')
+        self.cache_dir = os.path.join(cache_dir or config.FRAME_CACHE_DIR, model_slug)
+        self.max_bytes = config.FRAME_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, fingerprint):
+        return os.path.join(self.cache_dir, f"{fingerprint}.npy")
+
+    def _load(self, fingerprint, mmap=True):
+        path = self._path(fingerprint)
+        if not os.path.exists(path):
+            return None
+        try:
+            arr = np.load(path, mmap_mode='r' if mmap else None)
+            os.utime(path, None)  # đánh dấu vừa dùng (LRU theo mtime)
+            return arr
+        except Exception:
+            return None
+
+    def lookup(self, fingerprint, time_points):
+        """
+        Trả về (found_mask, embeddings float32 của các thời điểm tìm thấy, theo thứ tự time_points).
+        """
+        keys = time_keys(time_points)
+        found = np.zeros(len(keys), dtype=bool)
+        arr = self._load(fingerprint)
+        if arr is None or len(arr) == 0:
+            self.misses += len(keys)
+            return found, None
+        stored = arr['t']
+        pos = np.searchsorted(stored, keys)
+        pos_clipped = np.minimum(pos, len(stored) - 1)
+        found = stored[pos_clipped] == keys
+        embs = np.asarray(arr['e'][pos_clipped[found]], dtype='float32')
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return found, embs
+
+    def store(self, fingerprint, time_points, embeddings):
+        """
+        Gộp embedding mới vào entry của file (ghi tạm rồi os.replace → reader không thấy file dở).
+        Lỗi ghi cache (đĩa đầy, file đang bị map trên Windows...) chỉ được log, không làm hỏng request.
+        """
+        if embeddings is None or len(embeddings) == 0:
+            return
+        keys = time_keys(time_points)
+        embeddings = np.asarray(embeddings, dtype='float16')
+        dtype = np.dtype([('t', '<i8'), ('e', '<f2', (embeddings.shape[1],))])
+        new = np.empty(len(keys), dtype=dtype)
+        new['t'] = keys
+        new['e'] = embeddings
+
+        path = self._path(fingerprint)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                # Đọc hẳn vào RAM (không mmap): Windows không cho os.replace đè file đang được map
+                old = self._load(fingerprint, mmap=False)
+                if old is not None and old.dtype == dtype and len(old):
+                    merged = np.concatenate([old, new])
+                else:
+                    merged = new
+                old = None
+                # Giữ 1 dòng cho mỗi key (ưu tiên dòng cũ), sắp xếp theo t
+                _, first = np.unique(merged['t'], return_index=True)
+                merged = merged[first]
+                with open(tmp, 'wb') as f:
+                    np.save(f, merged)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"[FRAME CACHE] Không ghi được {path}: {e}")
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                return
+            try:
+                self._evict()
+            except OSError as e:
+                print(f"[FRAME CACHE] Lỗi dọn cache: {e}")
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            p = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        for _mtime, size, p in sorted(entries):
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                continue
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        total = 0
+        files = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                files += 1
+                try:
+                    total += os.path.getsize(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        return {'hits': self.hits, 'misses': self.misses, 'files': files,
+                'bytes': total, 'max_bytes': self.max_bytes}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_frame_cache():
+    """Cache dùng chung trong process, None nếu bị tắt trong config."""
+    global _cache
+    if not config.FRAME_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = FrameEmbeddingCache()
+                except OSError as e:
+                    print(f"[FRAME CACHE] Không tạo được cache dir: {e}")
+                    return None
+    return _cache
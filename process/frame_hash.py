@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Vectorized 64-bit average hash (aHash) engine for segment_videos.py.
+
+Hashes are packed as uint64 NumPy arrays (bit 63 = top-left pixel of the 8x8
+thumbnail, same MSB-first order as the old per-frame Python loop), so a whole
+timeline can be hashed, compared and reduced without per-bit Python loops.
+Run this module with --benchmark to check bit-identity and speedup against the
+scalar reference implementation.
+"""
+import argparse
+import time
+from typing import Iterable, List, Sequence
+
+import cv2
+import numpy as np
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# Popcount per byte value (fallback for NumPy < 2.0 without np.bitwise_count)
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def thumbnail(frame: np.ndarray) -> np.ndarray:
+    """BGR (or already-gray) frame -> 8x8 uint8 gray thumbnail (INTER_AREA)."""
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if gray.shape == (HASH_SIZE, HASH_SIZE):
+        return gray
+    return cv2.resize(gray, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def hash_thumbnails(thumbs: np.ndarray) -> np.ndarray:
+    """[N, 8, 8] gray thumbnails -> [N] uint64 average hashes."""
+    thumbs = np.asarray(thumbs)
+    if thumbs.size == 0:
+        return np.empty(0, dtype=np.uint64)
+    flat = thumbs.reshape(len(thumbs), HASH_BITS)
+    means = flat.mean(axis=1, dtype=np.float64)
+    bits = flat > means[:, None]
+    # packbits is MSB-first per byte; 8 big-endian bytes == the old shift-left loop
+    packed = np.packbits(bits, axis=1)
+    return np.ascontiguousarray(packed).view('>u8').ravel().astype(np.uint64)
+
+
+def hash_frames(frames: Iterable[np.ndarray]) -> np.ndarray:
+    """Hash a batch of BGR/gray frames -> [N] uint64."""
+    thumbs = [thumbnail(f) for f in frames]
+    if not thumbs:
+        return np.empty(0, dtype=np.uint64)
+    return hash_thumbnails(np.stack(thumbs))
+
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+    """Number of set bits of each uint64 (same shape as input, uint8)."""
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    as_bytes = np.ascontiguousarray(values).view(np.uint8).reshape(values.shape + (8,))
+    return _POPCOUNT8[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+
+def hamming(hashes: np.ndarray, refs) -> np.ndarray:
+    """
+    Hamming distances between hashes [N] and refs.
+    refs scalar -> [N]; refs [M] -> [M, N] (one row per reference).
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    refs = np.asarray(refs, dtype=np.uint64)
+    if refs.ndim == 0:
+        return popcount64(hashes ^ refs)
+    return popcount64(refs[:, None] ^ hashes[None, :])
+
+
+def median_hash(hashes) -> int:
+    """Bitwise majority of a set of hashes (bit set iff set in more than half of them); 0 if empty."""
+    hashes = np.asarray(hashes, dtype=np.uint64).ravel()
+    if hashes.size == 0:
+        return 0
+    bits = np.unpackbits(hashes.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1)
+    ones = bits.sum(axis=0, dtype=np.int64)
+    majority = ones > (len(hashes) / 2.0)
+    return int(np.packbits(majority).view('>u8')[0])
+
+
+# ================= Browser-compatible template hash =================
+# The web frontend hashes live frames with aHashFromCanvas (App.jsx): the RGB frame is drawn onto an
+# 8x8 canvas, luma = 0.299 R + 0.587 G + 0.114 B (float), bit = luma > mean, MSB-first. Templates are
+# sampled at 20/40/60/80% of their duration and combined with a ones >= ceil(n/2) majority.
+CANVAS_SAMPLE_FRACTIONS = (0.2, 0.4, 0.6, 0.8)
+
+
+def canvas_hash(frame: np.ndarray) -> int:
+    """BGR frame -> 64-bit aHash computed like the frontend's aHashFromCanvas."""
+    small = cv2.resize(frame, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.float64)
+    luma = 0.299 * small[..., 2] + 0.587 * small[..., 1] + 0.114 * small[..., 0]
+    bits = luma.ravel() > luma.mean()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def canvas_majority_hash(hashes) -> int:
+    """Bitwise majority as in the frontend's computeTemplateHash (ties set the bit); 0 if empty."""
+    hashes = np.asarray(hashes, dtype=np.uint64).ravel()
+    if hashes.size == 0:
+        return 0
+    bits = np.unpackbits(hashes.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1)
+    ones = bits.sum(axis=0, dtype=np.int64)
+    return int(np.packbits(ones >= -(-len(hashes) // 2)).view('>u8')[0])
+
+
+# ================= Scalar reference (pre-vectorization behaviour) =================
+def _scalar_average_hash(frame: np.ndarray) -> int:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+    return _scalar_pack(small)
+
+
+def _scalar_pack(small: np.ndarray) -> int:
+    mean_val = float(np.mean(small))
+    bits = (small > mean_val).astype(np.uint8).flatten()
+    val = 0
+    for b in bits:
+        val = (val << 1) | int(b)
+    return int(val)
+
+
+def _scalar_hamming(a: int, b: int) -> int:
+    return int(bin(a ^ b).count('1'))
+
+
+def _scalar_median_hash(hashes: List[int]) -> int:
+    if not hashes:
+        return 0
+    ones = [0] * 64
+    for h in hashes:
+        for i in range(64):
+            if (h >> i) & 1:
+                ones[i] += 1
+    half = len(hashes) / 2.0
+    out = 0
+    for i in range(63, -1, -1):
+        out <<= 1
+        out |= 1 if ones[i] > half else 0
+    return out
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def benchmark(n_frames: int = 2000, n_refs: int = 5, height: int = 360, width: int = 640, seed: int = 0) -> dict:
+    """
+    Compare scalar vs vectorized hashing, Hamming and median on synthetic frames.
+    Raises AssertionError if any result differs bit-for-bit.
+    """
+    rng = np.random.default_rng(seed)
+    # Smooth-ish random frames: low-res noise upscaled, so thumbnails are not all ~mean
+    base = rng.integers(0, 256, size=(n_frames, 9, 16, 3), dtype=np.uint8)
+    frames: Sequence[np.ndarray] = [cv2.resize(b, (width, height), interpolation=cv2.INTER_LINEAR) for b in base]
+
+    ref_hashes, t_hash_ref = _timed(lambda fs: [_scalar_average_hash(f) for f in fs], frames)
+    vec_hashes, t_hash_vec = _timed(hash_frames, frames)
+    assert [int(h) for h in vec_hashes] == ref_hashes, 'hash mismatch'
+
+    thumbs = np.stack([thumbnail(f) for f in frames])
+    _, t_pack_ref = _timed(lambda ts: [_scalar_pack(t) for t in ts], thumbs)
+    _, t_pack_vec = _timed(hash_thumbnails, thumbs)
+
+    refs = [int(h) for h in rng.integers(0, 2 ** 64, size=n_refs, dtype=np.uint64)]
+    ref_dist, t_ham_ref = _timed(lambda: [[_scalar_hamming(h, r) for h in ref_hashes] for r in refs])
+    vec_dist, t_ham_vec = _timed(hamming, vec_hashes, np.array(refs, dtype=np.uint64))
+    assert vec_dist.tolist() == ref_dist, 'hamming mismatch'
+
+    ref_med, t_med_ref = _timed(_scalar_median_hash, ref_hashes)
+    vec_med, t_med_vec = _timed(median_hash, vec_hashes)
+    assert vec_med == ref_med, 'median mismatch'
+
+    return {
+        'frames': n_frames,
+        'refs': n_refs,
+        'hash_frames': (t_hash_ref, t_hash_vec),
+        'pack_thumbnails': (t_pack_ref, t_pack_vec),
+        'hamming': (t_ham_ref, t_ham_vec),
+        'median': (t_med_ref, t_med_vec),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorized average-hash engine (bit-identity check + benchmark).')
+    parser.add_argument('--benchmark', action='store_true', help='Run scalar vs vectorized benchmark')
+    parser.add_argument('--frames', type=int, default=2000, help='Number of synthetic frames')
+    parser.add_argument('--refs', type=int, default=5, help='Number of reference hashes (templates)')
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        return
+
+    res = benchmark(n_frames=args.frames, n_refs=args.refs)
+    print(f"Bit-identical on {res['frames']} frames x {res['refs']} refs")
+    print(f"{'step':<22} {'scalar(s)':>10} {'vector(s)':>10} {'speedup':>9}")
+    for key in ('hash_frames', 'pack_thumbnails', 'hamming', 'median'):
+        ref_t, vec_t = res[key]
+        print(f"{key:<22} {ref_t:>10.4f} {vec_t:>10.4f} {ref_t / max(vec_t, 1e-9):>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
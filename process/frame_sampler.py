@@ -0,0 +1,203 @@
+"""
+Lấy mẫu khung hình theo danh sách thời điểm bằng 1 lượt decode tuần tự
+(dùng chung cho extract_features, search_video, verify_video)
+"""
+import re
+import subprocess
+import threading
+import cv2
+import numpy as np
+from PIL import Image
+import config
+
+
+def make_time_points(start_time, end_time, sample_rate):
+    """Lưới thời điểm lấy mẫu, giống hệt np.arange dùng trước đây."""
+    return np.arange(start_time, end_time, sample_rate)
+
+
+class FrameSampler:
+    """
+    Thay vì cap.set(CAP_PROP_POS_FRAMES) trước mỗi mẫu (mỗi lần seek decoder phải
+    quay về keyframe trước đó rồi decode lại), sampler decode tiến 1 lần:
+    - grab() bỏ qua các frame không cần (không retrieve/convert màu)
+    - chỉ retrieve frame gần thời điểm yêu cầu nhất (frame_no = int(t * fps) như cũ)
+    - chỉ seek khi khoảng cách tới mẫu tiếp theo lớn hơn max_skip_seconds
+    """
+
+    def __init__(self, max_skip_seconds=None, default_fps=None):
+        self.max_skip_seconds = config.SAMPLER_MAX_SKIP_SECONDS if max_skip_seconds is None else max_skip_seconds
+        self.default_fps = default_fps
+
+    def iter_frames(self, video_path, time_points, on_progress=None):
+        """
+        Yield (t, frame_bgr) cho từng thời điểm đọc được (bỏ qua thời điểm lỗi, như code cũ).
+        on_progress(i, total) được gọi sau mỗi thời điểm.
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            return
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or self.default_fps or 0
+            max_skip = int(self.max_skip_seconds * fps) if fps else 0
+            total = len(time_points)
+            pos = None            # index frame mà grab() tiếp theo sẽ trả về (None = chưa biết)
+            last_no, last_frame = None, None
+
+            for i, t in enumerate(time_points):
+                frame_no = int(t * fps)
+                if frame_no == last_no:
+                    # Nhiều thời điểm rơi vào cùng 1 frame (fps thấp) → dùng lại
+                    if last_frame is not None:
+                        yield t, last_frame
+                    if on_progress:
+                        on_progress(i + 1, total)
+                    continue
+
+                if pos is None or frame_no < pos or frame_no - pos > max_skip:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+                    pos = frame_no
+
+                ok = True
+                while pos < frame_no:
+                    if not cap.grab():
+                        ok = False
+                        break
+                    pos += 1
+
+                frame = None
+                if ok:
+                    ret, frame = cap.read()
+                    if not ret:
+                        frame = None
+                if frame is None:
+                    # Lỗi decode/EOF → lần sau seek lại giống hành vi cũ
+                    pos = None
+                else:
+                    pos = frame_no + 1
+
+                last_no, last_frame = frame_no, frame
+                if frame is not None:
+                    yield t, frame
+                if on_progress:
+                    on_progress(i + 1, total)
+        finally:
+            cap.release()
+
+    def iter_images(self, video_path, time_points, on_progress=None):
+        """Yield (t, PIL.Image RGB)."""
+        for t, frame in self.iter_frames(video_path, time_points, on_progress=on_progress):
+            yield t, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def sample(self, video_path, time_points, on_progress=None):
+        """List PIL.Image RGB (tương thích các hàm extract_frames cũ)."""
+        return [img for _t, img in self.iter_images(video_path, time_points, on_progress=on_progress)]
+
+
+# Dòng stream output của ffmpeg, vd: "Stream #0:0: Video: rawvideo (RGB[24] / 0x18424752), rgb24, 640x360, ..."
+_RAW_SIZE_RE = re.compile(r"Video: rawvideo.*?, (\d{2,5})x(\d{2,5})[ ,]")
+
+
+def iter_live_frames(source, sample_rate=None, max_height=None, idle_timeout=None):
+    """
+    Đọc video đang được ghi (file lớn dần) hoặc stdin ('-') qua ffmpeg, yield (t, PIL.Image RGB)
+    trên lưới sample_rate giây tính từ đầu stream, ngay khi frame được decode.
+    File: ffmpeg đọc tiếp khi file lớn thêm (-follow 1), dừng sau idle_timeout giây không có dữ liệu mới.
+    """
+    sample_rate = sample_rate or config.SAMPLE_RATE
+    max_height = config.LIVE_MAX_HEIGHT if max_height is None else max_height
+    idle_timeout = config.LIVE_IDLE_TIMEOUT_SEC if idle_timeout is None else idle_timeout
+    if source == '-':
+        input_args, stdin = ['-i', 'pipe:0'], None
+    else:
+        input_args = ['-nostdin', '-follow', '1', '-rw_timeout', str(int(idle_timeout * 1e6)), '-i', source]
+        stdin = subprocess.DEVNULL
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'info', *input_args, '-an', '-sn',
+           '-vf', f"fps={1.0 / sample_rate:g},scale=-2:'min({int(max_height)},ih)'",
+           '-pix_fmt', 'rgb24', '-f', 'rawvideo', 'pipe:1']
+    proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # Kích thước frame chỉ biết sau khi ffmpeg mở được stream: đọc từ stderr ở thread riêng
+    size = {}
+    size_ready = threading.Event()
+
+    def _read_stderr():
+        in_output = False
+        for raw in iter(proc.stderr.readline, b''):
+            line = raw.decode('utf-8', 'replace')
+            in_output = in_output or line.startswith('Output #0')
+            m = _RAW_SIZE_RE.search(line) if in_output and not size_ready.is_set() else None
+            if m:
+                size['w'], size['h'] = int(m.group(1)), int(m.group(2))
+                size_ready.set()
+        size_ready.set()
+
+    threading.Thread(target=_read_stderr, name="live-ffmpeg-stderr", daemon=True).start()
+    try:
+        size_ready.wait()
+        if not size:
+            return
+        frame_bytes = size['w'] * size['h'] * 3
+        n = 0
+        while True:
+            buf = proc.stdout.read(frame_bytes)
+            if buf is None or len(buf) < frame_bytes:
+                break
+            frame = np.frombuffer(buf, dtype=np.uint8).reshape(size['h'], size['w'], 3)
+            yield n * sample_rate, Image.fromarray(frame)
+            n += 1
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def _sample_by_seek(video_path, time_points, default_fps=None):
+    """Cách lấy mẫu cũ (seek trước mỗi mẫu), chỉ dùng để đối chiếu."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return []
+    fps = cap.get(cv2.CAP_PROP_FPS) or default_fps or 0
+    out = []
+    for t in time_points:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(t * fps))
+        ret, frame = cap.read()
+        if ret:
+            out.append((t, frame))
+    cap.release()
+    return out
+
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="So sánh FrameSampler (decode tuần tự) với cách seek từng mẫu")
+    parser.add_argument('video_path')
+    parser.add_argument('--rate', type=float, default=config.SAMPLE_RATE)
+    parser.add_argument('--tolerance', type=float, default=2.0, help='Sai khác pixel trung bình tối đa (0-255)')
+    args = parser.parse_args()
+
+    points = make_time_points(config.START_TIME, config.END_TIME, args.rate)
+
+    t0 = time.time()
+    seq = list(FrameSampler().iter_frames(args.video_path, points))
+    t_seq = time.time() - t0
+    t0 = time.time()
+    old = _sample_by_seek(args.video_path, points)
+    t_old = time.time() - t0
+
+    old_by_t = {round(float(t), 3): f for t, f in old}
+    mismatches = 0
+    for t, frame in seq:
+        ref = old_by_t.get(round(float(t), 3))
+        if ref is None or ref.shape != frame.shape:
+            mismatches += 1
+            continue
+        if float(np.mean(cv2.absdiff(ref, frame))) > args.tolerance:
+            mismatches += 1
+    print(f"Sequential: {len(seq)} frame trong {t_seq:.2f}s | Seek: {len(old)} frame trong {t_old:.2f}s")
+    print(f"Khác biệt: {mismatches} frame (tolerance {args.tolerance})")
+
+
+if __name__ == "__main__":
+    main()
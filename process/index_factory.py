@@ -0,0 +1,156 @@
+"""
+Factory tạo FAISS index theo config.INDEX_TYPE (flat, ivf_flat, hnsw, ivf_pq),
+tự train khi corpus vượt config.INDEX_TRAIN_THRESHOLD, kèm lệnh đánh giá recall/QPS.
+"""
+import os
+# Avoid multiple OpenMP runtime initialization on macOS
+os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
+import math
+import time
+import numpy as np
+import faiss
+import config
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+
+def _nlist_for(n):
+    if config.IVF_NLIST:
+        nlist = config.IVF_NLIST
+    else:
+        nlist = int(4 * math.sqrt(n))
+    # FAISS cần ~39 điểm train cho mỗi centroid
+    return max(1, min(nlist, n // 39))
+
+
+def _pq_m_for(d):
+    m = max(1, min(config.PQ_M, d))
+    while d % m:
+        m -= 1
+    return m
+
+
+def create_index(index_type, d, n):
+    """Tạo index rỗng (chưa train) cho n vector dimension d."""
+    if index_type == "flat":
+        return faiss.IndexFlatIP(d)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, config.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.HNSW_EF_CONSTRUCTION
+        return index
+    quantizer = faiss.IndexFlatIP(d)
+    nlist = _nlist_for(n)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "ivf_pq":
+        return faiss.IndexIVFPQ(quantizer, d, nlist, _pq_m_for(d), 8, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"INDEX_TYPE không hợp lệ: {index_type} (hỗ trợ: {', '.join(INDEX_TYPES)})")
+
+
+def apply_search_params(index):
+    """Đặt tham số tìm kiếm (nprobe / efSearch) theo config, cả sau khi load từ file."""
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(config.IVF_NPROBE, index.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.HNSW_EF_SEARCH
+    return index
+
+
+def resolve_index_type(n, index_type=None):
+    """Loại index thực sự dùng: dưới ngưỡng train thì luôn là flat."""
+    index_type = index_type or config.INDEX_TYPE
+    if index_type != "flat" and n < config.INDEX_TRAIN_THRESHOLD:
+        return "flat"
+    return index_type
+
+
+def build_index(vectors, index_type=None, force=False):
+    """
+    Tạo + train (nếu cần) + add toàn bộ vectors.
+    force=True: bỏ qua ngưỡng INDEX_TRAIN_THRESHOLD (dùng khi đánh giá).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    n, d = vectors.shape
+    index_type = (index_type or config.INDEX_TYPE) if force else resolve_index_type(n, index_type)
+    index = create_index(index_type, d, n)
+    if not index.is_trained:
+        sample = vectors
+        if n > config.INDEX_TRAIN_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n, config.INDEX_TRAIN_SAMPLE, replace=False)]
+        t0 = time.time()
+        index.train(sample)
+        print(f"[INDEX] Train {index_type} trên {len(sample)} vector ({time.time() - t0:.1f}s)")
+    index.add(vectors)
+    return apply_search_params(index), index_type
+
+
+# ======================================================
+# 📊 Đánh giá recall@TOP_K / QPS so với flat chính xác
+# ======================================================
+def evaluate(vectors, index_types=INDEX_TYPES, n_queries=200, top_k=None, noise=0.05, seed=0):
+    """
+    Query = vector trong corpus + nhiễu nhỏ (giống video query gần với video gốc).
+    Trả về list dict: index_type, build_seconds, recall, qps.
+    """
+    top_k = top_k or config.TOP_K
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    n, d = vectors.shape
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(n, min(n_queries, n), replace=False)]
+    queries = queries + rng.normal(scale=noise, size=queries.shape).astype('float32')
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = faiss.IndexFlatIP(d)
+    exact.add(vectors)
+    _, truth = exact.search(queries, top_k)
+
+    rows = []
+    for index_type in index_types:
+        t0 = time.time()
+        index, _ = build_index(vectors, index_type=index_type, force=True)
+        build_seconds = time.time() - t0
+        # Đo từng query một (giống /search), không batch
+        t0 = time.time()
+        found = np.empty_like(truth)
+        for i in range(len(queries)):
+            _, I = index.search(queries[i:i + 1], top_k)
+            found[i] = I[0]
+        elapsed = time.time() - t0
+        recall = float(np.mean([len(set(found[i]) & set(truth[i])) / top_k for i in range(len(queries))]))
+        rows.append({
+            'index_type': index_type,
+            'build_seconds': build_seconds,
+            'recall': recall,
+            'qps': len(queries) / max(elapsed, 1e-9),
+        })
+    return rows
+
+
+def main():
+    import argparse
+    import vector_store
+    parser = argparse.ArgumentParser(description="Đánh giá các loại FAISS index trên corpus hiện có")
+    parser.add_argument('--types', type=str, default=",".join(INDEX_TYPES), help='Danh sách loại index, cách nhau bởi dấu phẩy')
+    parser.add_argument('--queries', type=int, default=200, help='Số query thử')
+    parser.add_argument('--top-k', type=int, default=config.TOP_K)
+    parser.add_argument('--synthetic', type=int, default=0, help='Dùng N vector ngẫu nhiên thay cho corpus thật')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(args.synthetic, 512)).astype('float32')
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    else:
+        vectors = vector_store.load_all_vectors()
+    print(f"Corpus: {len(vectors)} vector, dimension {vectors.shape[1]}")
+
+    rows = evaluate(vectors, index_types=[t.strip() for t in args.types.split(",") if t.strip()],
+                    n_queries=args.queries, top_k=args.top_k)
+    print(f"\n{'index':<10} {'build(s)':>9} {'recall@' + str(args.top_k):>10} {'QPS':>10}")
+    for r in rows:
+        print(f"{r['index_type']:<10} {r['build_seconds']:>9.2f} {r['recall']:>10.3f} {r['qps']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Hàng đợi job trong process cho API: submit → trả job_id ngay, worker pool giới hạn
+chạy job theo thứ tự FIFO với giới hạn số job chạy đồng thời cho từng loại (kind).
+Quá tải thì job xếp hàng (có giới hạn độ dài hàng đợi) thay vì giữ HTTP request tới timeout.
+"""
+import time
+import uuid
+import threading
+import traceback
+from collections import deque
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+
+class JobError(Exception):
+    """Lỗi do input của job (trả về cho client kèm HTTP status tương ứng)."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.progress = None       # kết quả tạm thời (job có báo tiến độ)
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self, position=None):
+        d = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+        }
+        if position is not None:
+            d['queue_position'] = position
+        if self.progress is not None:
+            d['progress'] = self.progress
+        return d
+
+
+class JobQueue:
+    def __init__(self, max_workers, kind_limits=None, max_queue=1000, result_ttl=3600):
+        self.max_workers = max(1, int(max_workers))
+        self.kind_limits = dict(kind_limits or {})
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self._handlers = {}
+        self._with_progress = set()
+        self._jobs = {}
+        self._pending = deque()
+        self._running = {}         # kind -> số job đang chạy
+        self._counters = {}        # kind -> {'done': n, 'error': n, 'wait_sec': s, 'run_sec': s}
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def register(self, kind, fn, limit=None, progress=False):
+        """
+        fn(params) → result (JSON-serializable); raise JobError cho lỗi input.
+        progress=True: gọi fn(params, report), report(dict) cập nhật job.progress (hiện trong status).
+        """
+        self._handlers[kind] = fn
+        if progress:
+            self._with_progress.add(kind)
+        if limit is not None:
+            self.kind_limits[kind] = limit
+
+    @property
+    def kinds(self):
+        return tuple(self._handlers)
+
+    def _limit(self, kind):
+        return max(1, self.kind_limits.get(kind, self.max_workers))
+
+    def start(self):
+        with self._cond:
+            if self._workers:
+                return
+            for i in range(self.max_workers):
+                t = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._workers.append(t)
+
+    def submit(self, kind, params=None):
+        if kind not in self._handlers:
+            raise JobError(f"Unknown job kind: {kind} (supported: {', '.join(self._handlers)})")
+        job = Job(kind, params or {})
+        with self._cond:
+            self._purge_locked()
+            if len(self._pending) >= self.max_queue:
+                raise QueueFullError(f"Job queue is full ({self.max_queue} queued)")
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify_all()
+        self.start()
+        return job
+
+    def run(self, kind, params=None, timeout=None):
+        """
+        Submit rồi chờ kết quả (cho endpoint đồng bộ cũ); vẫn chịu giới hạn của hàng đợi.
+        Hết timeout thì trả job còn đang chờ/chạy (caller trả job_id cho client tự poll).
+        """
+        job = self.submit(kind, params)
+        job.wait(timeout)
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def position(self, job):
+        """Vị trí trong hàng đợi (0 = đầu hàng), None nếu không còn chờ."""
+        with self._cond:
+            for i, j in enumerate(self._pending):
+                if j is job:
+                    return i
+        return None
+
+    def _next_job_locked(self):
+        # FIFO, bỏ qua (tạm thời) job thuộc loại đã chạy đủ giới hạn
+        for job in self._pending:
+            if self._running.get(job.kind, 0) < self._limit(job.kind):
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_job_locked()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job_locked()
+                self._running[job.kind] = self._running.get(job.kind, 0) + 1
+                job.status = RUNNING
+                job.started_at = time.time()
+            try:
+                fn = self._handlers[job.kind]
+                if job.kind in self._with_progress:
+                    result = fn(job.params, lambda progress: setattr(job, 'progress', progress))
+                else:
+                    result = fn(job.params)
+                status, error, error_status = DONE, None, None
+            except JobError as e:
+                result, status, error, error_status = None, ERROR, str(e), e.status
+            except Exception as e:
+                print(f"[JOB ERROR] {job.kind} {job.id}: {e}")
+                traceback.print_exc()
+                result, status, error, error_status = None, ERROR, str(e), 500
+            with self._cond:
+                job.result, job.error, job.error_status = result, error, error_status
+                job.finished_at = time.time()
+                job.status = status
+                self._running[job.kind] -= 1
+                c = self._counters.setdefault(job.kind, {'done': 0, 'error': 0, 'wait_sec': 0.0, 'run_sec': 0.0})
+                c[status] += 1
+                c['wait_sec'] += job.started_at - job.submitted_at
+                c['run_sec'] += job.finished_at - job.started_at
+                self._cond.notify_all()
+            job._done.set()
+
+    def _purge_locked(self):
+        """Bỏ job đã xong quá result_ttl giây (giữ bộ nhớ ổn định)."""
+        cutoff = time.time() - self.result_ttl
+        expired = [jid for jid, j in self._jobs.items() if j.finished_at is not None and j.finished_at < cutoff]
+        for jid in expired:
+            del self._jobs[jid]
+
+    def stats(self):
+        with self._cond:
+            kinds = {}
+            for kind in self._handlers:
+                c = self._counters.get(kind, {'done': 0, 'error': 0, 'wait_sec': 0.0, 'run_sec': 0.0})
+                finished = c['done'] + c['error']
+                kinds[kind] = {
+                    'limit': self._limit(kind),
+                    'queued': sum(1 for j in self._pending if j.kind == kind),
+                    'running': self._running.get(kind, 0),
+                    'done': c['done'],
+                    'error': c['error'],
+                    'avg_wait_sec': c['wait_sec'] / finished if finished else None,
+                    'avg_run_sec': c['run_sec'] / finished if finished else None,
+                }
+            oldest = self._pending[0].submitted_at if self._pending else None
+            return {
+                'workers': self.max_workers,
+                'queue_depth': len(self._pending),
+                'max_queue': self.max_queue,
+                'running': sum(self._running.values()),
+                'oldest_queued_sec': time.time() - oldest if oldest is not None else None,
+                'tracked_jobs': len(self._jobs),
+                'kinds': kinds,
+            }
@@ -0,0 +1,251 @@
+"""
+Metadata store dạng SQLite, key = FAISS row id, unique index trên video_path.
+Thay cho video_metadata.pkl (list dict phải unpickle toàn bộ mỗi lần load/update):
+lookup top-k và kiểm tra trùng chỉ chạm tới các dòng cần thiết.
+"""
+import os
+import json
+import pickle
+import sqlite3
+import threading
+import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,          -- = FAISS row id
+    video_name TEXT,
+    video_path TEXT NOT NULL,
+    extra TEXT                       -- JSON các key khác của metadata (nếu có)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_videos_path ON videos(video_path);
+"""
+_CORE_KEYS = ('video_name', 'video_path')
+
+
+def _row_to_dict(row):
+    _id, name, path, extra = row
+    d = json.loads(extra) if extra else {}
+    d['video_name'] = name
+    d['video_path'] = path
+    return d
+
+
+def _dict_to_row(row_id, m):
+    m = m or {}
+    extra = {k: v for k, v in m.items() if k not in _CORE_KEYS}
+    return (row_id, m.get('video_name'), m.get('video_path'), json.dumps(extra, ensure_ascii=False) if extra else None)
+
+
+class MetadataStore:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or config.METADATA_DB
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def get(self, row_id):
+        return self.get_many([row_id]).get(int(row_id))
+
+    def get_many(self, ids):
+        """{id: metadata dict} cho các id tồn tại."""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, video_name, video_path, extra FROM videos WHERE id IN ({placeholders})", ids
+            ).fetchall()
+        return {r[0]: _row_to_dict(r) for r in rows}
+
+    def existing_paths(self, paths, limit=None):
+        """Tập con của paths đã có trong store (chỉ tính id < limit nếu có)."""
+        paths = [p for p in set(paths) if p]
+        found = set()
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            sql = f"SELECT video_path FROM videos WHERE video_path IN ({placeholders})"
+            params = list(chunk)
+            if limit is not None:
+                sql += " AND id < ?"
+                params.append(int(limit))
+            with self._lock:
+                found.update(r[0] for r in self._conn.execute(sql, params))
+        return found
+
+    def _write(self, pairs, delete_from, check_complete=False):
+        """
+        DELETE + INSERT trong 1 transaction BEGIN IMMEDIATE: khóa ghi của chính file SQLite
+        tuần tự hóa các writer ở mọi process (API ingest, CLI --update), không chỉ thread trong process.
+        check_complete: sau khi xóa, các id < delete_from phải đủ (COUNT = delete_from), nếu không thì hủy.
+        """
+        rows = [_dict_to_row(i, m) for i, m in pairs]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                dropped = self._conn.execute("DELETE FROM videos WHERE id >= ?", (int(delete_from),)).rowcount
+                if check_complete:
+                    have = self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+                    if have != int(delete_from):
+                        raise RuntimeError(
+                            f"Metadata {self.db_path}: có {have} dòng với id < {delete_from}, "
+                            f"thiếu metadata cho {int(delete_from) - have} row của index (cần chạy lại mode create)")
+                self._conn.executemany("INSERT INTO videos (id, video_name, video_path, extra) VALUES (?, ?, ?, ?)", rows)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return dropped
+
+    def append(self, metadata_list, start_id):
+        """
+        Ghi metadata cho các row id start_id.. (1 transaction); start_id = số row đã publish trong manifest.
+        Dòng id >= start_id là rác của lần ghi bị gián đoạn (chưa publish) nên được xóa trước.
+        Caller phải giữ vector_store.writer_lock() để start_id không bị writer khác đổi giữa chừng.
+        """
+        dropped = self._write([(start_id + i, m) for i, m in enumerate(metadata_list)], delete_from=start_id,
+                              check_complete=True)
+        if dropped:
+            print(f"[METADATA] Đã xóa {dropped} dòng id >= {start_id} của lần ghi bị gián đoạn ({self.db_path})")
+        return len(metadata_list)
+
+    def replace_all(self, metadata_list):
+        """Thay toàn bộ metadata (mode create), id = vị trí trong list."""
+        self._write(list(enumerate(metadata_list)), delete_from=0)
+        return len(metadata_list)
+
+    def drop_from(self, start_id):
+        """Xóa các dòng id >= start_id (rác của lần ghi bị gián đoạn, chưa có trong manifest)."""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM videos WHERE id >= ?", (int(start_id),)).rowcount
+
+    def iter_all(self, limit=None):
+        sql = "SELECT id, video_name, video_path, extra FROM videos"
+        params = []
+        if limit is not None:
+            sql += " WHERE id < ?"
+            params.append(int(limit))
+        sql += " ORDER BY id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        for r in rows:
+            yield r[0], _row_to_dict(r)
+
+
+class MetadataView:
+    """
+    View chỉ đọc trên store, giới hạn ở `limit` dòng đầu (= ntotal của index đã load).
+    Hỗ trợ len() và view[idx] như list metadata cũ.
+    """
+
+    def __init__(self, store, limit):
+        self.store = store
+        self.limit = int(limit)
+
+    def __len__(self):
+        return self.limit
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if not 0 <= idx < self.limit:
+            raise IndexError(idx)
+        row = self.store.get(idx)
+        if row is None:
+            raise IndexError(idx)
+        return row
+
+    def get_many(self, ids):
+        return self.store.get_many([i for i in ids if 0 <= int(i) < self.limit])
+
+
+_stores = {}
+_store_lock = threading.Lock()
+
+
+def get_store(db_path=None):
+    """Store dùng chung trong process theo đường dẫn DB (tự migrate từ pickle nếu là DB mặc định)."""
+    db_path = os.path.abspath(db_path or config.METADATA_DB)
+    with _store_lock:
+        store = _stores.get(db_path)
+        if store is None:
+            needs_migration = (db_path == os.path.abspath(config.METADATA_DB)
+                               and not os.path.exists(db_path) and os.path.exists(config.METADATA_FILE))
+            store = _stores[db_path] = MetadataStore(db_path)
+            if needs_migration:
+                migrate_from_pickle(store)
+    return store
+
+
+def _legacy_delta_metadata():
+    """Metadata của các delta dạng cũ (segments/*.pkl) theo thứ tự manifest."""
+    if not os.path.exists(config.MANIFEST_FILE):
+        return []
+    with open(config.MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    out = []
+    for entry in manifest.get('deltas', []):
+        pkl = os.path.join(config.SEGMENTS_FOLDER, f"{entry['name']}.pkl")
+        if os.path.exists(pkl):
+            with open(pkl, 'rb') as f:
+                out.extend(pickle.load(f))
+    return out
+
+
+def migrate_from_pickle(store=None, pickle_path=None):
+    """Migration 1 lần: video_metadata.pkl (+ delta .pkl cũ) → SQLite, id = vị trí trong list."""
+    store = store or MetadataStore()
+    pickle_path = pickle_path or config.METADATA_FILE
+    with open(pickle_path, 'rb') as f:
+        metadata = pickle.load(f)
+    metadata = list(metadata) + _legacy_delta_metadata()
+    # Mỗi row của index phải có đúng 1 dòng metadata: path trùng/thiếu thì dừng hẳn thay vì bỏ qua dòng
+    # (bỏ qua làm lệch số dòng so với index, mọi lần append sau đều hỏng)
+    missing, first_seen, duplicates = [], {}, []
+    for i, m in enumerate(metadata):
+        path = (m or {}).get('video_path')
+        if not path:
+            missing.append(i)
+        elif path in first_seen:
+            duplicates.append((first_seen[path], i, path))
+        else:
+            first_seen[path] = i
+    if missing or duplicates:
+        lines = [f"  row {i}: thiếu video_path" for i in missing[:20]]
+        lines += [f"  row {j}: trùng video_path với row {i} ({p})" for i, j, p in duplicates[:20]]
+        raise RuntimeError(
+            f"Không migrate được {pickle_path}: {len(missing)} dòng thiếu và {len(duplicates)} dòng trùng video_path\n"
+            + "\n".join(lines) + "\nHãy build lại thư viện bằng extract_features.py --mode create")
+    store._write(list(enumerate(metadata)), delete_from=0)
+    print(f"[METADATA] Đã migrate {len(metadata)} dòng từ {pickle_path} → {store.db_path}")
+    return len(metadata)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Metadata store (SQLite)")
+    parser.add_argument('--migrate', action='store_true', help='Migrate video_metadata.pkl sang SQLite')
+    parser.add_argument('--pickle', type=str, default=None, help='Đường dẫn pickle (mặc định config.METADATA_FILE)')
+    parser.add_argument('--db', type=str, default=None, help='Đường dẫn DB (mặc định config.METADATA_DB)')
+    parser.add_argument('--drop-from', type=int, default=None,
+                        help='Xóa các dòng id >= giá trị này (dọn lần ghi bị gián đoạn)')
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_from_pickle(pickle_path=args.pickle)
+    elif args.drop_from is not None:
+        store = MetadataStore(args.db)
+        print(f"{store.db_path}: đã xóa {store.drop_from(args.drop_from)} dòng id >= {args.drop_from}")
+    else:
+        store = MetadataStore(args.db)
+        print(f"{store.db_path}: {store.count()} dòng")
@@ -0,0 +1,81 @@
+"""
+Registry dùng chung CLIP model/processor cho toàn bộ process
+(VideoSearcher, VideoFeatureExtractor, VideoVerifier cùng mượn 1 bản duy nhất)
+"""
+import os
+# Avoid multiple OpenMP runtime initialization on macOS
+os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+import threading
+import time
+import torch
+from transformers import CLIPProcessor, CLIPModel
+import config
+
+_lock = threading.Lock()
+_clip = None          # (model, processor, device)
+_load_seconds = None
+_load_count = 0
+
+
+def get_clip():
+    """
+    Trả về (model, processor, device) dùng chung.
+    Chỉ load 1 lần cho mỗi process, an toàn khi gọi từ nhiều thread.
+    """
+    global _clip, _load_seconds, _load_count
+    if _clip is not None:
+        return _clip
+    with _lock:
+        if _clip is None:
+            print("Đang load CLIP model (shared)...")
+            t0 = time.time()
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model = CLIPModel.from_pretrained(config.CLIP_MODEL_NAME).to(device)
+            processor = CLIPProcessor.from_pretrained(config.CLIP_MODEL_NAME, use_fast=True)
+            model.eval()
+            _load_seconds = time.time() - t0
+            _load_count += 1
+            _clip = (model, processor, device)
+            print(f"Model đã load trên {device} ({_load_seconds:.1f}s)")
+    return _clip
+
+
+def _process_rss_bytes():
+    """RSS hiện tại của process (bytes), None nếu không đọc được."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        import platform
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS trả về bytes, Linux trả về KB
+        return peak if platform.system() == "Darwin" else peak * 1024
+    except Exception:
+        return None
+
+
+def memory_info():
+    """Thông tin bộ nhớ của model dùng chung và của process (dùng cho /health)."""
+    info = {
+        'loaded': _clip is not None,
+        'model_name': config.CLIP_MODEL_NAME,
+        'load_count': _load_count,
+        'load_seconds': _load_seconds,
+        'device': None,
+        'model_bytes': 0,
+        'process_rss_bytes': _process_rss_bytes(),
+    }
+    if _clip is not None:
+        model, _processor, device = _clip
+        info['device'] = device
+        info['model_bytes'] = int(
+            sum(p.numel() * p.element_size() for p in model.parameters())
+            + sum(b.numel() * b.element_size() for b in model.buffers())
+        )
+    return info
@@ -5,105 +5,67 @@ import os
 # Avoid multiple OpenMP runtime initialization on macOS
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
 os.environ.setdefault("OMP_NUM_THREADS", "1")
-import pickle
 import json
 import numpy as np
-import faiss
-from transformers import CLIPProcessor, CLIPModel
-import torch
 import config
+import vector_store
+import model_registry
+from frame_sampler import FrameSampler, make_time_points, iter_live_frames
+from clip_embedder import embed_batch, embed_video_mean, embed_video_means, iter_video_embeddings, RunningMean
+from frame_cache import get_frame_cache
 
 
 class VideoSearcher:
-    def __init__(self):
-        print("Đang load CLIP model...")
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(config.CLIP_MODEL_NAME).to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(config.CLIP_MODEL_NAME, use_fast=True)
-        self.model.eval()
-        
-        # Load FAISS index
-        if os.path.exists(config.FEATURES_FILE):
-            self.index = faiss.read_index(config.FEATURES_FILE)
-            print(f"Đã load index từ {config.FEATURES_FILE}")
-        else:
-            raise FileNotFoundError(f"Không tìm thấy index file: {config.FEATURES_FILE}")
-        
-        # Load metadata
-        if os.path.exists(config.METADATA_FILE):
-            with open(config.METADATA_FILE, 'rb') as f:
-                self.metadata = pickle.load(f)
-            print(f"Đã load metadata: {len(self.metadata)} videos")
-        else:
-            raise FileNotFoundError(f"Không tìm thấy metadata file: {config.METADATA_FILE}")
+    def __init__(self, holder=None):
+        self.model, self.processor, self.device = model_registry.get_clip()
+        self.sampler = FrameSampler()
+        self.frame_cache = get_frame_cache()
+
+        # FAISS index + metadata (base + delta) nằm trong holder dùng chung, được swap ở nền
+        self.holder = holder or vector_store.IndexHolder()
+        gen = self.holder.current()
+        print(f"Đã load index generation {gen.version} từ {config.VECTOR_FOLDER}")
+        print(f"Đã load metadata: {len(gen.metadata)} videos")
+
+    @property
+    def index(self):
+        return self.holder.current().index
+
+    @property
+    def metadata(self):
+        return self.holder.current().metadata
 
     def extract_frames_from_video(self, video_path, start_time=5, end_time=35, sample_rate=0.5):
         """
         Trích xuất khung hình từ video (tương tự extract_features.py)
         """
-        import cv2
-        from PIL import Image
-        
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            return []
-
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frames = []
-        
-        time_points = np.arange(start_time, end_time, sample_rate)
-        
-        for time_point in time_points:
-            frame_number = int(time_point * fps)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-            ret, frame = cap.read()
-            
-            if ret:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb)
-                frames.append(pil_image)
-        
-        cap.release()
-        return frames
+        time_points = make_time_points(start_time, end_time, sample_rate)
+        return self.sampler.sample(video_path, time_points)
 
     def extract_features_from_query_video(self, video_path):
         """
         Trích xuất đặc trưng từ video query (livestream hoặc video thử nghiệm)
         """
-        frames = self.extract_frames_from_video(
-            video_path,
-            start_time=config.START_TIME,
-            end_time=config.END_TIME,
-            sample_rate=config.SAMPLE_RATE
-        )
-        
-        if not frames:
-            return None
-        
-        # Xử lý với CLIP
-        inputs = self.processor(images=frames, return_tensors="pt", padding=True)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        with torch.no_grad():
-            image_features = self.model.get_image_features(**inputs)
-            image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-            feature_vector = image_features.mean(dim=0).cpu().numpy()
-            norm = np.linalg.norm(feature_vector)
-            if norm > 0:
-                feature_vector = feature_vector / norm
-        
-        return feature_vector
+        time_points = make_time_points(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
+        # Stream frame → micro-batch CLIP → running mean (frame đã embed trước đó lấy từ cache)
+        return embed_video_mean(self.sampler, video_path, time_points, cache=self.frame_cache)
 
-    def search(self, query_video_path, top_k=5):
+    def search(self, query_video_path, top_k=5, progressive=None):
         """
         Tìm kiếm video tương đồng
         Args:
             query_video_path: Đường dẫn video cần tìm
             top_k: Số lượng video tương đồng trả về
+            progressive: dùng search coarse-to-fine (mặc định config.SEARCH_PROGRESSIVE)
         Returns:
             List các dict chứa video_name, video_path, similarity
         """
         print(f"\nĐang xử lý video query: {query_video_path}")
+
+        if config.SEARCH_PROGRESSIVE if progressive is None else progressive:
+            _vec, results, info = self.search_progressive(query_video_path, top_k=top_k)
+            print(f"Đã dùng {info['frames_used']}/{info['frames_total']} frame (margin {info['margin']})")
+            return results
         
         # Extract features từ query video
         query_features = self.extract_features_from_query_video(query_video_path)
@@ -111,27 +73,136 @@ class VideoSearcher:
         if query_features is None:
             return []
         
-        # Reshape để FAISS có thể xử lý
-        query_features = query_features.reshape(1, -1).astype('float32')
-        
-        # Tìm kiếm
-        similarities, indices = self.index.search(query_features, top_k)
-        
-        # Chuẩn hóa similarity về 0-100%
-        similarities = similarities[0]
-        indices = indices[0]
-        
-        # Lấy thông tin metadata
-        results = []
-        for i, idx in enumerate(indices):
-            if idx < len(self.metadata):
-                similarity_percent = float(similarities[i] * 100)
-                video_info = self.metadata[idx].copy()
-                video_info['similarity'] = similarity_percent
-                video_info['rank'] = i + 1
-                results.append(video_info)
-        
-        return results
+        return self.search_vector(query_features, top_k=top_k)
+
+    def search_progressive(self, query_video_path, top_k=5, margin=None, strides=None):
+        """
+        Search coarse-to-fine: embed 1 tập thưa của lưới START_TIME..END_TIME, query index,
+        rồi chỉ lấy mẫu dày thêm khi similarity hạng 1 - hạng 2 còn dưới `margin`.
+        Lưới dày nhất (stride 1) cho đúng vector của search thường.
+        Mỗi stage chỉ decode + embed các thời điểm nó thêm vào, theo micro-batch (RAM không phụ thuộc
+        độ dài video, dừng sớm thì không decode phần còn lại); stage thưa seek thay vì grab qua mọi frame.
+        Frame đã cache thì không decode; embedding mới ghi vào cache như search thường.
+        Trả về (query_vec, results, info) với info = {frames_used, frames_total, margin, stride}.
+        """
+        margin = config.PROGRESSIVE_MARGIN if margin is None else margin
+        strides = sorted(set(strides or config.PROGRESSIVE_STRIDES) | {1}, reverse=True)
+        time_points = make_time_points(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
+        info = {'frames_used': 0, 'frames_total': len(time_points), 'margin': None, 'stride': None}
+
+        used = np.zeros(len(time_points), dtype=bool)
+        acc = RunningMean()
+        vec, results, gap = None, [], None
+        for stride in strides:
+            stage = np.zeros_like(used)
+            stage[::stride] = True
+            stage &= ~used
+            used |= stage
+            if not stage.any():
+                continue
+            # Khoảng cách giữa 2 mẫu của stage lớn hơn max_skip → sampler seek tới từng mẫu
+            sampler = self.sampler
+            spacing = stride * config.SAMPLE_RATE
+            if stride > 1 and sampler.max_skip_seconds >= spacing:
+                sampler = FrameSampler(max_skip_seconds=spacing / 2.0, default_fps=sampler.default_fps)
+            for _times, embs in iter_video_embeddings(sampler, query_video_path, time_points[stage],
+                                                      cache=self.frame_cache):
+                acc.add(embs)
+            vec = acc.vector()
+            if vec is None:
+                continue
+            # Cần ít nhất 2 kết quả để đo khoảng cách hạng 1 - hạng 2
+            results = self.search_vector(vec, top_k=max(top_k, 2))
+            gap = (results[0]['similarity'] - results[1]['similarity']) / 100.0 if len(results) > 1 else float('inf')
+            info.update(frames_used=acc.count, stride=stride,
+                        margin=round(gap, 4) if np.isfinite(gap) else None)
+            if gap >= margin:
+                break
+
+        return vec, results[:top_k], info
+
+    def extract_features_from_query_videos(self, video_paths, max_workers=None):
+        """
+        Đặc trưng của nhiều video query: decode song song, frame gộp chung batch CLIP.
+        Trả về list vector (None nếu video không đọc được) cùng thứ tự video_paths.
+        """
+        time_points = make_time_points(config.START_TIME, config.END_TIME, config.SAMPLE_RATE)
+        return embed_video_means(self.sampler, video_paths, time_points, cache=self.frame_cache,
+                                 max_workers=max_workers)
+
+    def search_vector(self, query_features, top_k=5):
+        """
+        Tìm kiếm bằng vector query đã có (bỏ qua decode + CLIP)
+        """
+        return self.search_vectors(np.asarray(query_features).reshape(1, -1), top_k=top_k)[0]
+
+    def search_vectors(self, query_matrix, top_k=5):
+        """
+        Tìm kiếm nhiều vector query bằng 1 lần index.search dạng ma trận.
+        Trả về list kết quả cho từng dòng của query_matrix.
+        """
+        query_matrix = np.ascontiguousarray(query_matrix, dtype='float32')
+        if len(query_matrix) == 0:
+            return []
+
+        # Tìm kiếm (giữ nguyên 1 generation cho cả request)
+        gen = self.holder.current()
+        similarities, indices = gen.index.search(query_matrix, top_k)
+
+        # Lấy thông tin metadata (1 truy vấn cho toàn bộ top-k của mọi query)
+        rows = gen.metadata.get_many(np.unique(indices[indices >= 0]))
+        all_results = []
+        for sims, ids in zip(similarities, indices):
+            results = []
+            for i, idx in enumerate(ids):
+                video_info = rows.get(int(idx))
+                if video_info is not None:
+                    # Chuẩn hóa similarity về 0-100%
+                    video_info = dict(video_info, similarity=float(sims[i] * 100), rank=i + 1)
+                    results.append(video_info)
+            all_results.append(results)
+        return all_results
+
+    def live_search(self, source, top_k=5, requery_sec=None, idle_timeout=None):
+        """
+        Search trực tiếp trên video livestream đang được ghi (file lớn dần) hoặc stdin ('-').
+        Frame trong [START_TIME, END_TIME) được embed ngay khi decode và cộng dồn vào running mean;
+        sau mỗi requery_sec giây stream thì query lại FAISS.
+        Yield dict {t, frames, results, final}: kết quả tạm thời, final=True ở lần cuối.
+        """
+        requery_sec = config.LIVE_REQUERY_SEC if requery_sec is None else requery_sec
+        clip = (self.model, self.processor, self.device)
+        acc = RunningMean()
+        pending = []
+        last_t = None
+
+        def _update(final):
+            if pending:
+                acc.add(embed_batch(pending, clip))
+                pending.clear()
+            vec = acc.vector()
+            results = self.search_vector(vec, top_k=top_k) if vec is not None else []
+            return {'t': last_t, 'frames': acc.count, 'results': results, 'final': final}
+
+        frames = iter_live_frames(source, config.SAMPLE_RATE, idle_timeout=idle_timeout)
+        try:
+            next_query = config.START_TIME + requery_sec
+            for t, img in frames:
+                if t < config.START_TIME:
+                    continue
+                if t >= config.END_TIME:
+                    break
+                pending.append(img)
+                last_t = float(t)
+                if len(pending) >= config.EMBED_BATCH_SIZE:
+                    acc.add(embed_batch(pending, clip))
+                    pending.clear()
+                if t >= next_query:
+                    yield _update(final=False)
+                    next_query = t + requery_sec
+        finally:
+            frames.close()
+        yield _update(final=True)
 
     def display_results(self, results):
         """
@@ -161,14 +232,30 @@ def main():
     if '--json' in argv:
         emit_json = True
         argv.remove('--json')
+    live = '--live' in argv
+    if live:
+        argv.remove('--live')
 
     if len(argv) < 1:
-        print("Usage: python search_video.py <path_to_query_video> [--json]")
+        print("Usage: python search_video.py <path_to_query_video> [--json] [--live]")
         print("Example: python search_video.py ../video1.mov --json")
+        print("Live:    python search_video.py --live <record_xxx.webm | -> [--json]")
         return
 
     query_video = argv[0]
 
+    if live:
+        # Theo dõi file đang được ghi (hoặc stdin '-'), in kết quả tạm thời sau mỗi lần query lại
+        searcher = VideoSearcher()
+        for update in searcher.live_search(query_video, top_k=config.TOP_K):
+            if emit_json:
+                print(json.dumps(update, ensure_ascii=False), flush=True)
+            else:
+                status = "KẾT QUẢ CUỐI" if update['final'] else "TẠM THỜI"
+                print(f"\n[LIVE {status}] t={update['t']}s, {update['frames']} frame")
+                searcher.display_results(update['results'])
+        return
+
     if not os.path.exists(query_video):
         print(f"Không tìm thấy file: {query_video}")
         return
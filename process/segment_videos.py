@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import json
+import multiprocessing
 import subprocess
+import time
 import sys
 import shutil
 import tempfile
+import threading
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, NamedTuple, Tuple
 
 import cv2
 import numpy as np
 
+import frame_hash
+from fingerprint import file_fingerprint
+
 ALLOWED_EXTS = {'.mp4', '.mov', '.avi', '.mkv', '.webm'}
 
 
@@ -20,7 +29,41 @@ def require_ffmpeg() -> None:
         sys.exit(1)
 
 
+# ================= Probe layer =================
+# Durations are cached by (path, size, mtime). Files written by run_ffmpeg(..., output=...) get their
+# duration from that run's -progress output; many files are probed with one ffmpeg call that lists
+# all of them as inputs (probe_durations), so ffprobe subprocesses stay rare.
+_duration_memo: dict = {}
+_INPUT_RE = re.compile(r"^Input #(\d+), .*, from '(.*)':\s*$")
+_DURATION_RE = re.compile(r"^\s+Duration: (N/A|(\d+):(\d+):(\d+(?:\.\d+)?))")
+PROBE_BATCH = 200
+
+
+def _stat_key(input_path: str):
+    try:
+        st = os.stat(input_path)
+    except OSError:
+        return None
+    return os.path.abspath(input_path), st.st_size, st.st_mtime
+
+
+def _remember_duration(input_path: str, duration: float) -> None:
+    key = _stat_key(input_path)
+    if key is not None and duration > 0:
+        if len(_duration_memo) > 65536:
+            _duration_memo.clear()
+        _duration_memo[key] = float(duration)
+
+
+def _cached_duration(input_path: str) -> float | None:
+    key = _stat_key(input_path)
+    return _duration_memo.get(key) if key is not None else None
+
+
 def ffprobe_duration(input_path: str) -> float:
+    cached = _cached_duration(input_path)
+    if cached is not None:
+        return cached
     try:
         result = subprocess.run(
             [
@@ -32,19 +75,85 @@ def ffprobe_duration(input_path: str) -> float:
             text=True,
             check=True,
         )
-        return float(result.stdout.strip())
+        duration = float(result.stdout.strip())
     except Exception:
         return 0.0
+    _remember_duration(input_path, duration)
+    return duration
+
+
+def probe_durations(paths: List[Path]) -> List[float]:
+    """
+    Durations of many files (0.0 if unreadable): cache first, then one `ffmpeg -i a -i b ...` per
+    PROBE_BATCH files parsing the "Duration:" line of each input; ffprobe only for files that call missed.
+    """
+    out = [_cached_duration(str(p)) for p in paths]
+    missing = [i for i, d in enumerate(out) if d is None]
+    for b in range(0, len(missing), PROBE_BATCH):
+        batch = missing[b:b + PROBE_BATCH]
+        cmd = ['ffmpeg', '-hide_banner', '-nostdin']
+        for i in batch:
+            cmd += ['-i', str(paths[i])]
+        # No output file: ffmpeg prints every input header then exits non-zero, which is expected here
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+        current = None
+        for line in proc.stderr.splitlines():
+            m = _INPUT_RE.match(line)
+            if m:
+                k = int(m.group(1))
+                current = batch[k] if k < len(batch) else None
+                continue
+            m = _DURATION_RE.match(line)
+            if m and current is not None:
+                if m.group(2) is not None:
+                    duration = int(m.group(2)) * 3600 + int(m.group(3)) * 60 + float(m.group(4))
+                    out[current] = duration
+                    _remember_duration(str(paths[current]), duration)
+                current = None
+    # ffmpeg stops at the first input it cannot open: probe the rest one by one
+    return [d if d is not None else ffprobe_duration(str(p)) for p, d in zip(paths, out)]
+
+
+# Cross-process cap on concurrent ffmpeg runs (set in pool workers by --jobs/--max-encodes)
+_ENCODE_SLOTS = None
+
+
+def _init_encode_slots(slots) -> None:
+    global _ENCODE_SLOTS
+    _ENCODE_SLOTS = slots
+
+
+def _run_with_progress(cmd: list) -> Tuple[int, float | None]:
+    """Run ffmpeg with -progress on stdout (stderr stays on the console); return (code, final out_time seconds)."""
+    proc = subprocess.Popen([cmd[0], '-progress', 'pipe:1', *cmd[1:]], stdout=subprocess.PIPE, text=True)
+    out_time = None
+    for line in proc.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and value.isdigit():
+            out_time = int(value) / 1e6
+    return proc.wait(), out_time
+
+
+def run_ffmpeg(cmd: list, output: Path | None = None) -> None:
+    """
+    output: the single file this run writes; its duration is taken from the run's progress
+    (so later duration checks on it need no ffprobe).
+    """
+    if _ENCODE_SLOTS is not None:
+        with _ENCODE_SLOTS:
+            returncode, out_time = _run_with_progress(cmd)
+    else:
+        returncode, out_time = _run_with_progress(cmd)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed with code {returncode}")
+    if output is not None and out_time:
+        _remember_duration(str(output), out_time)
+# =========================================================
 
 
-def run_ffmpeg(cmd: list) -> None:
-    proc = subprocess.run(cmd)
-    if proc.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed with code {proc.returncode}")
-
-
-def trim_file(input_file: Path, output_file: Path, trim_head: float, trim_tail: float, reencode: bool) -> bool:
-    duration = ffprobe_duration(str(input_file))
+def trim_file(input_file: Path, output_file: Path, trim_head: float, trim_tail: float, reencode: bool,
+              duration: float | None = None) -> bool:
+    duration = ffprobe_duration(str(input_file)) if duration is None else duration
     if duration <= 0:
         return False
     start = max(0.0, float(trim_head))
@@ -67,7 +176,7 @@ def trim_file(input_file: Path, output_file: Path, trim_head: float, trim_tail:
             '-ss', f'{start:.3f}', '-to', f'{end_time:.3f}',
             '-c', 'copy', str(output_file)
         ]
-    run_ffmpeg(cmd)
+    run_ffmpeg(cmd, output=output_file)
     return True
 
 
@@ -91,7 +200,7 @@ def encode_to_mov(input_file: Path, output_file: Path) -> None:
         '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
         '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', str(output_file)
     ]
-    run_ffmpeg(cmd)
+    run_ffmpeg(cmd, output=output_file)
 
 
 def build_out_name(stem: str, index: int) -> str:
@@ -100,78 +209,214 @@ def build_out_name(stem: str, index: int) -> str:
 
 # ================= Template-based detection =================
 def average_hash_from_frame(frame: np.ndarray) -> int:
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    small = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
-    mean_val = float(np.mean(small))
-    bits = (small > mean_val).astype(np.uint8).flatten()
-    val = 0
-    for b in bits:
-        val = (val << 1) | int(b)
-    return int(val)
+    return int(frame_hash.hash_frames([frame])[0])
 
 
 def hamming64(a: int, b: int) -> int:
-    return int(bin(a ^ b).count('1'))
+    return int(frame_hash.hamming(np.uint64(a), b))
 
 
-def collect_hashes(video_path: Path, step_sec: float) -> Tuple[List[float], List[int]]:
+def collect_hashes_opencv(video_path: Path, step_sec: float) -> Tuple[np.ndarray, np.ndarray]:
+    """cv2 backend: seek + full-resolution decode every step_sec, hashed in one batch."""
     cap = cv2.VideoCapture(str(video_path))
     if not cap.isOpened():
-        return [], []
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.uint64)
     duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / max(1.0, cap.get(cv2.CAP_PROP_FPS))
     t = 0.0
     times: List[float] = []
-    hashes: List[int] = []
+    thumbs: List[np.ndarray] = []
     while t <= max(0.0, duration):
         cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000.0)
         ok, frame = cap.read()
         if not ok or frame is None:
             t += step_sec
             continue
-        hashes.append(average_hash_from_frame(frame))
+        # Keep only the 8x8 thumbnail, not the full frame
+        thumbs.append(frame_hash.thumbnail(frame))
         times.append(t)
         t += step_sec
     cap.release()
+    hashes = frame_hash.hash_thumbnails(np.stack(thumbs)) if thumbs else np.empty(0, dtype=np.uint64)
+    return np.asarray(times, dtype=np.float64), hashes
+
+
+# Hash decoders: 'opencv' (default) seeks with cv2.VideoCapture and shrinks full frames, as
+# segment_videos always did; 'ffmpeg' (opt-in, faster) streams 8x8 gray frames over a pipe, with
+# frame times synthesized as n * step from 0 rather than read per frame. Hashes differ by a few bits
+# between the two, so --detect-threshold tuned on one may need retuning on the other, and timelines
+# and template signatures are always compared within one decoder.
+DECODERS = ('ffmpeg', 'opencv')
+DEFAULT_DECODER = 'opencv'
+
+
+def iter_hash_chunks_ffmpeg(video_path: Path, step_sec: float, chunk_frames: int = 4096) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    One ffmpeg process (fps -> 8x8 area scale -> gray) writes 64-byte raw frames to a pipe.
+    Yields (times, hashes) per chunk of up to chunk_frames frames, so memory stays O(chunk).
+    """
+    frame_bytes = frame_hash.HASH_BITS
+    cmd = [
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-an', '-sn', '-dn',
+        '-i', str(video_path),
+        '-vf', f"fps={1.0 / step_sec:g},scale={frame_hash.HASH_SIZE}:{frame_hash.HASH_SIZE}:flags=area,format=gray",
+        '-f', 'rawvideo', '-pix_fmt', 'gray', 'pipe:1'
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors: List[str] = []
+
+    def _read_stderr():
+        for raw in iter(proc.stderr.readline, b''):
+            errors.append(raw.decode('utf-8', 'replace').rstrip())
+            del errors[:-5]
+
+    err_thread = threading.Thread(target=_read_stderr, name='hash-ffmpeg-stderr', daemon=True)
+    err_thread.start()
+    buf = bytearray(chunk_frames * frame_bytes)
+    view = memoryview(buf)
+    n_done = 0
+    try:
+        while True:
+            filled = 0
+            while filled < len(buf):
+                got = proc.stdout.readinto(view[filled:])
+                if not got:
+                    break
+                filled += got
+            n = filled // frame_bytes
+            if n:
+                thumbs = np.frombuffer(buf, dtype=np.uint8, count=n * frame_bytes).reshape(n, frame_hash.HASH_SIZE, frame_hash.HASH_SIZE)
+                times = (n_done + np.arange(n, dtype=np.float64)) * step_sec
+                yield times, frame_hash.hash_thumbnails(thumbs)
+                n_done += n
+            if filled < len(buf):
+                break
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        err_thread.join(timeout=1.0)
+    if proc.returncode != 0 and n_done == 0:
+        print(f"  [Hash Decoder] ffmpeg failed on {video_path.name}: {' | '.join(errors) or proc.returncode}", file=sys.stderr)
+
+
+def collect_hashes_ffmpeg(video_path: Path, step_sec: float) -> Tuple[np.ndarray, np.ndarray]:
+    times, hashes = [np.empty(0, dtype=np.float64)], [np.empty(0, dtype=np.uint64)]
+    for t, h in iter_hash_chunks_ffmpeg(video_path, step_sec):
+        times.append(t)
+        hashes.append(h)
+    return np.concatenate(times), np.concatenate(hashes)
+
+
+def collect_hashes(video_path: Path, step_sec: float, decoder: str = DEFAULT_DECODER) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample every step_sec -> (times float64 [N], hashes uint64 [N])."""
+    if decoder == 'opencv':
+        return collect_hashes_opencv(video_path, step_sec)
+    return collect_hashes_ffmpeg(video_path, step_sec)
+
+
+def median_hash(hashes) -> int:
+    return frame_hash.median_hash(hashes)
+
+
+# ================= Hash timeline sidecar cache =================
+# Timeline of an input = (times, hashes) at --detect-step, stored in --hash-cache-dir (default
+# $XDG_CACHE_HOME/daga/hashes, keyed by fingerprint.file_fingerprint) or, with --hash-cache-sidecar,
+# next to the video, so reruns with other thresholds/gaps/templates skip decoding.
+
+
+def default_hash_cache_dir() -> Path:
+    # Computed locally: this script must not import config (it prints and creates DATA_DIR folders)
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(base) / 'daga' / 'hashes'
+
+
+def timeline_cache_path(video_path: Path, step_sec: float, fingerprint: str, cache_dir: Path | None = None,
+                        decoder: str = DEFAULT_DECODER) -> Path:
+    step_ms = int(round(step_sec * 1000.0))
+    if cache_dir is not None:
+        return cache_dir / f"{fingerprint}.ahash_{decoder}_{step_ms}ms.npz"
+    return video_path.with_name(f".{video_path.name}.ahash_{decoder}_{step_ms}ms.npz")
+
+
+def load_timeline(cache_file: Path, fingerprint: str, step_sec: float) -> Tuple[np.ndarray, np.ndarray] | None:
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data['fingerprint']) != fingerprint or abs(float(data['step_sec']) - step_sec) > 1e-6:
+                return None
+            return data['times'].astype(np.float64), data['hashes'].astype(np.uint64)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_timeline(cache_file: Path, fingerprint: str, step_sec: float, times: np.ndarray, hashes: np.ndarray) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_name(cache_file.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez(f, fingerprint=np.array(fingerprint), step_sec=np.float64(step_sec),
+                 times=np.asarray(times, dtype=np.float32), hashes=np.asarray(hashes, dtype=np.uint64))
+    os.replace(tmp, cache_file)
+
+
+def get_timeline(video_path: Path, step_sec: float, cache_dir: Path | None = None, use_cache: bool = True,
+                 decoder: str = DEFAULT_DECODER) -> Tuple[np.ndarray, np.ndarray]:
+    """collect_hashes() with a sidecar cache keyed by file fingerprint + step + decoder."""
+    if not use_cache:
+        return collect_hashes(video_path, step_sec, decoder)
+    fingerprint = file_fingerprint(str(video_path))
+    cache_file = timeline_cache_path(video_path, step_sec, fingerprint, cache_dir, decoder)
+    cached = load_timeline(cache_file, fingerprint, step_sec)
+    if cached is not None:
+        print(f"  [Hash Cache] {video_path.name}: {len(cached[1])} frame(s) from {cache_file.name}")
+        return cached
+    times, hashes = collect_hashes(video_path, step_sec, decoder)
+    if len(hashes):
+        try:
+            save_timeline(cache_file, fingerprint, step_sec, times, hashes)
+        except OSError as e:
+            print(f"  [Hash Cache] Cannot write {cache_file}: {e}", file=sys.stderr)
     return times, hashes
 
 
-def median_hash(hashes: List[int]) -> int:
-    if not hashes:
-        return 0
-    ones = [0] * 64
-    for h in hashes:
-        for i in range(64):
-            if (h >> i) & 1:
-                ones[i] += 1
-    half = len(hashes) / 2.0
-    out = 0
-    for i in range(63, -1, -1):
-        out <<= 1
-        out |= 1 if ones[i] > half else 0
+class TemplateSignature(NamedTuple):
+    path: Path
+    hash: int              # median hash of the template frames
+    duration: float
+    hashes: np.ndarray     # per-frame hashes (uint64)
+
+
+Timeline = Tuple[np.ndarray, np.ndarray]   # (times float64 [N], hashes uint64 [N])
+
+
+def load_template(template_file: Path, step_sec: float, decoder: str = DEFAULT_DECODER) -> TemplateSignature | None:
+    tmpl_times, tmpl_hashes = collect_hashes(template_file, max(0.25, step_sec), decoder)
+    if len(tmpl_hashes) == 0:
+        return None
+    tmpl_dur = ffprobe_duration(str(template_file))
+    if tmpl_dur <= 0:
+        tmpl_dur = max(1.0, len(tmpl_hashes) * max(0.25, step_sec))
+    return TemplateSignature(template_file, median_hash(tmpl_hashes), tmpl_dur, tmpl_hashes)
+
+
+def match_times(times: np.ndarray, is_match: np.ndarray, step_sec: float, suppress_window_sec: float) -> List[float]:
+    """
+    Greedy scan over a precomputed timeline: take a match, skip everything within
+    max(step, suppress) after it (same as the old seek-and-jump loop, snapped to the sample grid).
+    """
+    jump = max(step_sec, suppress_window_sec)
+    out: List[float] = []
+    next_allowed = -np.inf
+    for i in np.flatnonzero(is_match):
+        t = float(times[i])
+        if t >= next_allowed - 1e-6:
+            out.append(t)
+            next_allowed = t + jump
     return out
 
 
-def scan_ad_positions(video_path: Path, ref_hash: int, step_sec: float, threshold_bits: int, suppress_window_sec: float) -> List[float]:
-    cap = cv2.VideoCapture(str(video_path))
-    if not cap.isOpened():
-        return []
-    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / max(1.0, cap.get(cv2.CAP_PROP_FPS))
-    t = 0.0
-    matches: List[float] = []
-    while t <= max(0.0, duration):
-        cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000.0)
-        ok, frame = cap.read()
-        if not ok or frame is None:
-            t += step_sec
-            continue
-        h = average_hash_from_frame(frame)
-        d = hamming64(h, ref_hash)
-        if d <= threshold_bits:
-            matches.append(t)
-            t = t + max(step_sec, suppress_window_sec)
-            continue
-        t += step_sec
-    cap.release()
+def scan_ad_positions(video_path: Path, ref_hash: int, step_sec: float, threshold_bits: int, suppress_window_sec: float,
+                      timeline: Timeline | None = None) -> List[float]:
+    times, hashes = timeline if timeline is not None else collect_hashes(video_path, step_sec)
+    matches = match_times(times, frame_hash.hamming(hashes, ref_hash) <= threshold_bits, step_sec, suppress_window_sec)
     matches.sort()
     dedup: List[float] = []
     for mt in matches:
@@ -180,108 +425,498 @@ def scan_ad_positions(video_path: Path, ref_hash: int, step_sec: float, threshol
     return dedup
 
 
+_MOV_ENCODE_ARGS = [
+    '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
+    '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart',
+]
+
+
 def cut_segment_to_mov(input_file: Path, start_sec: float, end_sec: float, output_file: Path) -> None:
     if end_sec <= start_sec:
         return
+    cut_segments_to_mov(input_file, [(start_sec, end_sec, output_file)])
+
+
+def cut_segments_to_mov(input_file: Path, ranges: List[Tuple[float, float, Path]], per_run: int = 0) -> None:
+    """
+    Cut several (start, end, output) ranges of one input in a single ffmpeg run: each range is its own
+    input with input-side -ss/-t (seek, then read only that range) mapped to its own output, so the
+    recording is read about once instead of decoding from 0 up to every cut point.
+    per_run > 0 splits into runs of at most per_run outputs (bounds the number of live x264 encoders).
+    """
+    ranges = [(s, e, out) for s, e, out in ranges if e > s]
+    if not ranges:
+        return
+    per_run = per_run if per_run > 0 else len(ranges)
+    for i in range(0, len(ranges), per_run):
+        batch = ranges[i:i + per_run]
+        cmd = ['ffmpeg', '-y']
+        for start_sec, end_sec, _out in batch:
+            cmd += ['-ss', f'{start_sec:.3f}', '-t', f'{end_sec - start_sec:.3f}', '-i', str(input_file)]
+        for k, (_start, _end, output_file) in enumerate(batch):
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            cmd += ['-map', f'{k}:v:0', '-map', f'{k}:a:0?', *_MOV_ENCODE_ARGS, '-f', 'mov', str(output_file)]
+        # Progress time is per run, so it only identifies the output's duration for single-output runs
+        run_ffmpeg(cmd, output=batch[0][2] if len(batch) == 1 else None)
+
+
+# ================= Smart cut (keyframe-aware) =================
+# Stream-copy the GOPs fully inside [start, end], re-encode only the partial GOPs at both
+# edges, then concat the pieces into one avc1 track. avc1 carries a single SPS/PPS set (avcC, taken
+# from the first piece), so the pieces are only joined when the x264 edges produced exactly the
+# parameter sets of the copied source GOPs; the joined file must then decode cleanly end to end
+# (this also catches open GOPs, whose leading frames lose their references at the cut).
+# Anything else - non-H.264 sources, mismatched parameter sets, decode errors - falls back to
+# cut_segment_to_mov (full re-encode).
+SMART_CUT_CODECS = {'h264'}
+_X264_PROFILES = {'baseline', 'main', 'high', 'high10', 'high422', 'high444'}
+_packet_memo: dict = {}
+_stream_memo: dict = {}
+
+
+def probe_video_stream(input_path: str) -> dict:
+    key = _stat_key(input_path)
+    if key in _stream_memo:
+        return _stream_memo[key]
+    info = _probe_video_stream_uncached(input_path)
+    if key is not None:
+        _stream_memo[key] = info
+    return info
+
+
+def _probe_video_stream_uncached(input_path: str) -> dict:
+    try:
+        result = subprocess.run(
+            [
+                'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'stream=codec_name,profile,pix_fmt', '-of', 'json', input_path
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        streams = json.loads(result.stdout).get('streams') or [{}]
+        return streams[0]
+    except Exception:
+        return {}
+
+
+def probe_video_packets(input_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(all packet pts, keyframe pts) of the first video stream in seconds, sorted; read from packet flags, no decoding."""
+    st = os.stat(input_path)
+    key = (os.path.abspath(input_path), st.st_size, st.st_mtime)
+    if key in _packet_memo:
+        return _packet_memo[key]
+    try:
+        result = subprocess.run(
+            [
+                'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        pts, keys = [], []
+        for line in result.stdout.splitlines():
+            t, _, flags = line.strip().partition(',')
+            if t in ('', 'N/A'):
+                continue
+            pts.append(float(t))
+            if 'K' in flags:
+                keys.append(float(t))
+        packets = (np.sort(np.asarray(pts, dtype=np.float64)), np.unique(np.asarray(keys, dtype=np.float64)))
+    except Exception:
+        packets = (np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64))
+    _packet_memo[key] = packets
+    return packets
+
+
+def h264_parameter_sets(input_path: Path) -> frozenset | None:
+    """Distinct SPS/PPS NAL units of the first video stream (Annex B payloads); None if they cannot be read."""
+    try:
+        result = subprocess.run(
+            [
+                'ffmpeg', '-v', 'error', '-i', str(input_path), '-map', '0:v:0', '-c:v', 'copy',
+                '-bsf:v', 'h264_mp4toannexb,filter_units=pass_types=7-8', '-f', 'h264', 'pipe:1'
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+    except Exception:
+        return None
+    # 4-byte start codes leave one zero byte on the previous unit
+    units = frozenset(u.rstrip(b'\x00') for u in result.stdout.split(b'\x00\x00\x01'))
+    return frozenset(u for u in units if u) or None
+
+
+def decodes_cleanly(input_path: Path) -> bool:
+    """Decode every video frame; False on any decoder error (missing parameter sets, references, ...)."""
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-xerror', '-i', str(input_path), '-map', '0:v:0', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    return result.returncode == 0 and not result.stderr.strip()
+
+
+def _encode_piece(input_file: Path, start_sec: float, duration: float, out_ts: Path, stream: dict) -> None:
+    video = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', stream.get('pix_fmt') or 'yuv420p']
+    profile = str(stream.get('profile') or '').lower().replace(' ', '')
+    if profile in _X264_PROFILES:
+        video += ['-profile:v', profile]
+    run_ffmpeg([
+        'ffmpeg', '-y', '-ss', f'{start_sec:.6f}', '-i', str(input_file), '-t', f'{duration:.6f}',
+        '-map', '0:v:0', '-map', '0:a:0?', *video,
+        '-c:a', 'aac', '-b:a', '128k', '-f', 'mpegts', str(out_ts)
+    ])
+
+
+def _copy_piece(input_file: Path, start_sec: float, duration: float, n_frames: int, out_ts: Path) -> None:
+    # start_sec is a keyframe: nudge past float rounding so the seek lands on it, not on the previous one.
+    # -t alone overshoots with stream copy (cuts in decode order); -frames:v ends video exactly at the
+    # next keyframe (closed GOPs), -t still bounds the audio.
+    run_ffmpeg([
+        'ffmpeg', '-y', '-ss', f'{start_sec + 0.001:.6f}', '-i', str(input_file), '-t', f'{duration:.6f}',
+        '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy', '-frames:v', str(n_frames),
+        '-c:a', 'aac', '-b:a', '128k', '-avoid_negative_ts', 'make_zero', '-f', 'mpegts', str(out_ts)
+    ])
+
+
+def smart_cut_to_mov(input_file: Path, start_sec: float, end_sec: float, output_file: Path) -> None:
+    if end_sec <= start_sec:
+        return
+    stream = probe_video_stream(str(input_file))
+    if stream.get('codec_name') not in SMART_CUT_CODECS:
+        return cut_segment_to_mov(input_file, start_sec, end_sec, output_file)
+    packet_pts, keyframes = probe_video_packets(str(input_file))
+    inner = keyframes[(keyframes >= start_sec - 1e-3) & (keyframes <= end_sec + 1e-3)]
+    if len(inner) < 2:
+        # No whole GOP inside the range: nothing to copy
+        return cut_segment_to_mov(input_file, start_sec, end_sec, output_file)
+    copy_start, copy_end = float(inner[0]), float(inner[-1])
+
     output_file.parent.mkdir(parents=True, exist_ok=True)
-    cmd = [
-        'ffmpeg', '-y', '-i', str(input_file),
-        '-ss', f'{start_sec:.3f}', '-to', f'{end_sec:.3f}',
-        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
-        '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', str(output_file)
-    ]
-    run_ffmpeg(cmd)
+    with tempfile.TemporaryDirectory(prefix='smartcut_', dir=str(output_file.parent)) as td:
+        td_path = Path(td)
+        pieces: List[Path] = []
+        if copy_start - start_sec > 1e-3:
+            pieces.append(td_path / 'head.ts')
+            _encode_piece(input_file, start_sec, copy_start - start_sec, pieces[-1], stream)
+        pieces.append(td_path / 'middle.ts')
+        n_frames = int(np.count_nonzero((packet_pts >= copy_start - 1e-4) & (packet_pts < copy_end - 1e-4)))
+        _copy_piece(input_file, copy_start, copy_end - copy_start, n_frames, pieces[-1])
+        if end_sec - copy_end > 1e-3:
+            pieces.append(td_path / 'tail.ts')
+            _encode_piece(input_file, copy_end, end_sec - copy_end, pieces[-1], stream)
+
+        param_sets = {h264_parameter_sets(p) for p in pieces}
+        if len(param_sets) != 1 or None in param_sets:
+            print(f"[INFO] Smart cut {input_file.name} {start_sec:.2f}-{end_sec:.2f}s: re-encoded edges have other "
+                  f"SPS/PPS than the source, re-encoding the whole segment")
+            return cut_segment_to_mov(input_file, start_sec, end_sec, output_file)
+
+        list_file = td_path / 'pieces.txt'
+        list_file.write_text(''.join(f"file '{p.name}'\n" for p in pieces), encoding='utf-8')
+        run_ffmpeg([
+            'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', str(list_file),
+            '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart', '-f', 'mov', str(output_file)
+        ], output=output_file)
+
+    if not decodes_cleanly(output_file):
+        print(f"[INFO] Smart cut {input_file.name} {start_sec:.2f}-{end_sec:.2f}s: output does not decode cleanly, "
+              f"re-encoding the whole segment")
+        cut_segment_to_mov(input_file, start_sec, end_sec, output_file)
+
+
+def smart_trim_file(input_file: Path, output_file: Path, trim_head: float, trim_tail: float,
+                    duration: float | None = None) -> bool:
+    """trim_file(reencode=True) equivalent via smart cut (trim 0/0 = whole file)."""
+    duration = ffprobe_duration(str(input_file)) if duration is None else duration
+    if duration <= 0:
+        return False
+    start = max(0.0, float(trim_head))
+    end_time = max(0.0, duration - float(trim_tail))
+    if end_time <= start:
+        return False
+    smart_cut_to_mov(input_file, start, end_time, output_file)
+    return True
+# =========================================================
 
 
-def process_video_by_template(input_file: Path, output_dir: Path, template_file: Path, step_sec: float, threshold_bits: int, min_interval_sec: float, min_duration: float) -> List[Path]:
+def process_video_by_template(input_file: Path, output_dir: Path, template: TemplateSignature | Path, step_sec: float, threshold_bits: int, min_interval_sec: float, min_duration: float,
+                              timeline: Timeline | None = None, smart_cut: bool = False, segments_per_run: int = 0) -> List[Path]:
     created: List[Path] = []
-    tmpl_times, tmpl_hashes = collect_hashes(template_file, step_sec=max(0.25, step_sec))
-    if not tmpl_hashes:
-        return created
-    tmpl_hash = median_hash(tmpl_hashes)
-    tmpl_dur = ffprobe_duration(str(template_file))
-    if tmpl_dur <= 0:
-        tmpl_dur = max(1.0, len(tmpl_hashes) * max(0.25, step_sec))
+    if not isinstance(template, TemplateSignature):
+        template = load_template(template, step_sec)
+        if template is None:
+            return created
+    tmpl_dur = template.duration
 
     suppress = max(min_interval_sec, tmpl_dur * 0.8)
-    ad_positions = scan_ad_positions(input_file, tmpl_hash, step_sec=step_sec, threshold_bits=threshold_bits, suppress_window_sec=suppress)
+    ad_positions = scan_ad_positions(input_file, template.hash, step_sec=step_sec, threshold_bits=threshold_bits,
+                                     suppress_window_sec=suppress, timeline=timeline)
     if len(ad_positions) < 2:
         return created
 
-    seg_index = 1
+    planned: List[Tuple[float, float, Path]] = []
     for i in range(len(ad_positions) - 1):
         seg_start = ad_positions[i] + tmpl_dur
         seg_end = ad_positions[i + 1]
         if (seg_end - seg_start) < max(0.0, float(min_duration)):
             continue
-        out_name = build_out_name(input_file.stem, seg_index)
-        out_path = output_dir / out_name
-        cut_segment_to_mov(input_file, seg_start, seg_end, out_path)
-        if ffprobe_duration(str(out_path)) >= max(0.0, float(min_duration)):
+        # Temporary name; final names are numbered only over segments that pass the duration check
+        planned.append((seg_start, seg_end, output_dir / f".{input_file.stem}_cut_{i:03d}.mov.part"))
+    if not planned:
+        return created
+
+    if smart_cut:
+        for seg_start, seg_end, tmp_path in planned:
+            smart_cut_to_mov(input_file, seg_start, seg_end, tmp_path)
+    else:
+        cut_segments_to_mov(input_file, planned, per_run=segments_per_run)
+
+    cut_paths = [tmp_path for _start, _end, tmp_path in planned if tmp_path.exists()]
+    seg_index = 1
+    for tmp_path, duration in zip(cut_paths, probe_durations(cut_paths)):
+        if duration >= max(0.0, float(min_duration)):
+            out_path = output_dir / build_out_name(input_file.stem, seg_index)
+            os.replace(tmp_path, out_path)
             created.append(out_path)
             seg_index += 1
         else:
             try:
-                out_path.unlink()
+                tmp_path.unlink()
             except Exception:
                 pass
     return created
 
 
 # ================= NEW: Template Selection =================
-def count_ad_matches(video_path: Path, template_file: Path, step_sec: float, threshold_bits: int) -> int:
-    tmpl_times, tmpl_hashes = collect_hashes(template_file, step_sec=max(0.25, step_sec))
-    if not tmpl_hashes:
-        return 0
-    ref_hash = median_hash(tmpl_hashes)
-    tmpl_dur = ffprobe_duration(str(template_file))
-    if tmpl_dur <= 0:
-        tmpl_dur = max(1.0, len(tmpl_hashes) * max(0.25, step_sec))
-    suppress = max(10.0, tmpl_dur * 0.8)
+def score_templates(timeline: Timeline, templates: List[TemplateSignature], step_sec: float, threshold_bits: int) -> List[int]:
+    """Match count of every template on one timeline: a single [templates x frames] Hamming matrix."""
+    times, hashes = timeline
+    if not templates or len(hashes) == 0:
+        return [0] * len(templates)
+    is_match = frame_hash.hamming(hashes, np.array([t.hash for t in templates], dtype=np.uint64)) <= threshold_bits
+    return [len(match_times(times, row, step_sec, max(10.0, tmpl.duration * 0.8))) if row.any() else 0
+            for tmpl, row in zip(templates, is_match)]
 
-    cap = cv2.VideoCapture(str(video_path))
-    if not cap.isOpened():
+
+def count_ad_matches(video_path: Path, template_file: Path, step_sec: float, threshold_bits: int) -> int:
+    template = load_template(template_file, step_sec)
+    if template is None:
         return 0
-    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / max(1.0, cap.get(cv2.CAP_PROP_FPS))
-    t = 0.0
-    count = 0
-    while t <= duration:
-        cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000.0)
-        ok, frame = cap.read()
-        if not ok or frame is None:
-            t += step_sec
-            continue
-        h = average_hash_from_frame(frame)
-        if hamming64(h, ref_hash) <= threshold_bits:
-            count += 1
-            t += suppress
-            continue
-        t += step_sec
-    cap.release()
-    return count
+    return score_templates(collect_hashes(video_path, step_sec), [template], step_sec, threshold_bits)[0]
 
 
-def select_best_template(video_path: Path, template_files: List[Path], step_sec: float, threshold_bits: int) -> Path | None:
+def select_best_template(video_path: Path, templates: List[TemplateSignature], step_sec: float, threshold_bits: int,
+                         timeline: Timeline | None = None) -> TemplateSignature | None:
+    if timeline is None:
+        timeline = collect_hashes(video_path, step_sec)
     results = []
-    for tmpl in template_files:
-        try:
-            matches = count_ad_matches(video_path, tmpl, step_sec, threshold_bits)
-            if matches > 0:
-                results.append((matches, tmpl))
-                print(f"  [Template Test] {tmpl.name}: {matches} match(es)")
-        except Exception as e:
-            print(f"  [Template Error] {tmpl.name}: {e}", file=sys.stderr)
+    for tmpl, matches in zip(templates, score_templates(timeline, templates, step_sec, threshold_bits)):
+        if matches > 0:
+            results.append((matches, tmpl))
+            print(f"  [Template Test] {tmpl.path.name}: {matches} match(es)")
 
     if not results:
         return None
-    results.sort(key=lambda x: (-x[0], x[1].name))
+    results.sort(key=lambda x: (-x[0], x[1].path.name))
     best = results[0][1]
-    print(f"  [Selected] {best.name} with {results[0][0]} match(es)")
+    print(f"  [Selected] {best.path.name} with {results[0][0]} match(es)")
     return best
 # =========================================================
 
 
-def process_video(input_file: Path, output_dir: Path, segment_seconds: float, trim_head: float, trim_tail: float, reencode: bool, min_duration: float) -> list[Path]:
+# ================= Template signature library =================
+# `segment_videos.py templates build --template-dir DIR` hashes every template once into
+# DIR/templates.sig.json (median hash, per-frame hashes, duration, plus `browser_hash` computed like
+# the web frontend's canvas hash); hashes are 16-char hex so the web backend/frontend can read them
+# as BigInt without decoding any video.
+TEMPLATE_LIBRARY_NAME = 'templates.sig.json'
+TEMPLATE_LIBRARY_VERSION = 1
+
+
+def _hash_hex(h) -> str:
+    return f"{int(h):016x}"
+
+
+def _file_stamp(path: Path) -> Tuple[int, float]:
+    st = path.stat()
+    return st.st_size, st.st_mtime
+
+
+def browser_template_hash(path: Path, duration: float) -> int | None:
+    """Template hash as the web frontend computes it (frames at 20/40/60/80% of the duration); None if unreadable."""
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        return None
+    hashes = []
+    try:
+        for frac in frame_hash.CANVAS_SAMPLE_FRACTIONS:
+            cap.set(cv2.CAP_PROP_POS_MSEC, max(0.1, duration) * frac * 1000.0)
+            ok, frame = cap.read()
+            if ok and frame is not None:
+                hashes.append(frame_hash.canvas_hash(frame))
+    finally:
+        cap.release()
+    return frame_hash.canvas_majority_hash(hashes) if hashes else None
+
+
+def build_template_library(template_files: List[Path], step_sec: float, output_file: Path,
+                           decoder: str = DEFAULT_DECODER) -> List[TemplateSignature]:
+    entries = []
+    signatures: List[TemplateSignature] = []
+    probe_durations(list(template_files))  # one batched probe; load_template then hits the memo
+    for tmpl_path in sorted(template_files, key=lambda p: p.name):
+        try:
+            sig = load_template(tmpl_path, step_sec, decoder)
+        except Exception as e:
+            print(f"  [Template Error] {tmpl_path.name}: {e}", file=sys.stderr)
+            continue
+        if sig is None:
+            print(f"  [Template Error] {tmpl_path.name}: no decodable frames", file=sys.stderr)
+            continue
+        size, mtime = _file_stamp(tmpl_path)
+        browser_hash = browser_template_hash(tmpl_path, sig.duration)
+        entries.append({
+            'name': tmpl_path.name,
+            'path': str(tmpl_path),
+            'size': size,
+            'mtime': mtime,
+            'duration': sig.duration,
+            'hash': _hash_hex(sig.hash),
+            'hashes': [_hash_hex(h) for h in sig.hashes],
+            'browser_hash': _hash_hex(browser_hash) if browser_hash is not None else None,
+        })
+        signatures.append(sig)
+        print(f"  [Template] {tmpl_path.name}: {len(sig.hashes)} frame(s), {sig.duration:.2f}s, hash {_hash_hex(sig.hash)}")
+
+    library = {
+        'version': TEMPLATE_LIBRARY_VERSION,
+        'step_sec': max(0.25, step_sec),
+        'decoder': decoder,
+        'built_at': time.time(),
+        'templates': entries,
+    }
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output_file.with_name(output_file.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(library, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, output_file)
+    return signatures
+
+
+def load_template_library(library_file: Path, step_sec: float, decoder: str = DEFAULT_DECODER) -> dict:
+    """
+    {template file name: (size, mtime, TemplateSignature)}; empty if missing/unreadable or built
+    with another decoder or --detect-step (per-frame hashes and durations depend on both).
+    """
+    try:
+        with open(library_file, 'r', encoding='utf-8') as f:
+            library = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if library.get('version') != TEMPLATE_LIBRARY_VERSION:
+        return {}
+    if library.get('decoder', 'opencv') != decoder:
+        print(f"[INFO] Template library {library_file.name} was built with --decoder {library.get('decoder', 'opencv')}, ignoring it")
+        return {}
+    try:
+        lib_step = float(library.get('step_sec'))
+    except (TypeError, ValueError):
+        return {}
+    if abs(lib_step - max(0.25, step_sec)) > 1e-6:
+        print(f"[INFO] Template library {library_file.name} was built with --detect-step {lib_step:g}, ignoring it")
+        return {}
+    out = {}
+    for e in library.get('templates', []):
+        sig = TemplateSignature(
+            Path(e['path']), int(e['hash'], 16), float(e['duration']),
+            np.array([int(h, 16) for h in e.get('hashes', [])], dtype=np.uint64),
+        )
+        out[e['name']] = (int(e['size']), float(e['mtime']), sig)
+    return out
+
+
+def _library_signature(library: dict, tmpl_path: Path) -> TemplateSignature | None:
+    """Library signature of tmpl_path if the file is unchanged (size + mtime), else None."""
+    entry = library.get(tmpl_path.name)
+    if entry is None:
+        return None
+    size, mtime, sig = entry
+    cur_size, cur_mtime = _file_stamp(tmpl_path)
+    if size == cur_size and abs(mtime - cur_mtime) < 1e-3:
+        return sig._replace(path=tmpl_path)
+    return None
+
+
+def resolve_templates(template_files: List[Path], step_sec: float, library_file: Path | None,
+                      decoder: str = DEFAULT_DECODER) -> List[TemplateSignature]:
+    """Signatures from the library when the template file is unchanged (size + mtime), otherwise hash it now."""
+    library = load_template_library(library_file, step_sec, decoder) if library_file is not None else {}
+    cached = {p: _library_signature(library, p) for p in template_files}
+    probe_durations([p for p, sig in cached.items() if sig is None])
+    templates: List[TemplateSignature] = []
+    stale = 0
+    for tmpl_path in template_files:
+        if cached[tmpl_path] is not None:
+            templates.append(cached[tmpl_path])
+            continue
+        if library:
+            stale += 1
+        try:
+            sig = load_template(tmpl_path, step_sec, decoder)
+        except Exception as e:
+            print(f"  [Template Error] {tmpl_path.name}: {e}", file=sys.stderr)
+            continue
+        if sig is None:
+            print(f"  [Template Error] {tmpl_path.name}: no decodable frames", file=sys.stderr)
+            continue
+        templates.append(sig)
+    if library:
+        print(f"[INFO] Template library {library_file.name}: {len(template_files) - stale} loaded, {stale} re-hashed"
+              + (" (run 'templates build' to refresh)" if stale else ""))
+    return templates
+
+
+def list_template_files(template_dir: Path) -> List[Path]:
+    return [p for p in template_dir.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_EXTS]
+
+
+def templates_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog='segment_videos.py templates', description='Manage the template signature library.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help=f'Hash all templates into {TEMPLATE_LIBRARY_NAME}')
+    build.add_argument('--template-dir', required=True, help='Folder of template files')
+    build.add_argument('--output', type=str, default='', help=f'Library file (default: <template-dir>/{TEMPLATE_LIBRARY_NAME})')
+    build.add_argument('--detect-step', type=float, default=0.5, help='Frame sampling interval for templates')
+    build.add_argument('--decoder', choices=DECODERS, default=DEFAULT_DECODER, help='Hash decoder (must match segmenting runs)')
+    args = parser.parse_args(argv)
+
+    tmpl_dir = Path(args.template_dir).expanduser().resolve()
+    if not tmpl_dir.is_dir():
+        print(f"ERROR: Template dir not found: {tmpl_dir}", file=sys.stderr)
+        sys.exit(1)
+    template_files = list_template_files(tmpl_dir)
+    if not template_files:
+        print(f"ERROR: No video files in template dir: {tmpl_dir}", file=sys.stderr)
+        sys.exit(1)
+    output_file = Path(args.output).expanduser().resolve() if args.output else tmpl_dir / TEMPLATE_LIBRARY_NAME
+    if args.decoder == 'ffmpeg':
+        require_ffmpeg()
+    signatures = build_template_library(template_files, float(args.detect_step), output_file, args.decoder)
+    print(f"Done. {len(signatures)}/{len(template_files)} template(s) -> {output_file}")
+# =========================================================
+
+
+def process_video(input_file: Path, output_dir: Path, segment_seconds: float, trim_head: float, trim_tail: float, reencode: bool, min_duration: float,
+                  smart_cut: bool = False) -> list[Path]:
     created: list[Path] = []
     if segment_seconds and segment_seconds > 0:
         with tempfile.TemporaryDirectory(prefix='seg_') as td:
@@ -289,14 +924,16 @@ def process_video(input_file: Path, output_dir: Path, segment_seconds: float, tr
             parts = split_file(input_file, td_path, segment_seconds)
             if not parts:
                 return created
-            for idx, part in enumerate(parts, start=1):
-                duration = ffprobe_duration(str(part))
+            for idx, (part, duration) in enumerate(zip(parts, probe_durations(parts)), start=1):
                 if duration <= 0:
                     continue
                 out_name = build_out_name(input_file.stem, idx)
                 out_path = output_dir / out_name
-                if trim_head or trim_tail:
-                    ok = trim_file(part, out_path, trim_head, trim_tail, True)
+                if smart_cut:
+                    if not smart_trim_file(part, out_path, trim_head, trim_tail, duration=duration):
+                        continue
+                elif trim_head or trim_tail:
+                    ok = trim_file(part, out_path, trim_head, trim_tail, True, duration=duration)
                     if not ok:
                         continue
                 else:
@@ -311,7 +948,11 @@ def process_video(input_file: Path, output_dir: Path, segment_seconds: float, tr
     else:
         out_name = build_out_name(input_file.stem, 1)
         out_path = output_dir / out_name
-        if trim_head or trim_tail:
+        if smart_cut:
+            ok = smart_trim_file(input_file, out_path, trim_head, trim_tail)
+            if ok and ffprobe_duration(str(out_path)) >= max(0.0, float(min_duration)):
+                created.append(out_path)
+        elif trim_head or trim_tail:
             ok = trim_file(input_file, out_path, trim_head, trim_tail, True)
             if ok and ffprobe_duration(str(out_path)) >= max(0.0, float(min_duration)):
                 created.append(out_path)
@@ -330,7 +971,51 @@ def iter_videos(input_dir: Path):
                 yield Path(root) / name
 
 
+def segment_one(video_path: Path, out_dir: Path, args: argparse.Namespace, templates: List[TemplateSignature]) -> List[Path] | None:
+    """Segment one input (template mode if templates, else fixed-length); None = skipped, no template matched."""
+    if not templates:
+        return process_video(
+            video_path, out_dir,
+            args.segment_duration, args.trim_head, args.trim_tail,
+            args.reencode, args.min_duration,
+            smart_cut=args.smart_cut,
+        )
+
+    step_sec = max(0.25, float(args.detect_step))
+    threshold_bits = max(0, min(64, int(args.detect_threshold)))
+    hash_cache_dir = None if args.hash_cache_sidecar else Path(args.hash_cache_dir).expanduser().resolve()
+    # One decode pass per input: template selection and ad scanning share this timeline
+    timeline = get_timeline(video_path, step_sec, cache_dir=hash_cache_dir,
+                            use_cache=not args.no_hash_cache, decoder=args.decoder)
+    if len(templates) == 1:
+        best_template = templates[0]
+    else:
+        best_template = select_best_template(
+            video_path, templates,
+            step_sec=step_sec,
+            threshold_bits=threshold_bits,
+            timeline=timeline,
+        )
+        if not best_template:
+            return None
+
+    return process_video_by_template(
+        video_path, out_dir, best_template,
+        step_sec=step_sec,
+        threshold_bits=threshold_bits,
+        min_interval_sec=max(0.1, float(args.detect_min_gap)),
+        min_duration=float(args.min_duration),
+        timeline=timeline,
+        smart_cut=args.smart_cut,
+        segments_per_run=max(0, int(args.segments_per_run)),
+    )
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'templates':
+        templates_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='Segment videos by detecting ad/logo clips.')
     parser.add_argument('--input', required=True, help='Input file or folder')
     parser.add_argument('--output', required=True, help='Output folder')
@@ -339,13 +1024,26 @@ def main():
     parser.add_argument('--trim-tail', type=float, default=0.0, help='Trim end of each segment')
     parser.add_argument('--min-duration', type=float, default=0.5, help='Drop short clips')
     parser.add_argument('--reencode', action='store_true', help='Re-encode for precision')
+    parser.add_argument('--segments-per-run', type=int, default=8, help='Template segments cut per ffmpeg run (0 = all in one run)')
+    parser.add_argument('--smart-cut', action='store_true', help='Stream-copy whole GOPs, re-encode only partial GOPs at cut points (H.264 sources)')
 
     parser.add_argument('--template', type=str, default='', help='Single template file')
     parser.add_argument('--template-dir', type=str, default='', help='Folder of template files (auto-select best)')
+    parser.add_argument('--template-lib', type=str, default='', help=f'Template signature library (default: {TEMPLATE_LIBRARY_NAME} next to the templates)')
 
     parser.add_argument('--detect-step', type=float, default=0.5, help='Frame scan interval')
     parser.add_argument('--detect-threshold', type=int, default=50, help='Hamming distance threshold')
     parser.add_argument('--detect-min-gap', type=float, default=120.0, help='Min gap between ads')
+    parser.add_argument('--decoder', choices=DECODERS, default=DEFAULT_DECODER, help='Hash decoder: opencv seek + full decode (default), or ffmpeg pipe of 8x8 gray frames '
+                             '(faster; hashes differ by a few bits, so recheck --detect-threshold)')
+    parser.add_argument('--hash-cache-dir', type=str, default=str(default_hash_cache_dir()),
+                        help='Folder for hash timeline cache (default: %(default)s)')
+    parser.add_argument('--hash-cache-sidecar', action='store_true',
+                        help='Store the hash timeline cache as hidden .<name>.ahash_*.npz files next to each input instead')
+    parser.add_argument('--no-hash-cache', action='store_true', help='Always re-decode inputs, do not read/write the hash timeline cache')
+
+    parser.add_argument('--jobs', type=int, default=1, help='Process N input videos in parallel')
+    parser.add_argument('--max-encodes', type=int, default=0, help='Max concurrent ffmpeg encodes across jobs (default: jobs/2)')
 
     args = parser.parse_args()
 
@@ -371,7 +1069,7 @@ def main():
         if not tmpl_dir.is_dir():
             print(f"ERROR: Template dir not found: {tmpl_dir}", file=sys.stderr)
             sys.exit(1)
-        template_files = [p for p in tmpl_dir.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_EXTS]
+        template_files = list_template_files(tmpl_dir)
         if not template_files:
             print(f"ERROR: No video files in template dir: {tmpl_dir}", file=sys.stderr)
             sys.exit(1)
@@ -399,44 +1097,63 @@ def main():
         for video_path in iter_videos(in_path):
             to_process.append(video_path)
 
-    total_inputs = total_outputs = 0
-
-    for video_path in to_process:
-        total_inputs += 1
-        try:
-            if use_template:
-                if len(template_files) == 1:
-                    best_template = template_files[0]
-                else:
-                    best_template = select_best_template(
-                        video_path, template_files,
-                        step_sec=max(0.25, float(args.detect_step)),
-                        threshold_bits=max(0, min(64, int(args.detect_threshold)))
-                    )
-                    if not best_template:
-                        print(f'[SKIP] {video_path.name}: No template matched', file=sys.stderr)
-                        continue
-
-                outputs = process_video_by_template(
-                    video_path, out_dir, best_template,
-                    step_sec=max(0.25, float(args.detect_step)),
-                    threshold_bits=max(0, min(64, int(args.detect_threshold))),
-                    min_interval_sec=max(0.1, float(args.detect_min_gap)),
-                    min_duration=float(args.min_duration),
-                )
-            else:
-                outputs = process_video(
-                    video_path, out_dir,
-                    args.segment_duration, args.trim_head, args.trim_tail,
-                    args.reencode, args.min_duration
-                )
+    step_sec = max(0.25, float(args.detect_step))
+    # Templates are hashed once per run (or loaded from the signature library), not once per input video
+    templates: List[TemplateSignature] = []
+    if use_template:
+        if args.template_lib:
+            library_file = Path(args.template_lib).expanduser().resolve()
+        else:
+            library_file = template_files[0].parent / TEMPLATE_LIBRARY_NAME
+        templates = resolve_templates(template_files, step_sec, library_file, args.decoder)
+    if use_template and not templates:
+        print("ERROR: No usable template.", file=sys.stderr)
+        sys.exit(1)
 
+    jobs = max(1, int(args.jobs))
+    max_encodes = max(1, int(args.max_encodes or max(1, jobs // 2)))
+    total_inputs = total_outputs = 0
+    failed: List[str] = []
+
+    def _report(video_path: Path, outputs: List[Path] | None, error: str | None) -> None:
+        nonlocal total_outputs
+        if error is not None:
+            failed.append(video_path.name)
+            print(f'[ERR] {video_path.name}: {error}', file=sys.stderr)
+        elif outputs is None:
+            print(f'[SKIP] {video_path.name}: No template matched', file=sys.stderr)
+        else:
             total_outputs += len(outputs)
             print(f'[OK] {video_path.name} -> {len(outputs)} file(s)')
-        except Exception as e:
-            print(f'[ERR] {video_path.name}: {e}', file=sys.stderr)
+
+    if jobs == 1 or len(to_process) <= 1:
+        for video_path in to_process:
+            total_inputs += 1
+            try:
+                outputs = segment_one(video_path, out_dir, args, templates)
+            except Exception as e:
+                _report(video_path, None, str(e))
+                continue
+            _report(video_path, outputs, None)
+    else:
+        # Each input runs in its own process (errors stay per video); ffmpeg runs share max_encodes slots
+        print(f"[INFO] {len(to_process)} video(s) on {jobs} worker(s), max {max_encodes} concurrent ffmpeg encode(s)")
+        slots = multiprocessing.Semaphore(max_encodes)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_encode_slots, initargs=(slots,)) as pool:
+            futures = {pool.submit(segment_one, video_path, out_dir, args, templates): video_path for video_path in to_process}
+            for fut in as_completed(futures):
+                total_inputs += 1
+                video_path = futures[fut]
+                try:
+                    outputs = fut.result()
+                except Exception as e:
+                    _report(video_path, None, str(e) or type(e).__name__)
+                    continue
+                _report(video_path, outputs, None)
 
     print(f'Done. Processed {total_inputs} videos -> {total_outputs} outputs into {out_dir}')
+    if failed:
+        print(f'Failed ({len(failed)}): {", ".join(sorted(failed))}', file=sys.stderr)
 
 
 if __name__ == '__main__':
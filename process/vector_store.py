@@ -0,0 +1,698 @@
+"""
+Lưu trữ vector theo generation bất biến:
+- generations/gen_XXXXXX/: manifest.json + file mới của lần ghi đó (base.faiss + base_vectors.npy
+  khi create/compaction, delta.npy khi update); đã publish thì không bao giờ bị sửa
+- CURRENT: tên generation đang dùng, đổi bằng 1 phép rename (ghi tạm rồi os.replace)
+- metadata: SQLite (metadata_store), key = FAISS row id, mỗi lần create dùng 1 DB mới
+Reader mở base index bằng FAISS mmap và ghép thêm delta; compaction gộp delta vào base định kỳ.
+"""
+import os
+import json
+import time
+import shutil
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import faiss
+import config
+import metadata_store
+import index_factory
+from metadata_store import MetadataView
+
+MANIFEST_VERSION = 2
+_write_lock = threading.RLock()  # tuần tự hóa các thao tác ghi trong cùng process
+_file_lock = {'depth': 0, 'file': None}  # lock file giữa các process, giữ bởi thread đang có _write_lock
+_GEN_PREFIX = "gen_"
+WRITE_LOCK_NAME = ".write.lock"
+
+
+def _lock_file(f):
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)   # tự thử lại ~10s rồi báo lỗi
+                return
+            except OSError:
+                continue
+    import fcntl
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(f):
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def writer_lock():
+    """
+    Lock ghi của store: RLock trong process + lock file VECTOR_FOLDER/.write.lock giữa các process
+    (API ingest/compaction, CLI extract_features --mode update, vector_store --compact).
+    Bao trọn đọc manifest → ghi file → publish nên không writer nào publish đè generation của writer khác.
+    """
+    with _write_lock:
+        if _file_lock['depth'] == 0:
+            os.makedirs(config.VECTOR_FOLDER, exist_ok=True)
+            f = open(os.path.join(config.VECTOR_FOLDER, WRITE_LOCK_NAME), 'a+b')
+            try:
+                _lock_file(f)
+            except BaseException:
+                f.close()
+                raise
+            _file_lock['file'] = f
+        _file_lock['depth'] += 1
+        try:
+            yield
+        finally:
+            _file_lock['depth'] -= 1
+            if _file_lock['depth'] == 0:
+                f, _file_lock['file'] = _file_lock['file'], None
+                try:
+                    _unlock_file(f)
+                finally:
+                    f.close()
+
+
+# ======================================================
+# 📄 Generation + manifest
+# ======================================================
+# Mỗi lần ghi tạo 1 thư mục generations/gen_XXXXXX/ (không bao giờ sửa lại) chứa
+# manifest.json + file mới của lần ghi đó; file CURRENT (ghi tạm rồi os.replace)
+# trỏ tới generation đang dùng. Đường dẫn trong manifest tương đối với VECTOR_FOLDER.
+def _empty_manifest(base_count=0, dim=None, index_type=None):
+    return {'version': MANIFEST_VERSION, 'generation': None, 'base_count': base_count, 'dim': dim,
+            'index_type': index_type, 'base_index': None, 'base_vectors': None, 'base_sequences': None,
+            'deltas': [], 'metadata_db': None}
+
+
+def _abs(rel_path):
+    return os.path.join(config.VECTOR_FOLDER, rel_path) if rel_path else None
+
+
+def _rel(path):
+    return os.path.relpath(path, config.VECTOR_FOLDER)
+
+
+def _gen_number(name):
+    try:
+        return int(name[len(_GEN_PREFIX):]) if name and name.startswith(_GEN_PREFIX) else None
+    except ValueError:
+        return None
+
+
+def _read_current():
+    try:
+        with open(config.CURRENT_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _read_generation_manifest(name):
+    with open(os.path.join(config.GENERATIONS_FOLDER, name, "manifest.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_manifest():
+    """
+    Manifest của generation hiện tại (base_count=None nếu chưa có store).
+    Store cũ chưa migrate được đọc tại chỗ (generation=None); reader không bao giờ publish generation.
+    """
+    name = _read_current()
+    if name is None:
+        return _legacy_manifest() or _empty_manifest(base_count=None)
+    return _read_generation_manifest(name)
+
+
+def _atomic_write_bytes(path, write_fn):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _atomic_write_json(path, obj):
+    data = json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    _atomic_write_bytes(path, lambda f: f.write(data))
+
+
+def _new_generation_dir():
+    """Tạo thư mục generation kế tiếp (số lớn nhất hiện có + 1, kể cả generation đang ghi dở)."""
+    os.makedirs(config.GENERATIONS_FOLDER, exist_ok=True)
+    while True:
+        numbers = [n for n in map(_gen_number, os.listdir(config.GENERATIONS_FOLDER)) if n is not None]
+        name = f"{_GEN_PREFIX}{max(numbers, default=0) + 1:06d}"
+        path = os.path.join(config.GENERATIONS_FOLDER, name)
+        try:
+            os.makedirs(path)
+            return name, path
+        except FileExistsError:
+            continue  # process khác vừa lấy số này
+
+
+_ANY_PARENT = object()
+
+
+def _publish(manifest, name, parent=_ANY_PARENT):
+    """
+    Commit generation: ghi manifest vào thư mục của nó rồi đổi con trỏ CURRENT (1 phép rename).
+    parent: generation mà writer đã đọc làm gốc; nếu CURRENT đã đổi (writer khác publish giữa chừng)
+    thì hủy thay vì publish đè làm mất dữ liệu của writer kia.
+    """
+    current = _read_current()
+    if parent is not _ANY_PARENT and current != parent:
+        shutil.rmtree(os.path.join(config.GENERATIONS_FOLDER, name), ignore_errors=True)
+        raise RuntimeError(f"CURRENT đã đổi từ {parent} sang {current} trong lúc ghi {name}, hủy publish")
+    manifest = dict(manifest, version=MANIFEST_VERSION, generation=name, created=time.time())
+    _atomic_write_json(os.path.join(config.GENERATIONS_FOLDER, name, "manifest.json"), manifest)
+    _atomic_write_bytes(config.CURRENT_FILE, lambda f: f.write(name.encode('utf-8')))
+    print(f"[INDEX] Đã publish generation {name}")
+    _gc_generations()
+    return manifest
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def _legacy_manifest():
+    """Manifest trỏ thẳng vào file của store cũ (video_features.faiss + manifest.json/segments), chỉ đọc."""
+    if not os.path.exists(config.FEATURES_FILE):
+        return None
+    legacy = {}
+    if os.path.exists(config.MANIFEST_FILE):
+        with open(config.MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+    base_count, dim = legacy.get('base_count'), legacy.get('dim')
+    if base_count is None or dim is None:
+        base = _read_index_mmap(config.FEATURES_FILE)
+        base_count, dim = base.ntotal, base.d
+    manifest = _empty_manifest(base_count=base_count, dim=dim, index_type=legacy.get('index_type') or 'flat')
+    manifest['base_index'] = _rel(config.FEATURES_FILE)
+    if os.path.exists(config.VECTORS_FILE) and len(np.load(config.VECTORS_FILE, mmap_mode='r')) == base_count:
+        manifest['base_vectors'] = _rel(config.VECTORS_FILE)
+    for entry in legacy.get('deltas', []):
+        manifest['deltas'].append({'name': entry['name'],
+                                   'path': _rel(os.path.join(config.SEGMENTS_FOLDER, f"{entry['name']}.npy")),
+                                   'count': entry['count'], 'created': entry.get('created', time.time())})
+    manifest['metadata_db'] = _rel(config.METADATA_DB)
+    return manifest
+
+
+def migrate_legacy_layout():
+    """
+    Store cũ → generation đầu tiên (chỉ gọi từ phía ghi: append/compact, hoặc --migrate).
+    File cũ được hard-link (hoặc copy) nên không sửa gì tới dữ liệu cũ.
+    Trả về tên generation hiện tại, None nếu không có store nào.
+    """
+    with writer_lock():
+        name = _read_current()
+        if name is not None:
+            return name
+        manifest = _legacy_manifest()
+        if manifest is None:
+            return None
+        metadata_store.get_store(config.METADATA_DB)  # migrate pickle → SQLite nếu cần
+
+        name, gen_dir = _new_generation_dir()
+        manifest['base_index'] = _rel(_link_or_copy(_abs(manifest['base_index']), os.path.join(gen_dir, "base.faiss")))
+        if manifest['base_vectors']:
+            manifest['base_vectors'] = _rel(_link_or_copy(_abs(manifest['base_vectors']),
+                                                          os.path.join(gen_dir, "base_vectors.npy")))
+        for entry in manifest['deltas']:
+            entry['path'] = _rel(_link_or_copy(_abs(entry['path']), os.path.join(gen_dir, f"{entry['name']}.npy")))
+        print(f"[INDEX] Chuyển store cũ sang generation {name}")
+        _publish(manifest, name, parent=None)
+        return name
+
+
+def _manifest_files(manifest):
+    files = [manifest.get('base_index'), manifest.get('base_vectors'), manifest.get('metadata_db')]
+    files += [d['path'] for d in manifest.get('deltas', [])]
+    for seq in [manifest.get('base_sequences')] + [d.get('sequences') for d in manifest.get('deltas', [])]:
+        files += list((seq or {}).values())
+    return {f for f in files if f}
+
+
+def _gc_generations():
+    """Xóa generation (và metadata DB) không còn được GENERATION_KEEP generation gần nhất tham chiếu."""
+    current = _gen_number(_read_current())
+    if current is None:
+        return
+    names = sorted((n for n in os.listdir(config.GENERATIONS_FOLDER) if _gen_number(n) is not None), key=_gen_number)
+    kept = [n for n in names if _gen_number(n) <= current][-max(1, config.GENERATION_KEEP):]
+    referenced = set()
+    for n in kept:
+        try:
+            referenced |= _manifest_files(_read_generation_manifest(n))
+        except (OSError, ValueError):
+            continue
+    referenced_dirs = {os.path.normpath(os.path.dirname(_abs(p))) for p in referenced}
+    for n in names:
+        path = os.path.normpath(os.path.join(config.GENERATIONS_FOLDER, n))
+        # Generation số lớn hơn CURRENT đang được process khác ghi: không đụng tới
+        if _gen_number(n) < current and n not in kept and path not in referenced_dirs:
+            shutil.rmtree(path, ignore_errors=True)
+    if os.path.isdir(config.METADATA_FOLDER):
+        referenced_dbs = {os.path.basename(p) for p in referenced}
+        for fname in os.listdir(config.METADATA_FOLDER):
+            db_name = fname.split('.sqlite')[0] + '.sqlite'  # kèm file -wal / -shm
+            n = _gen_number(db_name[len("metadata_"):-len(".sqlite")])
+            if n is not None and n < current and db_name not in referenced_dbs:
+                try:
+                    os.remove(os.path.join(config.METADATA_FOLDER, fname))
+                except OSError:
+                    pass
+
+
+def store_version():
+    """Tên generation hiện tại, đổi sau mỗi lần commit (dùng để phát hiện reload)."""
+    return _read_current() or read_manifest().get('generation')
+
+
+def current_files(manifest=None):
+    """Đường dẫn tuyệt đối (generation, index, metadata DB) của generation hiện tại."""
+    manifest = manifest or read_manifest()
+    return {'generation': manifest.get('generation'),
+            'index_file': _abs(manifest.get('base_index')),
+            'metadata_file': _abs(manifest.get('metadata_db'))}
+
+
+def has_base():
+    return read_manifest().get('base_index') is not None
+
+
+def committed_count(manifest=None):
+    """Số vector đã commit (base + delta), None nếu chưa có store."""
+    manifest = manifest or read_manifest()
+    if manifest.get('base_count') is None:
+        return None
+    return manifest['base_count'] + sum(d['count'] for d in manifest.get('deltas', []))
+
+
+def _read_index_mmap(path):
+    """
+    Mở index bằng memory-mapped I/O (load gần như tức thì, page được chia sẻ giữa các process).
+    Loại index không hỗ trợ mmap (vd. IVF) thì đọc bình thường.
+    """
+    flags = []
+    if hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        flags.append(faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    flags.append(faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    for flag in flags:
+        try:
+            return faiss.read_index(path, flag)
+        except RuntimeError:
+            continue
+    return faiss.read_index(path)
+
+
+# ======================================================
+# 🔎 Index ghép base + delta
+# ======================================================
+class SegmentedIndex:
+    """
+    Index chỉ đọc, ghép base index với 1 IndexFlatIP nhỏ chứa vector delta.
+    search() trả về (D, I) giống FAISS, id của delta nối tiếp sau base.
+    """
+
+    def __init__(self, base, delta_vectors=None):
+        self.base = base
+        self.d = base.d
+        self.delta = None
+        if delta_vectors is not None and len(delta_vectors):
+            self.delta = faiss.IndexFlatIP(self.d)
+            self.delta.add(np.ascontiguousarray(delta_vectors, dtype='float32'))
+        self.base_count = base.ntotal
+        self.ntotal = base.ntotal + (self.delta.ntotal if self.delta is not None else 0)
+
+    def search(self, x, k):
+        D, I = self.base.search(x, k)
+        if self.delta is None:
+            return D, I
+        D2, I2 = self.delta.search(x, k)
+        I2 = np.where(I2 >= 0, I2 + self.base_count, -1)
+        D_all = np.concatenate([D, D2], axis=1)
+        I_all = np.concatenate([I, I2], axis=1)
+        D_all = np.where(I_all >= 0, D_all, -np.inf)
+        order = np.argsort(-D_all, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(D_all, order, axis=1), np.take_along_axis(I_all, order, axis=1)
+
+
+def _load_deltas(manifest):
+    vectors = [np.load(_abs(entry['path']), mmap_mode='r') for entry in manifest.get('deltas', [])]
+    return np.concatenate(vectors) if vectors else None
+
+
+def _load_once():
+    manifest = read_manifest()
+    if manifest.get('base_index') is None:
+        raise FileNotFoundError(f"Chưa có index trong {config.VECTOR_FOLDER}")
+    base = _read_index_mmap(_abs(manifest['base_index']))
+    if base.ntotal != manifest['base_count']:
+        raise RuntimeError(f"base không khớp manifest (index={base.ntotal}, manifest={manifest['base_count']})")
+    index = SegmentedIndex(index_factory.apply_search_params(base), _load_deltas(manifest))
+    store = metadata_store.get_store(_abs(manifest['metadata_db']))
+    # Metadata: chỉ nhìn thấy các row id < ntotal của generation vừa load
+    return index, MetadataView(store, index.ntotal), manifest
+
+
+def load_generation(retries=5):
+    """
+    Load (index, metadata, manifest) của generation hiện tại. Generation không bao giờ bị sửa
+    nên index + metadata luôn khớp nhau; chỉ thử lại nếu generation vừa bị GC giữa chừng.
+    """
+    last_error = None
+    for _ in range(max(1, retries)):
+        try:
+            return _load_once()
+        except (RuntimeError, FileNotFoundError, ValueError) as e:
+            last_error = e
+            time.sleep(0.2)
+    raise RuntimeError(f"Không load được vector store: {last_error}")
+
+
+def load(retries=5):
+    """Load (index, metadata) đã ghép base + delta; metadata là view SQLite giới hạn theo ntotal."""
+    index, metadata, _manifest = load_generation(retries)
+    return index, metadata
+
+
+def load_all_vectors(manifest=None):
+    """Toàn bộ vector gốc (base + delta) theo thứ tự row id."""
+    manifest = manifest or read_manifest()
+    if manifest.get('base_vectors'):
+        base_vectors = np.load(_abs(manifest['base_vectors']), mmap_mode='r')
+    else:
+        # Store cũ (flat, chưa có file vector gốc): lấy lại từ index
+        base = faiss.read_index(_abs(manifest['base_index']))
+        base_vectors = base.reconstruct_n(0, base.ntotal) if base.ntotal else np.zeros((0, base.d), dtype='float32')
+    delta_vectors = _load_deltas(manifest)
+    if delta_vectors is None:
+        return np.asarray(base_vectors, dtype='float32')
+    return np.concatenate([base_vectors, delta_vectors]).astype('float32')
+
+
+# ======================================================
+# 🎞️ Chuỗi embedding từng frame (cho verify căn chỉnh theo thời gian)
+# ======================================================
+# Mỗi segment (base / delta) có 3 file: frames float16 [tổng số frame, d], times float32 (giây)
+# và offsets int64 [số row + 1]; frame của row i nằm ở [offsets[i], offsets[i+1]).
+def _save_sequences(gen_dir, prefix, sequences):
+    if sequences is None:
+        return None
+    rows = [(None, None) if seq is None else seq for seq in sequences]
+    lengths = np.array([0 if embs is None else len(embs) for _times, embs in rows], dtype='int64')
+    if not lengths.any():
+        return None
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+    dim = next(np.shape(embs)[1] for _times, embs in rows if embs is not None and len(embs))
+    paths = {key: os.path.join(gen_dir, f"{prefix}_seq_{key}.npy") for key in ('frames', 'times', 'offsets')}
+    # Ghi từng row vào file .npy (mmap) để compaction không phải giữ toàn bộ chuỗi trong RAM
+    frames = np.lib.format.open_memmap(paths['frames'], mode='w+', dtype='float16', shape=(int(offsets[-1]), dim))
+    times = np.lib.format.open_memmap(paths['times'], mode='w+', dtype='float32', shape=(int(offsets[-1]),))
+    for i, (row_times, embs) in enumerate(rows):
+        if lengths[i]:
+            frames[offsets[i]:offsets[i + 1]] = np.asarray(embs, dtype='float16')
+            times[offsets[i]:offsets[i + 1]] = np.asarray(row_times, dtype='float32')
+    frames.flush()
+    times.flush()
+    del frames, times
+    np.save(paths['offsets'], offsets)
+    return {key: _rel(path) for key, path in paths.items()}
+
+
+class SequenceStore:
+    """
+    Chuỗi embedding từng frame theo FAISS row id của 1 generation (đọc bằng mmap).
+    store[row_id] → (times float32, embeddings float16) hoặc None nếu video không có chuỗi.
+    """
+
+    def __init__(self, manifest):
+        self._segments = []   # (row bắt đầu, số row, frames, times, offsets) hoặc None
+        start = 0
+        parts = [(manifest.get('base_count') or 0, manifest.get('base_sequences'))]
+        parts += [(d['count'], d.get('sequences')) for d in manifest.get('deltas', [])]
+        for count, seq in parts:
+            arrays = None
+            if seq:
+                try:
+                    arrays = tuple(np.load(_abs(seq[key]), mmap_mode='r') for key in ('frames', 'times', 'offsets'))
+                except (OSError, ValueError) as e:
+                    print(f"[INDEX] Không đọc được chuỗi frame {seq.get('frames')}: {e}")
+            self._segments.append((start, count, arrays))
+            start += count
+        self.ntotal = start
+
+    @property
+    def available(self):
+        return any(arrays is not None for _start, _count, arrays in self._segments)
+
+    def __len__(self):
+        return self.ntotal
+
+    def __getitem__(self, row_id):
+        row_id = int(row_id)
+        for start, count, arrays in self._segments:
+            if start <= row_id < start + count:
+                if arrays is None:
+                    return None
+                frames, times, offsets = arrays
+                a, b = int(offsets[row_id - start]), int(offsets[row_id - start + 1])
+                return (times[a:b], frames[a:b]) if b > a else None
+        raise IndexError(row_id)
+
+    def __iter__(self):
+        for i in range(self.ntotal):
+            yield self[i]
+
+
+# ======================================================
+# 🔁 Double buffer: load generation mới ở nền rồi swap nguyên tử
+# ======================================================
+IndexGeneration = namedtuple('IndexGeneration', ['index', 'metadata', 'version', 'loaded_at', 'sequences'])
+
+
+class IndexHolder:
+    """
+    Giữ generation (index + metadata) hiện tại. Reader lấy current() 1 lần cho mỗi
+    request nên request đang chạy luôn hoàn tất trên generation cũ; generation mới
+    được load ở thread nền rồi thay bằng 1 phép gán (nguyên tử với GIL).
+    """
+
+    def __init__(self):
+        self._current = None
+        self._reload_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._watcher = None
+        self.reloads = 0
+        self.last_error = None
+
+    def current(self):
+        """Generation hiện tại; load đồng bộ ở lần gọi đầu tiên."""
+        gen = self._current
+        if gen is None:
+            self.refresh(force=True)
+            gen = self._current
+        return gen
+
+    def refresh(self, force=False):
+        """Load generation mới nếu store đã đổi (hoặc force). Trả về True nếu đã swap."""
+        with self._reload_lock:
+            if not force and self._current is not None and self._current.version == store_version():
+                return False
+            t0 = time.time()
+            index, metadata, manifest = load_generation()
+            self._current = IndexGeneration(index, metadata, manifest['generation'], time.time(),
+                                            SequenceStore(manifest))
+            self.reloads += 1
+            print(f"[INDEX] Đã swap generation {manifest['generation']}: {index.ntotal} vector ({time.time() - t0:.2f}s)")
+            return True
+
+    def request_reload(self):
+        """Báo watcher kiểm tra store ngay (không chặn caller)."""
+        self._wakeup.set()
+
+    def start_watcher(self, interval=None):
+        """Thread nền: kiểm tra store định kỳ hoặc khi có request_reload()."""
+        if self._watcher is not None:
+            return
+        interval = config.INDEX_WATCH_INTERVAL_SEC if interval is None else interval
+
+        def _loop():
+            while True:
+                self._wakeup.wait(interval)
+                self._wakeup.clear()
+                try:
+                    self.refresh()
+                    self.last_error = None
+                except Exception as e:
+                    # Giữ generation cũ, thử lại ở vòng sau
+                    self.last_error = str(e)
+                    print(f"[INDEX] Reload lỗi, tiếp tục dùng generation cũ: {e}")
+
+        self._watcher = threading.Thread(target=_loop, name="index-watcher", daemon=True)
+        self._watcher.start()
+
+    def info(self):
+        gen = self._current
+        return {
+            'loaded': gen is not None,
+            'generation': gen.version if gen is not None else None,
+            'ntotal': gen.index.ntotal if gen is not None else None,
+            'loaded_at': gen.loaded_at if gen is not None else None,
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+        }
+
+
+def existing_paths(paths):
+    """Các path trong `paths` đã có trong store (dùng để lọc trùng khi update)."""
+    manifest = read_manifest()
+    if manifest.get('metadata_db') is None:
+        return set()
+    store = metadata_store.get_store(_abs(manifest['metadata_db']))
+    return store.existing_paths(paths, limit=committed_count(manifest))
+
+
+def index_dimension():
+    """Dimension của base index hiện có, None nếu chưa có."""
+    return read_manifest().get('dim')
+
+
+# ======================================================
+# ✍️ Ghi (mỗi lần ghi = 1 generation mới)
+# ======================================================
+def _save_vectors(path, features_array):
+    _atomic_write_bytes(path, lambda f: np.save(f, np.ascontiguousarray(features_array, dtype='float32')))
+    return path
+
+
+def write_base(features_array, metadata_list, sequences=None):
+    """
+    Ghi base mới (mode create) với metadata DB mới; generation cũ không bị đụng tới.
+    sequences: list (theo row) các cặp (times, embeddings) từng frame để verify căn chỉnh theo thời gian.
+    """
+    with writer_lock():
+        return _write_base_locked(features_array, metadata_list, sequences=sequences)
+
+
+def _write_base_locked(features_array, metadata_list, metadata_db=None, sequences=None, parent=_ANY_PARENT):
+    name, gen_dir = _new_generation_dir()
+    if metadata_db is None:
+        # DB riêng cho generation này: reader của generation cũ vẫn đọc DB cũ
+        os.makedirs(config.METADATA_FOLDER, exist_ok=True)
+        db_path = os.path.join(config.METADATA_FOLDER, f"metadata_{name}.sqlite")
+        metadata_store.get_store(db_path).replace_all(metadata_list)
+        metadata_db = _rel(db_path)
+        print(f"Đã lưu metadata vào {db_path}")
+
+    # Vector gốc giữ riêng: index nén (IVF-PQ) không tái tạo được vector chính xác khi rebuild
+    vectors_path = _save_vectors(os.path.join(gen_dir, "base_vectors.npy"), features_array)
+    index, index_type = index_factory.build_index(features_array)
+    index_path = os.path.join(gen_dir, "base.faiss")
+    faiss.write_index(index, index_path)
+    print(f"Đã lưu index ({index_type}) vào {index_path}")
+
+    manifest = _empty_manifest(base_count=len(features_array), dim=int(features_array.shape[1]),
+                               index_type=index_type)
+    manifest.update(base_index=_rel(index_path), base_vectors=_rel(vectors_path), metadata_db=metadata_db,
+                    base_sequences=_save_sequences(gen_dir, "base", sequences))
+    _publish(manifest, name, parent=parent)
+    return len(features_array)
+
+
+def append_segment(features_array, metadata_list, sequences=None):
+    """
+    Ghi 1 delta nhỏ (mode update): chi phí chỉ phụ thuộc số video mới,
+    không phụ thuộc kích thước thư viện.
+    """
+    with writer_lock():
+        return _append_segment_locked(features_array, metadata_list, sequences=sequences)
+
+
+def _append_segment_locked(features_array, metadata_list, sequences=None):
+    migrate_legacy_layout()
+    manifest = read_manifest()
+    if manifest.get('base_index') is None:
+        raise FileNotFoundError(f"Chưa có base index trong {config.VECTOR_FOLDER}, hãy chạy mode create")
+    start_id = committed_count(manifest)
+
+    # Metadata trước (row id >= start_id chưa được reader nào nhìn thấy), rồi vector
+    metadata_store.get_store(_abs(manifest['metadata_db'])).append(metadata_list, start_id=start_id)
+    name, gen_dir = _new_generation_dir()
+    vec_path = _save_vectors(os.path.join(gen_dir, "delta.npy"), features_array)
+
+    # Commit: delta chỉ "tồn tại" với reader sau khi CURRENT trỏ tới generation mới
+    manifest['deltas'] = manifest['deltas'] + [
+        {'name': name, 'path': _rel(vec_path), 'count': len(metadata_list), 'created': time.time(),
+         'sequences': _save_sequences(gen_dir, "delta", sequences)}]
+    manifest = _publish(manifest, name, parent=manifest['generation'])
+    print(f"Đã ghi delta {name}: +{len(metadata_list)} video")
+    return committed_count(manifest)
+
+
+def needs_compaction():
+    manifest = read_manifest()
+    deltas = manifest.get('deltas', [])
+    if not deltas:
+        return False
+    if len(deltas) >= config.COMPACT_MAX_DELTAS:
+        return True
+    # Corpus vừa vượt ngưỡng train: rebuild base sang INDEX_TYPE đã cấu hình
+    if (manifest.get('index_type') or 'flat') != index_factory.resolve_index_type(committed_count(manifest)):
+        return True
+    oldest = min(d.get('created', time.time()) for d in deltas)
+    return time.time() - oldest >= config.COMPACT_MAX_AGE_SEC
+
+
+def compact():
+    """Gộp toàn bộ delta vào base. Trả về số video trong base mới (None nếu không có gì để gộp)."""
+    with writer_lock():
+        return _compact_locked()
+
+
+def _compact_locked():
+    migrate_legacy_layout()
+    manifest = read_manifest()
+    deltas = manifest.get('deltas', [])
+    if not deltas or not has_base():
+        return None
+    print(f"[COMPACT] Gộp {len(deltas)} delta vào base...")
+    features_array = load_all_vectors(manifest)
+    # Row id không đổi nên dùng tiếp metadata DB; index được build lại (train nếu đã vượt ngưỡng)
+    sequences = SequenceStore(manifest)
+    total = _write_base_locked(features_array, None, metadata_db=manifest['metadata_db'],
+                               sequences=sequences if sequences.available else None,
+                               parent=manifest['generation'])
+    print(f"[COMPACT] Xong: {total} video trong base")
+    return total
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Quản lý vector store (generation base + delta)")
+    parser.add_argument('--compact', action='store_true', help='Gộp delta vào base')
+    parser.add_argument('--migrate', action='store_true', help='Chuyển store cũ sang generation đầu tiên')
+    args = parser.parse_args()
+    if args.migrate:
+        print(migrate_legacy_layout() or "Không có store cũ để migrate")
+    elif args.compact:
+        compact()
+    else:
+        m = read_manifest()
+        print(json.dumps(m, ensure_ascii=False, indent=2))
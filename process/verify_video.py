@@ -5,105 +5,166 @@ os.environ.setdefault("OMP_NUM_THREADS", "1")
 
 import json
 import numpy as np
-import faiss
-from transformers import CLIPProcessor, CLIPModel
-import torch
-import cv2
-from PIL import Image
-import pickle
 import argparse
 import config  # <-- Dùng config.VERIFY_RATE
+import vector_store
+import model_registry
+from frame_sampler import FrameSampler, make_time_points
+from clip_embedder import iter_video_embeddings, RunningMean
+from frame_cache import get_frame_cache
+
+def align_sequences(query_times, query_embs, ref_times, ref_embs, max_lag=None, step=None, min_overlap=None):
+    """
+    Căn chỉnh theo thời gian bằng sliding cross-correlation trên ma trận similarity frame-frame
+    (vector hóa NumPy, không vòng lặp theo frame).
+    Với mỗi độ lệch δ (bội số của step, |δ| <= max_lag), frame query ở thời điểm t được ghép với
+    frame gốc gần t + δ nhất (lệch <= step/2); điểm của δ = cosine trung bình của các cặp ghép được.
+    Chỉ xét δ ghép được >= min_overlap * số frame query.
+    Trả về (score, lag_seconds, số cặp) của δ tốt nhất, None nếu không có δ hợp lệ.
+    """
+    max_lag = config.VERIFY_MAX_LAG_SEC if max_lag is None else max_lag
+    step = config.SAMPLE_RATE if step is None else step
+    min_overlap = config.VERIFY_MIN_OVERLAP if min_overlap is None else min_overlap
+    q = np.asarray(query_embs, dtype='float32')
+    r = np.asarray(ref_embs, dtype='float32')
+    qt = np.asarray(query_times, dtype='float64')
+    rt = np.asarray(ref_times, dtype='float64')
+    if len(q) == 0 or len(r) == 0:
+        return None
+
+    sims = q @ r.T                                                  # [nq, nr]
+    lags = np.arange(-max_lag, max_lag + step / 2, step)
+    lags = lags[np.argsort(np.abs(lags), kind='stable')]            # hòa điểm → ưu tiên |δ| nhỏ
+    target = qt[:, None] + lags[None, :]                            # [nq, nlag]
+    j = np.searchsorted(rt, target)
+    j_lo = np.clip(j - 1, 0, len(rt) - 1)
+    j_hi = np.clip(j, 0, len(rt) - 1)
+    pick = np.where(np.abs(rt[j_hi] - target) < np.abs(rt[j_lo] - target), j_hi, j_lo)
+    valid = np.abs(rt[pick] - target) <= step / 2 + 1e-6
+    vals = np.take_along_axis(sims, pick, axis=1)
+
+    matched = valid.sum(axis=0)
+    need = max(1, int(np.ceil(min_overlap * len(q))))
+    scores = np.where(matched >= need, (vals * valid).sum(axis=0) / np.maximum(matched, 1), -np.inf)
+    best = int(np.argmax(scores))
+    if not np.isfinite(scores[best]):
+        return None
+    return float(scores[best]), float(lags[best]), int(matched[best])
+
 
 class VideoVerifier:
-    def __init__(self):
-        print("Đang load CLIP model cho verify...")
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(config.CLIP_MODEL_NAME).to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(config.CLIP_MODEL_NAME)
-        self.model.eval()
-
-        # Load FAISS index
-        if not os.path.exists(config.FEATURES_FILE):
-            raise FileNotFoundError(f"Không tìm thấy: {config.FEATURES_FILE}")
-        self.index = faiss.read_index(config.FEATURES_FILE)
-
-        # Load metadata
-        if not os.path.exists(config.METADATA_FILE):
-            raise FileNotFoundError(f"Không tìm thấy: {config.METADATA_FILE}")
-        with open(config.METADATA_FILE, 'rb') as f:
-            self.metadata = pickle.load(f)
-
-        print(f"Đã load {len(self.metadata)} video từ DB")
+    def __init__(self, holder=None):
+        self.model, self.processor, self.device = model_registry.get_clip()
+        self.sampler = FrameSampler(default_fps=30)
+        self.frame_cache = get_frame_cache()
 
-    def extract_frames(self, video_path):
+        # FAISS index + metadata (base + delta), dùng chung holder với searcher nếu có
+        self.holder = holder or vector_store.IndexHolder()
+
+        print(f"Đã load {len(self.holder.current().metadata)} video từ DB")
+
+    @property
+    def index(self):
+        return self.holder.current().index
+
+    @property
+    def metadata(self):
+        return self.holder.current().metadata
+
+    def _time_points(self, sample_rate=None):
         """
-        Dùng config.VERIFY_RATE để lấy mẫu
+        Dùng config.VERIFY_RATE để lấy mẫu (hoặc sample_rate), trả về (time_points, callback in tiến trình)
         """
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            return []
-
-        fps = cap.get(cv2.CAP_PROP_FPS) or 30
-        frames = []
         start_time = config.START_TIME
         end_time = config.END_TIME
-        sample_rate = config.VERIFY_RATE  # Dùng config
-        time_points = np.arange(start_time, end_time, sample_rate)
+        sample_rate = config.VERIFY_RATE if sample_rate is None else sample_rate  # Dùng config
+        time_points = make_time_points(start_time, end_time, sample_rate)
         total = len(time_points)
 
         print(f"[VERIFY] Lấy mẫu mỗi {sample_rate}s → {total} khung hình")
 
-        for i, t in enumerate(time_points):
-            frame_no = int(t * fps)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-            ret, frame = cap.read()
-            if ret:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frames.append(Image.fromarray(frame_rgb))
-
+        def _progress(done, total):
             # IN TIẾN TRÌNH
-            progress = int((i + 1) / total * 100)
-            print(f"PROGRESS: {progress}")
+            print(f"PROGRESS: {int(done / total * 100)}")
 
-        cap.release()
-        return frames
+        return time_points, _progress
 
-    def get_feature(self, video_path):
-        frames = self.extract_frames(video_path)
-        if not frames:
-            return None
+    def iter_frames(self, video_path):
+        time_points, progress = self._time_points()
+        return self.sampler.iter_images(video_path, time_points, on_progress=progress)
 
-        inputs = self.processor(images=frames, return_tensors="pt", padding=True)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    def extract_frames(self, video_path):
+        return [img for _t, img in self.iter_frames(video_path)]
 
-        with torch.no_grad():
-            feats = self.model.get_image_features(**inputs)
-            feats = feats / feats.norm(p=2, dim=-1, keepdim=True)
-            vec = feats.mean(dim=0).cpu().numpy()
-            norm = np.linalg.norm(vec)
-            if norm > 0:
-                vec = vec / norm
-        return vec
+    def get_sequence(self, video_path, sample_rate=None):
+        """
+        (times, embeddings) từng frame ở VERIFY_RATE (hoặc sample_rate), sắp theo thời gian; (None, None) nếu rỗng.
+        Embed theo micro-batch, các frame trùng lưới mà search đã embed được lấy lại từ cache.
+        """
+        time_points, progress = self._time_points(sample_rate)
+        times, embs = [], []
+        for batch_times, batch_embs in iter_video_embeddings(self.sampler, video_path, time_points,
+                                                             cache=self.frame_cache, on_progress=progress):
+            times.append(batch_times)
+            embs.append(batch_embs)
+        if not embs:
+            return None, None
+        times, embs = np.concatenate(times), np.concatenate(embs)
+        order = np.argsort(times, kind='stable')
+        return times[order], embs[order]
+
+    def get_feature(self, video_path):
+        _times, embs = self.get_sequence(video_path)
+        if embs is None:
+            return None
+        acc = RunningMean()
+        acc.add(embs)
+        return acc.vector()
 
     def verify(self, query_path):
+        """
+        similarity: cosine vector trung bình với video gần nhất (thang điểm verify cũ, luôn có).
+        alignment_similarity: cosine trung bình của các cặp frame đã căn chỉnh theo thời gian với
+        VERIFY_CANDIDATES ứng viên (None nếu store không có chuỗi frame); thang điểm khác similarity.
+        """
         print(f"\n[VERIFY] Đang xử lý: {query_path}")
-        query_vec = self.get_feature(query_path)
-        if query_vec is None:
+        # Store chưa có chuỗi frame (store cũ/đã migrate): chỉ 1 lượt lấy mẫu ở VERIFY_MEAN_RATE như trước
+        gen = self.holder.current()
+        has_sequences = gen.sequences is not None and gen.sequences.available
+        times, embs = self.get_sequence(query_path, sample_rate=None if has_sequences else config.VERIFY_MEAN_RATE)
+        if embs is None:
             return None
-
-        query_vec = query_vec.reshape(1, -1).astype('float32')
-        D, I = self.index.search(query_vec, 1)
-        idx = I[0][0]
-        sim = float(D[0][0] * 100)
-
-        if idx < len(self.metadata):
-            video_info = self.metadata[idx]
+        acc = RunningMean()
+        acc.add(embs)
+        query_vec = acc.vector().reshape(1, -1).astype('float32')
+
+        D, I = gen.index.search(query_vec, config.VERIFY_CANDIDATES if has_sequences else 1)
+        idx = int(I[0][0])
+        result = {"similarity": round(float(D[0][0] * 100), 2), "method": "mean", "alignment_similarity": None}
+
+        best = None
+        for cand in (I[0] if has_sequences else []):
+            seq = gen.sequences[cand] if cand >= 0 else None
+            if seq is None:
+                continue
+            aligned = align_sequences(times, embs, seq[0], seq[1])
+            if aligned is not None and (best is None or aligned[0] > best[0]):
+                best = (*aligned, int(cand))
+        if best is not None:
+            score, lag, matched, idx = best
+            result.update(method="alignment", alignment_similarity=round(score * 100, 2), offset_sec=lag,
+                          frames=matched)
+
+        video_info = gen.metadata.get_many([idx]).get(idx)
+        if video_info is not None:
             print(f"[VERIFY] Video gốc: {video_info['video_name']}")
-            print(f"[VERIFY] Độ tương đồng: {sim:.2f}%")
+            print(f"[VERIFY] Độ tương đồng: {result['similarity']:.2f}%"
+                  + (f" (căn chỉnh {result['alignment_similarity']:.2f}%, lệch {result['offset_sec']:+.1f}s)"
+                     if best is not None else ""))
         else:
             print(f"[VERIFY] Không tìm thấy trong DB (idx={idx})")
 
-        return {"similarity": round(sim, 2)}
+        return result
 
 def main():
     parser = argparse.ArgumentParser(description="Verify video với độ chính xác cao")
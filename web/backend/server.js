@@ -21,6 +21,23 @@ const PYTHON_SERVICE_URL = process.env.PYTHON_SERVICE_URL || 'http://192.168.132
 
 console.log(`[INIT] Python Service URL: ${PYTHON_SERVICE_URL}`);
 
+// Endpoint đồng bộ của Python service trả 202 + result_url khi job chạy quá JOB_SYNC_TIMEOUT_SEC:
+// poll result_url tới khi có kết quả (200) hoặc lỗi, trong giới hạn timeout của lời gọi.
+async function callPythonService(endpoint, body, timeout) {
+  const deadline = Date.now() + timeout;
+  let response = await axios.post(`${PYTHON_SERVICE_URL}${endpoint}`, body, { timeout });
+  while (response.status === 202 && response.data && response.data.result_url) {
+    const remaining = deadline - Date.now();
+    if (remaining <= 0) {
+      throw new Error(`Python job ${response.data.job_id} chưa xong sau ${timeout} ms`);
+    }
+    await new Promise((r) => setTimeout(r, Math.min(2000, remaining)));
+    response = await axios.get(`${PYTHON_SERVICE_URL}${response.data.result_url}`,
+      { timeout: Math.max(1, deadline - Date.now()) });
+  }
+  return response;
+}
+
 // ==================== CONFIG ====================
 const app = express();
 const PORT = process.env.PORT || 5050;
@@ -290,11 +307,9 @@ async function runSearchJob(videoPath, requestId, shouldCleanup = true) {
     // Gọi Python service qua HTTP
     console.log(`[${logId}] [PYTHON] Calling service: ${PYTHON_SERVICE_URL}/search`);
     console.log(`[${logId}] [PYTHON] Video path: ${normalizedVideoPath}`);
-    const response = await axios.post(`${PYTHON_SERVICE_URL}/search`, {
+    const response = await callPythonService('/search', {
       video_path: normalizedVideoPath
-    }, {
-      timeout: 300000 // 5 minutes timeout
-    });
+    }, 300000); // 5 minutes timeout
 
     const results = response.data;
     if (!Array.isArray(results)) {
@@ -558,6 +573,35 @@ app.get('/template', async (_req, res) => {
  *                     type: string
  *                   description: Array of absolute paths to template video files
  *                   example: ["/data/daga/1daga/6video_cut/cut.mov", "/data/daga/1daga/6video_cut/ad1.mp4"]
+ *                 signatures:
+ *                   type: array
+ *                   description: Precompiled signatures from templates.sig.json (built by `segment_videos.py templates build`), only for templates unchanged since the build and libraries with a supported version/decoder. The hash is only comparable with hashes from the same decoder and step_sec
+ *                   items:
+ *                     type: object
+ *                     properties:
+ *                       path:
+ *                         type: string
+ *                       name:
+ *                         type: string
+ *                       hash:
+ *                         type: string
+ *                         description: Median 64-bit average hash (16 hex chars)
+ *                         example: "ce8463b1a8a7c7c0"
+ *                       duration:
+ *                         type: number
+ *                       decoder:
+ *                         type: string
+ *                         description: Hash pipeline that produced the signature (segment_videos.py --decoder)
+ *                         example: "opencv"
+ *                       step_sec:
+ *                         type: number
+ *                         description: Frame sampling step the median hash was built with
+ *                         example: 0.5
+ *                       browser_hash:
+ *                         type: string
+ *                         nullable: true
+ *                         description: Template hash computed like the frontend canvas hash (frames at 20/40/60/80% of the duration, RGB luma, majority vote); comparable with live-frame hashes. null for libraries built before this field existed
+ *                         example: "ce8463b1a8a7c7c0"
  *                 message:
  *                   type: string
  *                   description: Optional message (e.g., if directory doesn't exist)
@@ -574,6 +618,45 @@ app.get('/template', async (_req, res) => {
  *                 details:
  *                   type: string
  */
+// Signature library written by `segment_videos.py templates build` (median hash per template)
+const TEMPLATE_LIBRARY_FILE = path.join(TEMPLATE_DIR, 'templates.sig.json');
+const TEMPLATE_LIBRARY_VERSION = 1;
+const TEMPLATE_LIBRARY_DECODERS = ['ffmpeg', 'opencv'];
+
+// Signatures for the given template files; entries whose file changed since the build are skipped
+async function loadTemplateSignatures(files) {
+  let library;
+  try {
+    library = JSON.parse(await fsPromises.readFile(TEMPLATE_LIBRARY_FILE, 'utf8'));
+  } catch (_) {
+    return [];
+  }
+  const decoder = library.decoder || 'opencv';
+  const stepSec = Number(library.step_sec);
+  if (library.version !== TEMPLATE_LIBRARY_VERSION || !TEMPLATE_LIBRARY_DECODERS.includes(decoder) || !(stepSec > 0)) {
+    console.warn(`[TEMPLATES] Ignoring ${TEMPLATE_LIBRARY_FILE}: unsupported version/decoder/step_sec (${library.version}/${decoder}/${library.step_sec})`);
+    return [];
+  }
+  const byName = new Map((library.templates || []).map(t => [t.name, t]));
+  const signatures = [];
+  for (const file of files) {
+    const entry = byName.get(path.basename(file));
+    if (!entry) continue;
+    try {
+      const stat = await fsPromises.stat(file);
+      if (stat.size !== entry.size || Math.abs(stat.mtimeMs / 1000 - entry.mtime) >= 1e-3) continue;
+    } catch (_) {
+      continue;
+    }
+    signatures.push({ path: file, name: entry.name, hash: entry.hash, duration: entry.duration, decoder, step_sec: stepSec,
+      browser_hash: entry.browser_hash || null });
+  }
+  if (signatures.length < files.length) {
+    console.warn(`[TEMPLATES] ${files.length - signatures.length} template(s) without up-to-date signature in ${TEMPLATE_LIBRARY_FILE}`);
+  }
+  return signatures;
+}
+
 // List all template clips under TEMPLATE_DIR (absolute paths)
 app.get('/templates', async (_req, res) => {
   try {
@@ -601,7 +684,8 @@ app.get('/templates', async (_req, res) => {
       return res.status(500).json({ error: `Cannot read template directory: ${readError.message}` });
     }
     
-    return res.json({ templates: files });
+    const signatures = await loadTemplateSignatures(files);
+    return res.json({ templates: files, signatures });
   } catch (e) {
     console.error('[TEMPLATES] error:', e.message);
     return res.status(500).json({ error: 'List templates error', details: e.message });
@@ -847,16 +931,18 @@ app.post('/verify/start', async (req, res) => {
   setImmediate(async () => {
     try {
       // Gọi Python service qua HTTP
-      const response = await axios.post(`${PYTHON_SERVICE_URL}/verify`, {
+      const response = await callPythonService('/verify', {
         video_path: videoPath
-      }, {
-        timeout: 300000 // 5 minutes
-      });
+      }, 300000); // 5 minutes
 
       verifyJobs[verifyId] = {
         status: 'completed',
         progress: 100,
         similarity: response.data.similarity || 0,
+        // Điểm căn chỉnh chuỗi frame: thang điểm riêng, không so sánh trực tiếp với similarity
+        alignment_similarity: response.data.alignment_similarity ?? null,
+        method: response.data.method || null,
+        offset_sec: response.data.offset_sec ?? null,
       };
     } catch (e) {
       console.error(`[VERIFY] Error: ${e.message}`);
@@ -911,9 +997,7 @@ app.get('/search/latest', async (_req, res) => {
 app.post('/update-db', async (req, res) => {
   try {
     // Gọi Python service qua HTTP
-    const response = await axios.post(`${PYTHON_SERVICE_URL}/extract`, {}, {
-      timeout: 3600000 // 1 hour timeout for extraction
-    });
+    const response = await callPythonService('/extract', {}, 3600000); // 1 hour timeout for extraction
     
     res.json({ 
       success: true, 
@@ -537,9 +537,14 @@ function App() {
       const res = await axios.get(`${API_BASE}/templates`);
       const templates = res.data.templates || [];
       if (!templates.length) throw new Error('No templates in folder');
+      // browser_hash của thư viện tính giống computeTemplateHash; `hash` (median của segment_videos.py)
+      // là thuật toán khác nên không dùng. Template chưa có browser_hash thì tự hash bằng canvas.
+      const browserHashes = new Map((res.data.signatures || [])
+        .filter(s => /^[0-9a-f]{16}$/i.test(s.browser_hash || ''))
+        .map(s => [s.path, BigInt(`0x${s.browser_hash}`)]));
       const hashes = {};
       for (const tmplPath of templates) {
-        hashes[tmplPath] = await computeTemplateHash(tmplPath);
+        hashes[tmplPath] = browserHashes.has(tmplPath) ? browserHashes.get(tmplPath) : await computeTemplateHash(tmplPath);
       }
       templateHashesRef.current = hashes;
       console.log('[FE][AutoSplit] Loaded templates:', Object.keys(hashes));